@@ -2,27 +2,51 @@
 # ===============================================================================
 # Copyright (c) 2016 by Frank Fischer
 # ===============================================================================
+# Without arguments, prints MachineMaxWalltime and MachineStarttime for
+# "include command" in the HTCondor configuration.
+# With --cron, runs as continuous startd cron job publishing the remaining
+# walltime and whether the machine should drain, configured by workers.yml.
+# ===============================================================================
 from __future__ import unicode_literals, print_function, with_statement
 
+import argparse
+import json
 import os
 import pickle
 import re
+import sys
+import tempfile
 import time
 
+# cloud-init's JSON instance data, read before falling back to its pickle
+INSTANCE_DATA = "/run/cloud-init/instance-data.json"
+OBJ_PKL = "/var/lib/cloud/instance/obj.pkl"
+# Extracted times, valid as long as the source file is unchanged
+CACHE_FILE = "/var/cache/meta_walltime.json"
+
 
-def get_times():
+def meta_from_json(path):
     """
-    Retrieve wall time from cloud-init meta-data.
+    Return the user meta-data of the instance from cloud-init's JSON instance data.
+
+    The meta-data of the datasource is stored under 'ds', OpenStack's additional metadata in its sub-dictionary 'meta'."""
+    with open(path, "r") as file_:
+        data = json.load(file_)
+    return data.get("ds", {}).get("meta_data", {}).get("meta")
+
+
+def meta_from_pickle(path):
+    """
+    Return the user meta-data of the instance from the pickled cloud-init DataSource.
 
     Cloud-Init saves all passed meta-data into a cloudinit.sources.DataSource object with attribute 'metadata'
     A DataSourceOpenStack object stores information on additional metadata in a sub-dictionary 'meta'."""
-    try:
-        with open("/var/lib/cloud/instance/obj.pkl", "r") as file_:
-            data = pickle.load(file_)
-    except IOError:
-        return
+    with open(path, "rb") as file_:
+        data = pickle.load(file_)
+    return data.metadata.get("meta")
+
 
-    meta = data.metadata.get("meta")
+def find_walltime(meta):
     if meta is None:
         raise EnvironmentError("Wrong virtualization environment.")
 
@@ -33,41 +57,185 @@ def get_times():
         else:
             raise ValueError("Ambiguous meta-data found: %s" % keys)
 
-    walltime = int(meta.get(keys[0]))
-    starttime = int(os.stat("/var/lib/cloud/instance/obj.pkl").st_ctime)
+    return int(meta.get(keys[0]))
+
+
+def load_cache(cache_file, source):
+    """
+    Return the cached (walltime, starttime) if they were extracted from source as it is now.
+    """
+    try:
+        with open(cache_file, "r") as file_:
+            cache = json.load(file_)
+    except (IOError, ValueError):
+        return None
+    if cache.get("path") != source["path"] or cache.get("mtime") != source["mtime"] \
+            or cache.get("size") != source["size"]:
+        return None
+    return cache["walltime"], cache["starttime"]
+
+
+def save_cache(cache_file, source, walltime, starttime):
+    cache = dict(source, walltime=walltime, starttime=starttime)
+    try:
+        fd, name = tempfile.mkstemp(dir=os.path.dirname(cache_file))
+        with os.fdopen(fd, "w") as file_:
+            json.dump(cache, file_)
+        os.rename(name, cache_file)
+    except (IOError, OSError):
+        # Extracted again next time
+        pass
+
+
+def get_times(cache_file=CACHE_FILE, instance_data=INSTANCE_DATA, obj_pkl=OBJ_PKL):
+    """
+    Retrieve wall time from cloud-init meta-data.
+
+    The JSON instance data is preferred, the pickled DataSource is only loaded if it is missing.
+    The result is cached in cache_file until the source changes, so later runs skip reading it."""
+    path = instance_data if os.path.exists(instance_data) else obj_pkl
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return
+    source = {"path": path, "mtime": stat.st_mtime, "size": stat.st_size}
+    cached = load_cache(cache_file, source)
+    if cached is not None:
+        return cached
+
+    if path == instance_data:
+        meta = meta_from_json(path)
+    else:
+        try:
+            meta = meta_from_pickle(path)
+        except IOError:
+            return
+    walltime = find_walltime(meta)
+    # The pickle is written once when the instance is set up
+    try:
+        starttime = int(os.stat(obj_pkl).st_ctime)
+    except OSError:
+        starttime = int(stat.st_ctime)
+    save_cache(cache_file, source, walltime, starttime)
     return walltime, starttime
 
 
+def uptime_starttime():
+    """
+    Return the boot time from /proc/uptime.
+    """
+    with open("/proc/uptime", "r") as _file:
+        uptime = float(_file.readline().split()[0])
+    return int(time.time() - uptime)
+
+
+def walltime_ad(times, now, drain_before):
+    """
+    Return the startd cron attributes at time now for (walltime, starttime) as returned by get_times, or None.
+
+    MachineDrainSoon is set once less than drain_before seconds of the walltime remain."""
+    if times is None:
+        return ["MachineStarttime = %d" % uptime_starttime(), "MachineDrainSoon = False"]
+    walltime, starttime = times
+    remaining = max(starttime + walltime - int(now), 0)
+    return [
+        "MachineMaxWalltime = %d" % walltime,
+        "MachineStarttime = %d" % starttime,
+        "MachineRemainingWalltime = %d" % remaining,
+        "MachineDrainSoon = %s" % (remaining < drain_before),
+    ]
+
+
+def next_interval(times, now, drain_before, min_interval=30, max_interval=600):
+    """
+    Return the seconds until the next update: a tenth of the remaining walltime, within the bounds.
+
+    Updates get more frequent as the walltime runs out, and one falls on the moment to start draining."""
+    if times is None:
+        return max_interval
+    walltime, starttime = times
+    remaining = starttime + walltime - now
+    interval = min(max(remaining / 10.0, min_interval), max_interval)
+    until_drain = remaining - drain_before
+    if until_drain > 0:
+        interval = min(interval, max(until_drain, 1))
+    return interval
+
+
+def publish(args, out=sys.stdout, clock=time.time, sleep=time.sleep):
+    """
+    Write the walltime attributes as continuous startd cron output, every block terminated by a line "-".
+    """
+    updates = 0
+    while True:
+        now = clock()
+        try:
+            times = get_times(args.cache_file, args.instance_data, args.obj_pkl)
+        except (ValueError, EnvironmentError, TypeError):
+            times = None
+        out.write("\n".join(walltime_ad(times, now, args.drain_before)) + "\n-\n")
+        out.flush()
+        updates += 1
+        if args.count and updates >= args.count:
+            return
+        sleep(next_interval(times, now, args.drain_before, args.min_interval, args.max_interval))
+
+
 def save_env(wall_time_=None, start_time_=None, environment_file="/etc/environment"):
     """
     Save wall-time information to system variables WALLTIME & BOOTTIME.
 
     Values by default are stored in /etc/environment, discarding old wall-/boottime entries, preserving the rest.
-    """
+    The file is only rewritten if the values change."""
     if not os.access(environment_file, os.W_OK):
         raise EnvironmentError("Can't write to %s" % environment_file)
 
-    with open(name=environment_file, mode="r") as file_:
-        # keep results != WALLTIME/BOOTTIME
-        content = [entry for entry in file_.readlines() if re.match("(?:WALL|BOOT)TIME", entry, re.IGNORECASE) is None]
-        if wall_time_ is not None:
-            content.append("WALLTIME=%d\n" % wall_time_)
-        if start_time_ is not None:
-            content.append("BOOTTIME=%d\n" % start_time_)
-    with open(name=environment_file, mode="w") as file_:
+    with open(environment_file, mode="r") as file_:
+        old_content = file_.readlines()
+    # keep results != WALLTIME/BOOTTIME
+    content = [entry for entry in old_content if re.match("(?:WALL|BOOT)TIME", entry, re.IGNORECASE) is None]
+    if wall_time_ is not None:
+        content.append("WALLTIME=%d\n" % wall_time_)
+    if start_time_ is not None:
+        content.append("BOOTTIME=%d\n" % start_time_)
+    if content == old_content:
+        return
+    with open(environment_file, mode="w") as file_:
         file_.writelines(content)
 
 
+def make_parser():
+    parser = argparse.ArgumentParser(description="Publish the walltime of a cloud worker to HTCondor")
+    parser.add_argument("--cron", action="store_true", help="run as continuous startd cron job")
+    parser.add_argument("--drain-before", type=int, default=3600,
+                        help="seconds of remaining walltime below which MachineDrainSoon is set")
+    parser.add_argument("--min-interval", type=float, default=30, help="minimum seconds between updates")
+    parser.add_argument("--max-interval", type=float, default=600, help="maximum seconds between updates")
+    parser.add_argument("--count", type=int, help="stop after this many updates")
+    parser.add_argument("--instance-data", default=INSTANCE_DATA)
+    parser.add_argument("--obj-pkl", default=OBJ_PKL)
+    parser.add_argument("--cache-file", default=CACHE_FILE)
+    return parser
+
+
 if __name__ == "__main__":
+    args = make_parser().parse_args()
+    if args.cron:
+        try:
+            publish(args)
+        except KeyboardInterrupt:
+            pass
+        sys.exit(0)
     try:
-        wall_time, start_time = get_times()
+        wall_time, start_time = get_times(args.cache_file, args.instance_data, args.obj_pkl)
+    except (ValueError, EnvironmentError, TypeError):
+        # Fall back on reading /proc/uptime
+        print("MachineStarttime=%d" % uptime_starttime())
+    else:
         # Condor parses stdout as configuration file content
         print("MachineMaxWalltime=%d" % wall_time)
         print("MachineStarttime=%d" % start_time)
-        save_env(wall_time, start_time)
-    except (ValueError, EnvironmentError, TypeError):
-        # Fall back on reading /proc/uptime
-        with open("/proc/uptime", "r") as _file:
-            uptime = float(_file.readline().split()[0])
-        boot_time = int(time.time() - uptime)
-        print("MachineStarttime=%d" % boot_time)
+        try:
+            save_env(wall_time, start_time)
+        except EnvironmentError:
+            pass
@@ -0,0 +1,204 @@
+#!/usr/bin/env python3
+# Stand-in for the external tools of build.py, so the benchmarks run on a plain
+# Linux box without KVM, network or cloud credentials. The executables in
+# benchmarks/bin are symlinks to this file, which acts according to the name
+# it was called by. Volume and rate of the output are set by the benchmark:
+#   FAKE_LINES       lines of Ansible output of "packer build" (default 2000)
+#   FAKE_RATE        lines per second, 0 for as fast as possible (default 0)
+#   FAKE_IMAGE_MB    size of the image "packer build" writes (default 64)
+#   FAKE_DATA_RATIO  share of non-zero blocks in that image (default 0.5)
+#   FAKE_STATE_DIR   where the fake OpenStack keeps its images
+# The ssh/scp "remote host" is the local machine.
+
+import hashlib
+import json
+import os
+import pathlib
+import random
+import shutil
+import subprocess
+import sys
+import time
+
+CHUNK_SIZE = 4 * 1024**2
+BLOCK_SIZE = 1024**2
+
+
+def env_number(name: str, default: float) -> float:
+    return float(os.environ.get(name, default))
+
+
+def emit(lines):
+    """
+    Writes lines to stdout at FAKE_RATE lines per second.
+    """
+    rate = env_number("FAKE_RATE", 0)
+    start = time.monotonic()
+    out = sys.stdout.buffer
+    for index, line in enumerate(lines):
+        out.write(line.encode() + b"\n")
+        if rate:
+            out.flush()
+            delay = start + (index + 1) / rate - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+    out.flush()
+
+
+def write_image(path: pathlib.Path):
+    """
+    Writes a sparse image with a share of random blocks, like a fresh install.
+    """
+    size = int(env_number("FAKE_IMAGE_MB", 64)) * 1024**2
+    ratio = env_number("FAKE_DATA_RATIO", 0.5)
+    # Reproducible contents, the benchmarks compare runs
+    rng = random.Random(size)
+    data = rng.randbytes(BLOCK_SIZE)
+    with open(path, "wb") as f:
+        for offset in range(0, size, BLOCK_SIZE):
+            if rng.random() < ratio:
+                f.seek(offset)
+                # Vary the block a little, so checksums see different data
+                f.write(offset.to_bytes(8, "big") + data[8:])
+        f.truncate(size)
+
+
+def copy_file(source: str, target: str):
+    with open(source, "rb") as src, open(target, "wb") as dst:
+        shutil.copyfileobj(src, dst, CHUNK_SIZE)
+
+
+def packer(args):
+    if args[0] == "init":
+        emit(["Installed plugin github.com/hashicorp/qemu v1.1.0"])
+        return 0
+    source = next(x for x in args if x.startswith("-only=")).split(".", 1)[1]
+    vm_name = source.removesuffix("-base").removesuffix("-layered")
+    output_directory = pathlib.Path(os.environ["PKR_VAR_output_directory"])
+    prefix = f"qemu.{source}"
+    lines = [
+        f"==> {prefix}: Retrieving ISO",
+        f"==> {prefix}: Starting VM, booting from CD-ROM",
+        f"==> {prefix}: Waiting for SSH to become available...",
+        f"==> {prefix}: Provisioning with shell script: templates/base-provisioning.sh",
+        f"==> {prefix}: Provisioning with Ansible...",
+        f"    {prefix}: PLAY [generic] *************************************************",
+    ]
+    tasks = int(env_number("FAKE_LINES", 2000)) // 4
+    for task in range(tasks):
+        lines += [
+            f"    {prefix}: TASK [role : task {task}] ****************************************",
+            f"    {prefix}: changed: [default] => (item=package-{task})",
+            f"    {prefix}: ok: [default]",
+            f"    {prefix}:",
+        ]
+    lines += [
+        f"    {prefix}: PLAY RECAP *****************************************************",
+        f"    {prefix}: default : ok={tasks} changed={tasks} unreachable=0 failed=0",
+        f"==> {prefix}: Gracefully halting virtual machine...",
+        f"Build '{prefix}' finished after 1 second.",
+    ]
+    output_directory.mkdir(parents=True, exist_ok=True)
+    write_image(output_directory / vm_name)
+    emit(lines)
+    return 0
+
+
+def qemu_img(args):
+    if args[0] == "convert":
+        source, target = args[-2:]
+        copy_file(source, target)
+    elif args[0] == "info":
+        print(json.dumps({"virtual-size": os.path.getsize(args[-1])}))
+    elif args[0] == "create":
+        with open(args[-2], "wb") as f:
+            f.truncate(int(args[-1]))
+    return 0
+
+
+def nbdcopy(args):
+    """
+    Supports the two uses in build.py: reading an image exported by qemu-nbd
+    to stdout, and writing stdin to an image exported by qemu-nbd.
+    """
+    args = args[args.index("--") + 1 :] if "--" in args else args
+    if args[0] == "[":
+        close = args.index("]")
+        with open(args[close - 1], "rb") as f:
+            shutil.copyfileobj(f, sys.stdout.buffer, CHUNK_SIZE)
+        return 0
+    target = args[args.index("]") - 1].rsplit("filename=", 1)[-1]
+    with open(target, "r+b") as f:
+        shutil.copyfileobj(sys.stdin.buffer, f, CHUNK_SIZE)
+    return 0
+
+
+def qemu_nbd(args):
+    sys.exit("qemu-nbd: only supported as server of nbdcopy")
+
+
+def openstack(args):
+    state = pathlib.Path(os.environ["FAKE_STATE_DIR"]) / "openstack"
+    state.mkdir(parents=True, exist_ok=True)
+    name = args[-1]
+    if args[:2] == ["image", "show"]:
+        print((state / f"{name}.json").read_text())
+        return 0
+    sha512, md5, size = hashlib.sha512(), hashlib.md5(), 0
+    source = open(args[args.index("--file") + 1], "rb") if "--file" in args else None
+    with source or sys.stdin.buffer as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+            sha512.update(chunk)
+            md5.update(chunk)
+            size += len(chunk)
+    image = {
+        "name": name,
+        "size": size,
+        "checksum": md5.hexdigest(),
+        "os_hash_algo": "sha512",
+        "os_hash_value": sha512.hexdigest(),
+    }
+    (state / f"{name}.json").write_text(json.dumps(image))
+    emit([f"| {key} | {value} |" for key, value in image.items()])
+    return 0
+
+
+def strip_options(args, with_value="i"):
+    """
+    Drops the ssh/scp options before the first other argument,
+    returns the remaining arguments.
+    """
+    index = 0
+    while index < len(args) and args[index].startswith("-"):
+        index += 2 if args[index][1:] in with_value else 1
+    return args[index:]
+
+
+def scp(args):
+    source, target = strip_options(args)
+    copy_file(source, target.split(":", 1)[1])
+    return 0
+
+
+def ssh(args):
+    # Like ssh, the remote command is the rest of the arguments joined by spaces
+    command = strip_options(args)[1:]
+    return subprocess.call(" ".join(command), shell=True)
+
+
+TOOLS = {
+    "packer": packer,
+    "qemu-img": qemu_img,
+    "nbdcopy": nbdcopy,
+    "qemu-nbd": qemu_nbd,
+    "openstack": openstack,
+    "scp": scp,
+    "ssh": ssh,
+}
+
+
+if __name__ == "__main__":
+    tool = os.path.basename(sys.argv[0])
+    if tool not in TOOLS:
+        sys.exit(f"fake_tool.py: unknown tool {tool}")
+    sys.exit(TOOLS[tool](sys.argv[1:]))
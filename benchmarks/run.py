@@ -0,0 +1,349 @@
+#!/usr/bin/env python
+# Benchmarks of the build orchestration in build.py.
+# packer, qemu-img, nbdcopy, openstack, scp and ssh are replaced by the stand-ins
+# in benchmarks/bin (see fake_tool.py), which produce realistic volumes of output
+# and images without KVM, network or cloud credentials. What is measured is
+# build.py itself: log throughput of run_subprocess_with_spinner, the CPU cost
+# of the Spinner, concurrency of the stage graph, throughput of the streaming
+# pipeline and the overhead of a whole build.
+# Results are compared with a saved baseline, a metric that got worse by more
+# than the threshold factor (and more than its noise level) is a regression:
+#   python benchmarks/run.py [--quick] [--only log,stream] [--threshold 1.25]
+#   python benchmarks/run.py --save-baseline
+
+import argparse
+import contextlib
+import datetime
+import json
+import os
+import pathlib
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCH_DIR = pathlib.Path(__file__).parent.absolute()
+DIR_PATH = BENCH_DIR.parent
+
+# The stand-ins must be found before build.py looks up its tools
+os.environ["PATH"] = f"{BENCH_DIR / 'bin'}{os.pathsep}{os.environ['PATH']}"
+sys.path.insert(0, str(DIR_PATH))
+
+import build  # noqa: E402
+import build_report  # noqa: E402
+
+RESULTS_DIR = DIR_PATH / "reports" / "benchmarks"
+BASELINE_FILE = RESULTS_DIR / "baseline.json"
+
+
+def metric(value: float, unit: str, better: str, noise: float = 0) -> dict:
+    """
+    A benchmark result. better is "lower" or "higher", differences up to noise
+    (in unit) never count as regression.
+    """
+    return {"value": round(value, 6), "unit": unit, "better": better, "noise": noise}
+
+
+@contextlib.contextmanager
+def quiet():
+    """
+    Sends the console output of build.py and of the commands it runs to
+    /dev/null, at the file descriptor level since commands inherit them.
+    """
+    sys.stdout.flush()
+    sys.stderr.flush()
+    saved = [os.dup(1), os.dup(2)]
+    devnull = os.open(os.devnull, os.O_WRONLY)
+    try:
+        os.dup2(devnull, 1)
+        os.dup2(devnull, 2)
+        yield
+    finally:
+        sys.stdout.flush()
+        sys.stderr.flush()
+        os.dup2(saved[0], 1)
+        os.dup2(saved[1], 2)
+        for fd in [*saved, devnull]:
+            os.close(fd)
+
+
+def fake_env(directory: pathlib.Path, **settings) -> dict:
+    env = os.environ.copy()
+    env["FAKE_STATE_DIR"] = str(directory)
+    env["PKR_VAR_output_directory"] = str(directory / "images")
+    env.update({f"FAKE_{key.upper()}": str(value) for key, value in settings.items()})
+    return env
+
+
+def bench_log(directory: pathlib.Path, scale: float) -> dict:
+    """
+    Lines per second through run_subprocess_with_spinner, with the build report
+    parsing them, compared with the fake packer writing to /dev/null.
+    """
+    lines = int(200_000 * scale)
+    env = fake_env(directory, lines=lines, image_mb=1)
+    command = "packer build -only=qemu.rockylinux-9-latest-x86_64 templates"
+    start = time.perf_counter()
+    subprocess.run(command, shell=True, env=env, stdout=subprocess.DEVNULL, check=True)
+    alone = time.perf_counter() - start
+    stage = build_report.Stage("BUILD")
+    start = time.perf_counter()
+    with quiet():
+        build.run_subprocess_with_spinner(
+            "BUILD",
+            subprocess.Popen(
+                command,
+                env=env,
+                shell=True,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+            ),
+            show_spinner=False,
+            line_callbacks=[stage.on_line],
+        )
+    piped = time.perf_counter() - start
+    return {
+        "log_lines_per_second": metric(lines / piped, "lines/s", "higher"),
+        "log_overhead_per_line": metric(
+            max(piped - alone, 0) / lines * 1e6, "us", "lower", noise=2
+        ),
+    }
+
+
+def bench_spinner(directory: pathlib.Path, scale: float) -> dict:
+    """
+    CPU time the Spinner takes while a command runs.
+    """
+    duration = 3 * scale
+    with quiet():
+        start = time.process_time()
+        with build.Spinner():
+            time.sleep(duration)
+        cpu = time.process_time() - start
+    return {"spinner_cpu": metric(cpu / duration * 100, "%", "lower", noise=0.5)}
+
+
+def bench_stages(directory: pathlib.Path, scale: float) -> dict:
+    """
+    Runs the shape of the post-build graph with stages of equal length and
+    compares its duration with the critical path.
+    """
+    length = 0.5 * scale
+
+    def stage():
+        subprocess.run(["sleep", str(length)], check=True)
+
+    graph = build.StageGraph()
+    graph.add("convert", stage)
+    graph.add("checksum", stage, after=["convert"])
+    graph.add("openstack", stage, after=["convert"])
+    graph.add("publish", stage, after=["convert"])
+    graph.add("verify-openstack", stage, after=["openstack", "checksum"])
+    graph.add("verify-publish", stage, after=["publish", "checksum"])
+    start = time.perf_counter()
+    with quiet():
+        status = graph.run()
+    duration = time.perf_counter() - start
+    if set(status.values()) != {"ok"}:
+        raise RuntimeError(f"Stages failed: {status}")
+    critical_path = 3 * length
+    return {
+        "stage_graph_overhead": metric(
+            duration - critical_path, "s", "lower", noise=0.05
+        ),
+        "stage_graph_efficiency": metric(critical_path / duration, "", "higher"),
+    }
+
+
+def bench_stream(directory: pathlib.Path, scale: float) -> dict:
+    """
+    Throughput of the streaming pipeline into a sparse file, two checksums
+    and a command, the sinks of a conversion with upload.
+    """
+    size = int(1024 * scale)
+    env = fake_env(directory, lines=0, image_mb=size)
+    subprocess.run(
+        "packer build -only=qemu.bench templates",
+        shell=True,
+        env=env,
+        stdout=subprocess.DEVNULL,
+        check=True,
+    )
+    image = directory / "images" / "bench"
+    sinks = [
+        build.FileSink("RAW IMAGE", directory / "bench.raw"),
+        build.ChecksumSink("sha256"),
+        build.ChecksumSink("md5"),
+        build.ProcessSink("UPLOAD", "cat > /dev/null"),
+    ]
+    start = time.perf_counter()
+    with quiet():
+        build.stream_to_sinks(
+            "CONVERT",
+            f"nbdcopy --synchronous -- [ qemu-nbd --read-only --format=qcow2 {image} ] -",
+            sinks,
+            show_spinner=False,
+        )
+    duration = time.perf_counter() - start
+    return {"stream_throughput": metric(size / duration, "MiB/s", "higher")}
+
+
+def bench_pipeline(directory: pathlib.Path, scale: float) -> dict:
+    """
+    A whole build with OpenStack upload and publishing, once with the raw
+    image written first and once streamed.
+    """
+    results = {}
+    os.environ.update(
+        {
+            "FAKE_STATE_DIR": str(directory),
+            "FAKE_LINES": str(int(20_000 * scale)),
+            "FAKE_IMAGE_MB": str(int(256 * scale)),
+            "OS_AUTH_URL": "http://openstack.invalid",
+            "OS_APPLICATION_CREDENTIAL_ID": "bench",
+            "OS_APPLICATION_CREDENTIAL_SECRET": "bench",
+        }
+    )
+    for stream in [False, True]:
+        published = directory / f"published-{stream}"
+        published.mkdir()
+        image = build.Build(
+            openstack=True,
+            template="rockylinux-9-latest-x86_64",
+            conda_env=None,
+            provisioning=["generic"],
+            delivery="kvm",
+            comment="bench",
+            pvt_key=directory / "id_bench",
+            ansible_args=None,
+            show_spinner=False,
+            output_directory=directory / f"images-{stream}",
+            publish_target=f"bench-host:{published}",
+        )
+        # Keep the artifacts out of the repository
+        image.image_path = directory / f"{image.image_name}.raw"
+        start = time.perf_counter()
+        with quiet():
+            image.build()
+            status = image.post_build_graph(stream=stream).run()
+        duration = time.perf_counter() - start
+        if set(status.values()) != {"ok"}:
+            raise RuntimeError(f"Stages failed: {status}")
+        name = "pipeline_stream_seconds" if stream else "pipeline_seconds"
+        results[name] = metric(duration, "s", "lower", noise=0.5)
+    return results
+
+
+BENCHMARKS = {
+    "log": bench_log,
+    "spinner": bench_spinner,
+    "stages": bench_stages,
+    "stream": bench_stream,
+    "pipeline": bench_pipeline,
+}
+
+
+def compare(report: dict, baseline: dict, threshold: float) -> [str]:
+    """
+    Returns the names of the metrics of a report that regressed against the
+    baseline report. Raises ValueError if one of them ran the quick workloads
+    and the other didn't, most metrics depend on the workload size.
+    """
+    if report["quick"] != baseline["quick"]:
+        kind = "quick" if baseline["quick"] else "full"
+        raise ValueError(f"The baseline has results of the {kind} workloads")
+    regressions = []
+    for name, current in report["results"].items():
+        if name not in baseline["results"]:
+            continue
+        before, now = baseline["results"][name]["value"], current["value"]
+        if abs(now - before) <= current["noise"]:
+            continue
+        if current["better"] == "lower" and now > before * threshold:
+            regressions.append(name)
+        if current["better"] == "higher" and now < before / threshold:
+            regressions.append(name)
+    return regressions
+
+
+def make_parser() -> argparse.ArgumentParser:
+    my_parser = argparse.ArgumentParser(
+        prog="benchmarks/run.py",
+        description="Benchmark the build orchestration with stand-in tools",
+    )
+    my_parser.add_argument(
+        "--only",
+        type=build.comma_separated(list(BENCHMARKS)),
+        default=list(BENCHMARKS),
+        help=f"comma-separated benchmarks to run ({', '.join(BENCHMARKS)})",
+    )
+    my_parser.add_argument(
+        "--quick", action="store_true", help="smaller workloads, for a quick check"
+    )
+    my_parser.add_argument(
+        "--baseline",
+        type=pathlib.Path,
+        default=BASELINE_FILE,
+        help="results to compare with",
+    )
+    my_parser.add_argument(
+        "--save-baseline",
+        action="store_true",
+        help="store the results as the new baseline",
+    )
+    my_parser.add_argument(
+        "--threshold",
+        type=float,
+        default=1.25,
+        help="flag metrics that got worse by more than this factor",
+    )
+    return my_parser
+
+
+def main():
+    args = make_parser().parse_args()
+    scale = 0.25 if args.quick else 1
+    results = {}
+    for name in args.only:
+        print(f"Running {name}...", flush=True)
+        with tempfile.TemporaryDirectory(prefix=f"vgcn-bench-{name}-") as directory:
+            results.update(BENCHMARKS[name](pathlib.Path(directory), scale))
+
+    report = {
+        "started": datetime.datetime.now().isoformat(),
+        "quick": args.quick,
+        "results": results,
+    }
+    baseline = {}
+    regressions = []
+    if args.baseline.exists():
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        try:
+            regressions = compare(report, baseline, args.threshold)
+        except ValueError as e:
+            print(f"Not compared with {args.baseline}: {e}")
+            baseline = {}
+    for name, result in results.items():
+        line = f"  {name}: {result['value']:.3f} {result['unit']}"
+        if name in baseline.get("results", {}):
+            line += f" (baseline {baseline['results'][name]['value']:.3f})"
+        if name in regressions:
+            line = f"  REGRESSION{line}"
+        print(line)
+    RESULTS_DIR.mkdir(parents=True, exist_ok=True)
+    with open(RESULTS_DIR / "history.jsonl", "a") as f:
+        f.write(json.dumps(report) + "\n")
+    if args.save_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"Baseline saved to {args.baseline}")
+    elif not args.baseline.exists():
+        print(f"No baseline in {args.baseline}, save one with --save-baseline")
+    if regressions:
+        print(f"{len(regressions)} regressions with threshold {args.threshold}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
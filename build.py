@@ -12,13 +12,25 @@
 # to create a raw image in your openstack tenant
 # If you have trouble with the ansible provider on your setup, you can specify additional
 # --ansible-args="..." to e.g. solve the issues with scp on some distros
+# With --matrix, the template and delivery arguments take comma-separated lists and every
+# combination is built concurrently, each in its own directory below 'images'.
 
 
 import argparse
+import concurrent.futures
 import contextlib
 import datetime
+import fcntl
+import functools
+import hashlib
+import itertools
+import json
 import os
 import pathlib
+import queue
+import re
+import selectors
+import shlex
 import shutil
 import signal
 import subprocess
@@ -26,6 +38,11 @@ import sys
 import threading
 import time
 
+import build_report
+import delta_publish
+import iso_cache
+import package_proxy
+
 DIR_PATH = pathlib.Path(__file__).parent.absolute()
 
 STATIC_DIR = pathlib.Path("/data/dnb01/vgcn/").absolute()
@@ -34,22 +51,80 @@ SSH_HOST = "sn06.galaxyproject.eu"
 
 SSH_USER = "root"
 
+# Resources kept free for the build host itself when sizing build VMs
+HOST_RESERVED_CPUS = 2
+HOST_RESERVED_MEMORY = 4096  # MiB
+
+# Smallest VM a matrix build is allowed to run in
+MIN_VM_CPUS = 2
+MIN_VM_MEMORY = 4096  # MiB
+
+DELIVERIES = ["no", "kvm", "pxe", "cloud"]
+
+# Artifacts build.py can write next to the raw image: a qcow2 with compressed
+# clusters, a zstd-compressed raw image, and kernel and initramfs for network boot
+FORMATS = ["qcow2", "zstd", "netboot"]
+# Written for every build of a delivery, in addition to --formats
+DELIVERY_FORMATS = {"pxe": ["netboot"]}
+
+BASE_CACHE_DIR = DIR_PATH / "cache" / "base"
+
+# Size of the chunks the streaming pipeline reads and hands to its sinks
+STREAM_CHUNK_SIZE = 4 * 1024**2
+# Chunks buffered per sink, bounds the memory a slow sink can take up
+STREAM_QUEUE_DEPTH = 16
+ZERO_CHUNK = bytes(STREAM_CHUNK_SIZE)
+
+# Serializes writes to the console between the spinner and subprocess output
+OUTPUT_LOCK = threading.Lock()
+
+# Boot ISOs of the templates, keep in sync with the locals in templates/build.pkr.hcl
+ISO_URLS = {
+    "rockylinux-9-latest-x86_64": "https://download.rockylinux.org/pub/rocky/9/isos/x86_64/Rocky-9-latest-x86_64-boot.iso",
+    "rockylinux-10-latest-x86_64": "https://download.rockylinux.org/pub/rocky/10/isos/x86_64/Rocky-10-latest-x86_64-boot.iso",
+}
+
+
+def comma_separated(choices=None):
+    """
+    Returns an argparse type that splits a comma-separated argument into a list
+    and validates each item against choices.
+    """
+
+    def parse(value: str) -> [str]:
+        items = [x for x in value.split(",") if x]
+        if not items:
+            raise argparse.ArgumentTypeError("expected at least one value")
+        for item in items:
+            if choices and item not in choices:
+                raise argparse.ArgumentTypeError(
+                    f"invalid choice: '{item}' (choose from {', '.join(choices)})"
+                )
+        return items
+
+    return parse
+
 
 def make_parser() -> argparse.ArgumentParser:
     my_parser = argparse.ArgumentParser(
         prog="build",
         description="Build a VGCN image with Packer and the Ansible provisioner",
     )
+    playbooks = [
+        x.split(".", 1)[0]
+        for x in os.listdir("ansible")
+        # Hidden files are generated incremental meta-playbooks
+        if x.endswith(".yml") and not x.startswith(".")
+    ]
 
     my_parser.add_argument(
         "image",
-        help="image help",
+        type=comma_separated(),
+        help="The template to build, a comma-separated list with --matrix",
     )
     my_parser.add_argument(
         "provisioning",
-        choices=[
-            x.split(".", 1)[0] for x in os.listdir("ansible") if x.endswith(".yml")
-        ],
+        choices=playbooks,
         help="""
         The playbooks you want to provision.
         The playbook files are located in the ansible folder
@@ -59,8 +134,8 @@ def make_parser() -> argparse.ArgumentParser:
     )
     my_parser.add_argument(
         "delivery",
-        choices=["no","kvm", "pxe", "cloud"],
-        help="Delivery method playbook to run (kvm, pxe, or cloud)",
+        type=comma_separated(DELIVERIES),
+        help="Delivery method playbook to run (kvm, pxe, cloud or no), a comma-separated list with --matrix",
     )
     my_parser.add_argument(
         "--ansible-args",
@@ -97,10 +172,238 @@ def make_parser() -> argparse.ArgumentParser:
         action="store_true",
         help="Don't use the spinner, but still print logs.",
     )
+    my_parser.add_argument(
+        "--matrix",
+        action="store_true",
+        help="Build every template x provisioning x delivery combination concurrently, each in its own output directory",
+    )
+    my_parser.add_argument(
+        "--provisioning",
+        dest="provisioning_sets",
+        type=comma_separated(playbooks),
+        action="append",
+        default=[],
+        metavar="PLAYBOOK,...",
+        help="With --matrix, another comma-separated set of playbooks to build besides the positional provisioning, can be repeated",
+    )
+    my_parser.add_argument(
+        "--max-parallel",
+        type=int,
+        help="Upper limit for the number of concurrent matrix builds",
+    )
+    my_parser.add_argument(
+        "--base-cache",
+        action="store_true",
+        help="Start from a cached base layer (kickstart install and shell provisioner) and only run Ansible on top of it",
+    )
+    my_parser.add_argument(
+        "--stream",
+        action="store_true",
+        help="Stream the converted raw image straight into the OpenStack upload and the publish copy "
+        "instead of writing it to disk first (requires qemu-nbd and nbdcopy)",
+    )
+    my_parser.add_argument(
+        "--no-keep-raw",
+        dest="keep_raw",
+        action="store_false",
+        help="With --stream, don't write the raw image to disk if it is uploaded or published",
+    )
+    my_parser.add_argument(
+        "--delta",
+        action="store_true",
+        help="With --publish, only send the blocks that changed since the previously published image",
+    )
+    my_parser.add_argument(
+        "--publish-target",
+        metavar="[USER@]HOST:DIR",
+        help=f"Where --publish copies the image to (default: {SSH_USER}@{SSH_HOST}:{STATIC_DIR}), "
+        "a target without host is a local directory",
+    )
+    my_parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help="Start from the previous raw image of the same template and provisioning "
+        "and only run the playbooks affected by changes since its commit",
+    )
+    my_parser.add_argument(
+        "--full",
+        action="store_true",
+        help="Force a full rebuild, even with --incremental",
+    )
+    my_parser.add_argument(
+        "--block-manifest",
+        action="store_true",
+        help="Also record the SHA256 of every 1 MiB block of the raw image in checksums.json",
+    )
+    my_parser.add_argument(
+        "--shrink",
+        action="store_true",
+        help="Trim free space in the guest at the end of provisioning and sparsify the image before converting it",
+    )
+    my_parser.add_argument(
+        "--formats",
+        type=comma_separated(FORMATS),
+        default=[],
+        help="Comma-separated artifacts to write next to the raw image, in parallel with it: "
+        "compressed qcow2, zstd-compressed raw and netboot files (always written for pxe)",
+    )
+    my_parser.add_argument(
+        "--no-iso-cache",
+        dest="iso_cache",
+        action="store_false",
+        help="Let Packer download the boot ISO instead of using the verified copy in cache/iso",
+    )
+    my_parser.add_argument(
+        "--package-proxy",
+        action="store_true",
+        help="Run a caching HTTP proxy for the packages downloaded during the build, "
+        "shared by matrix builds and kept between builds",
+    )
+    my_parser.add_argument(
+        "--package-cache-size",
+        type=float,
+        default=20,
+        help="Size limit of the package cache in GiB (default: 20)",
+    )
+    my_parser.add_argument(
+        "--output-directory",
+        type=pathlib.Path,
+        help="Packer output directory, wiped before the build (default: images, "
+        "with --matrix every build gets its own directory below it)",
+    )
+    my_parser.add_argument(
+        "--cpus",
+        type=int,
+        help="CPUs per build VM (default: Packer default, or sized to the host with --matrix)",
+    )
+    my_parser.add_argument(
+        "--memory",
+        type=int,
+        help="Memory in MiB per build VM (default: Packer default, or sized to the host with --matrix)",
+    )
 
     return my_parser
 
 
+def parse_publish_target(target: str) -> (str, pathlib.PurePosixPath):
+    """
+    Splits a publish target [USER@]HOST:DIR into the ssh destination and the
+    directory. A target without a host is a local directory and the ssh
+    destination is None.
+    """
+    host, sep, directory = target.rpartition(":")
+    if not sep:
+        return None, pathlib.PurePosixPath(pathlib.Path(target).absolute())
+    return host, pathlib.PurePosixPath(directory)
+
+
+def changed_files(commit: str) -> [str]:
+    """
+    Returns the tracked files affecting the image content that changed since
+    commit, including uncommitted changes. Untracked files are left out, the
+    galaxy roles and collections get installed into the ansible directory.
+    """
+    return (
+        subprocess.check_output(
+            [
+                "git",
+                "diff",
+                "--name-only",
+                commit,
+                "--",
+                "ansible",
+                "templates",
+                "requirements.yml",
+                "scripts",
+            ],
+            cwd=DIR_PATH,
+        )
+        .decode()
+        .split()
+    )
+
+
+def affected_playbooks(changed: [str], playbooks: [str]) -> [str]:
+    """
+    Maps changed files to the playbooks among playbooks they affect.
+    Returns None if a change can't be attributed to playbooks,
+    e.g. a changed template or galaxy requirement, and needs a full rebuild.
+    """
+    ansible_dir = DIR_PATH / "ansible"
+    sources = {x: (ansible_dir / f"{x}.yml").read_text() for x in playbooks}
+    role_sources = {
+        role.name: "\n".join(
+            x.read_text(errors="replace") for x in role.rglob("*") if x.is_file()
+        )
+        for role in (ansible_dir / "roles").iterdir()
+        if role.is_dir()
+    }
+    affected = set()
+    for path in changed:
+        parts = pathlib.PurePosixPath(path).parts
+        name = parts[-1]
+        referencing = {x for x in playbooks if name in sources[x]}
+        if parts[0] == "scripts":
+            # Only scripts copied into the image by a playbook matter
+            affected.update(referencing)
+            continue
+        if parts[0] != "ansible" or len(parts) < 2:
+            return None
+        kind = parts[1]
+        if len(parts) == 2 and name.endswith(".yml"):
+            playbook = name[: -len(".yml")]
+            if not (ansible_dir / name).exists() or playbook.startswith("playbooks-"):
+                # Meta-playbooks and removed playbooks change what runs at all
+                return None
+            # Changes to playbooks this image isn't provisioned with don't matter
+            affected.update({playbook} & set(playbooks))
+        elif kind in ["group_vars", "secret_group_vars"] and len(parts) == 3:
+            # The build VM is in all provisioning groups, so the vars of any
+            # of them apply to every playbook; others may be vars_files anywhere
+            affected.update(playbooks)
+        elif kind == "roles" and len(parts) > 3:
+            role = parts[2]
+            referencing = {x for x in playbooks if role in sources[x]}
+            if any(role in text for x, text in role_sources.items() if x != role):
+                # Used by another role, which can't be followed here
+                return None
+            affected.update(referencing)
+        elif kind in ["files", "templates"] and referencing:
+            affected.update(referencing)
+        else:
+            return None
+    return [x for x in playbooks if x in affected]
+
+
+def host_resources() -> (int, int):
+    """
+    Returns the number of usable CPUs and the physical memory in MiB of the build host.
+    """
+    if hasattr(os, "sched_getaffinity"):
+        cpus = len(os.sched_getaffinity(0))
+    else:
+        cpus = os.cpu_count() or 1
+    memory = os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES") // 1024**2
+    return cpus, memory
+
+
+def plan_resources(builds: int, max_parallel: int = None, host: (int, int) = None):
+    """
+    Sizes the VMs of a build matrix, so the build host is saturated,
+    but not oversubscribed.
+    Returns a tuple of (concurrent builds, cpus per VM, memory per VM in MiB).
+    """
+    cpus, memory = host or host_resources()
+    cpus = max(cpus - HOST_RESERVED_CPUS, MIN_VM_CPUS)
+    memory = max(memory - HOST_RESERVED_MEMORY, MIN_VM_MEMORY)
+    parallel = min(builds, cpus // MIN_VM_CPUS, memory // MIN_VM_MEMORY)
+    if max_parallel:
+        parallel = min(parallel, max_parallel)
+    parallel = max(parallel, 1)
+    # Round memory down to full 256 MiB
+    return parallel, cpus // parallel, memory // parallel // 256 * 256
+
+
 # Spinner class from https://stackoverflow.com/a/39504463 by Victor Moyseenko, subject to CC BY-SA 4.0 license.
 class Spinner:
     """
@@ -125,30 +428,89 @@ class Spinner:
 
     def spinner_task(self):
         while self.busy:
-            sys.stdout.write(next(self.spinner_generator))
-            sys.stdout.flush()
+            # Step back right away, output written meanwhile overwrites the
+            # cursor instead of getting a character erased by a late backspace
+            with OUTPUT_LOCK:
+                sys.stdout.write(next(self.spinner_generator) + "\b")
+                sys.stdout.flush()
             time.sleep(self.delay)
-            sys.stdout.write("\b")
-            sys.stdout.flush()
 
     def __enter__(self):
         self.busy = True
-        threading.Thread(target=self.spinner_task).start()
+        self.thread = threading.Thread(target=self.spinner_task, daemon=True)
+        self.thread.start()
 
     def __exit__(self, exception, value, tb):
         self.busy = False
-        time.sleep(self.delay)
+        self.thread.join()
+        with OUTPUT_LOCK:
+            sys.stdout.write(" \b")
+            sys.stdout.flush()
         if exception is not None:
             return False
 
 
-def run_subprocess_with_spinner(name: str, proc: subprocess.Popen, show_spinner: bool):
+def stream_lines(proc: subprocess.Popen, on_line):
+    """
+    Reads stdout and stderr of a process concurrently until both are closed,
+    so a full pipe never blocks the process, and calls
+    on_line(stream, timestamp, line) for every line in the order they arrive.
+    stream is "stdout" or "stderr", a last line without newline is passed as is.
+    """
+    selector = selectors.DefaultSelector()
+    buffers = {}
+    for stream, pipe in [("stdout", proc.stdout), ("stderr", proc.stderr)]:
+        if pipe is not None:
+            selector.register(pipe, selectors.EVENT_READ, stream)
+            buffers[stream] = b""
+    while selector.get_map():
+        for key, _ in selector.select():
+            stream = key.data
+            # Read what is there instead of a full line, readline could block
+            data = os.read(key.fd, 65536)
+            timestamp = time.time()
+            if not data:
+                selector.unregister(key.fileobj)
+                if buffers[stream]:
+                    on_line(stream, timestamp, buffers[stream])
+                continue
+            *lines, buffers[stream] = (buffers[stream] + data).split(b"\n")
+            for line in lines:
+                on_line(stream, timestamp, line + b"\n")
+    selector.close()
+
+
+def run_subprocess_with_spinner(
+    name: str,
+    proc: subprocess.Popen,
+    show_spinner: bool,
+    prefix: str = None,
+    line_callbacks: list = None,
+):
     """
     Opens a subprocess and redirect stdout and stderr to Python.
     Shows a spinning Cursor while the command runs.
     Exits with returncode of subprocess if not equals 0.
+    If a prefix is given, every line is prefixed with it, so the output of
+    concurrent builds can be told apart.
+    Each callable in line_callbacks is called as callback(stream, timestamp, line)
+    for every line of output, e.g. to parse progress from it.
     """
 
+    # Signal handlers can only be installed from the main thread,
+    # matrix builds run in worker threads and leave SIGINT to the main thread
+    main_thread = threading.current_thread() is threading.main_thread()
+    head = f"[{prefix}] " if prefix else ""
+    outputs = {"stdout": sys.stdout.buffer, "stderr": sys.stderr.buffer}
+
+    def print_line(stream, timestamp, line):
+        # Print the line to the console
+        with OUTPUT_LOCK:
+            outputs[stream].write(head.encode() + line)
+            outputs[stream].flush()
+        for callback in line_callbacks or []:
+            callback(stream, timestamp, line)
+
     try:
         p = None
         # Register handler to pass keyboard interrupt to the subprocess
@@ -160,29 +522,375 @@ def run_subprocess_with_spinner(name: str, proc: subprocess.Popen, show_spinner:
             else:
                 raise KeyboardInterrupt.add_note()
 
-        signal.signal(signal.SIGINT, handler)
+        if main_thread:
+            signal.signal(signal.SIGINT, handler)
         context_mgr = Spinner() if show_spinner else contextlib.suppress()
         with context_mgr:
-            print(f"{name.rstrip('Ee')}ing...")
+            print(f"{head}{name.rstrip('Ee')}ing...")
             with proc as p:
-                for line in iter(p.stdout.readline, b""):
-                    # Print the line to the console
-                    sys.stdout.buffer.write(line)
-                for line in iter(p.stderr.readline, b""):
-                    # Print the error output to the console
-                    sys.stderr.buffer.write(line)
+                stream_lines(p, print_line)
                 returncode = p.wait()
                 if returncode:
                     print(
-                        f"===================== {name} FAILED ========================="
+                        f"{head}===================== {name} FAILED ========================="
                     )
                     sys.exit(returncode)
                 else:
                     print(
-                        f"===================== {name} SUCCESSFUL ====================="
+                        f"{head}===================== {name} SUCCESSFUL ====================="
                     )
     finally:
-        signal.signal(signal.SIGINT, signal.SIG_DFL)
+        if main_thread:
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+
+
+class FileSink:
+    """
+    Writes a stream to a local file. All-zero chunks are skipped by seeking,
+    so the file stays sparse. Only sinks with sparse set have a skip method.
+    """
+
+    sparse = True
+
+    def __init__(self, name: str, path: pathlib.Path):
+        self.name = name
+        self.path = path
+        self.file = None
+
+    def open(self):
+        self.file = open(self.path, "wb")
+
+    def write(self, chunk: bytes):
+        self.file.write(chunk)
+
+    def skip(self, length: int):
+        self.file.seek(length, os.SEEK_CUR)
+
+    def close(self) -> int:
+        # A trailing hole is only allocated by setting the file size
+        self.file.truncate()
+        self.file.close()
+        return 0
+
+    def abort(self):
+        self.file.close()
+        self.path.unlink()
+
+
+class ProcessSink:
+    """
+    Pipes a stream into the stdin of a command, e.g. an upload.
+    """
+
+    sparse = False
+
+    def __init__(self, name: str, command: str, env: dict = None):
+        self.name = name
+        self.command = command
+        self.env = env
+        self.proc = None
+
+    def open(self):
+        self.proc = subprocess.Popen(
+            self.command,
+            env=self.env,
+            stdin=subprocess.PIPE,
+            close_fds=True,
+            shell=True,
+            # The shell may not exec the command, abort() kills the group
+            start_new_session=True,
+        )
+
+    def write(self, chunk: bytes):
+        self.proc.stdin.write(chunk)
+
+    def close(self) -> int:
+        with contextlib.suppress(BrokenPipeError):
+            self.proc.stdin.close()
+        return self.proc.wait()
+
+    def abort(self):
+        # Killed before its input ends, so an upload isn't committed
+        with contextlib.suppress(ProcessLookupError):
+            os.killpg(self.proc.pid, signal.SIGKILL)
+        with contextlib.suppress(BrokenPipeError):
+            self.proc.stdin.close()
+        self.proc.wait()
+
+
+class ChecksumSink:
+    """
+    Hashes a stream, optionally also block by block for a block manifest.
+    Every checksum sink runs in its own thread, hashlib releases the GIL
+    for large chunks, so several algorithms are computed in parallel.
+    """
+
+    sparse = False
+
+    def __init__(self, algorithm: str, block_size: int = None):
+        self.name = f"{algorithm.upper()} CHECKSUM"
+        self.algorithm = algorithm
+        self.block_size = block_size
+        self.digest = hashlib.new(algorithm)
+        self.blocks = []
+        self.size = 0
+        self.pending = b""
+
+    def open(self):
+        pass
+
+    def write(self, chunk: bytes):
+        self.digest.update(chunk)
+        self.size += len(chunk)
+        if not self.block_size:
+            return
+        if self.pending:
+            chunk = self.pending + chunk
+        view = memoryview(chunk)
+        full = len(chunk) - len(chunk) % self.block_size
+        for offset in range(0, full, self.block_size):
+            block = view[offset : offset + self.block_size]
+            self.blocks.append(hashlib.new(self.algorithm, block).hexdigest())
+        self.pending = bytes(view[full:])
+
+    def close(self) -> int:
+        if self.pending:
+            self.blocks.append(hashlib.new(self.algorithm, self.pending).hexdigest())
+            self.pending = b""
+        return 0
+
+    def abort(self):
+        pass
+
+
+def disk_usage(path: pathlib.Path) -> dict:
+    """
+    Returns the apparent size and the allocated size of a (sparse) file in bytes.
+    """
+    stat = path.stat()
+    return {"size": stat.st_size, "allocated": stat.st_blocks * 512}
+
+
+def is_zero(chunk: bytes) -> bool:
+    # Comparing against a preallocated zero chunk stops at the first non-zero byte
+    if len(chunk) == len(ZERO_CHUNK):
+        return chunk == ZERO_CHUNK
+    return chunk.count(0) == len(chunk)
+
+
+def _drain_to_sink(sink, chunks: queue.Queue, errors: dict):
+    """
+    Writes the chunks of a queue to a sink until a None arrives.
+    After a failure, the queue is still drained, so the reader never blocks.
+    """
+    while True:
+        chunk = chunks.get()
+        if chunk is None:
+            break
+        if sink.name in errors:
+            continue
+        try:
+            if sink.sparse and is_zero(chunk):
+                sink.skip(len(chunk))
+            else:
+                sink.write(chunk)
+        except OSError as e:
+            errors[sink.name] = e
+
+
+def stream_to_sinks(
+    name: str, command: str, sinks: list, show_spinner: bool, prefix: str = None
+):
+    """
+    Runs command and fans its stdout out to several sinks, without writing it
+    to disk first. Every sink is fed from its own thread through a bounded queue,
+    so the sinks run concurrently and a slow one only holds back the others once
+    its queue is full. A failing sink is isolated from the others.
+    If the command fails, the sinks are aborted instead of closed, so none of
+    them takes the truncated stream for a complete one. If a sink can't be
+    opened, the ones opened before it are aborted and the error is raised.
+    Exits with returncode 1 if the command or any sink failed.
+    """
+    head = f"[{prefix}] " if prefix else ""
+    errors = {}
+    context_mgr = Spinner() if show_spinner else contextlib.suppress()
+    with context_mgr:
+        print(f"{head}{name.rstrip('Ee')}ing to {', '.join(x.name for x in sinks)}...")
+        workers = []
+        # Sinks to abort or close, also if a later one can't be opened
+        opened = []
+        returncode = None
+        try:
+            for sink in sinks:
+                sink.open()
+                opened.append(sink)
+                chunks = queue.Queue(maxsize=STREAM_QUEUE_DEPTH)
+                worker = threading.Thread(
+                    target=_drain_to_sink, args=(sink, chunks, errors), daemon=True
+                )
+                worker.start()
+                workers.append((chunks, worker))
+            with subprocess.Popen(
+                command, stdout=subprocess.PIPE, close_fds=True, shell=True
+            ) as p:
+                for chunk in iter(lambda: p.stdout.read(STREAM_CHUNK_SIZE), b""):
+                    for chunks, _ in workers:
+                        chunks.put(chunk)
+                returncode = p.wait()
+        finally:
+            # Also when interrupted or a sink couldn't be opened: the rest of
+            # the stream is skipped and the sinks are aborted instead of closed
+            if returncode != 0:
+                for sink in opened:
+                    errors.setdefault(sink.name, "aborted")
+            for chunks, worker in workers:
+                chunks.put(None)
+                worker.join()
+            for sink in opened:
+                if returncode != 0:
+                    sink.abort()
+                    continue
+                sink_returncode = sink.close()
+                if sink_returncode and sink.name not in errors:
+                    errors[sink.name] = f"exited with {sink_returncode}"
+        if returncode:
+            errors[name] = f"exited with {returncode}"
+        for failed, error in errors.items():
+            print(
+                f"{head}===================== {failed} FAILED: {error} ====================="
+            )
+        if errors:
+            sys.exit(1)
+        print(f"{head}===================== {name} SUCCESSFUL =====================")
+
+
+class StageGraph:
+    """
+    A small dependency graph of build stages. Stages run concurrently as soon
+    as all stages they depend on succeeded. A failing stage is isolated,
+    only the stages depending on it are skipped.
+    """
+
+    def __init__(self):
+        self.stages = {}
+
+    def add(self, name: str, function, after: [str] = ()):
+        for dependency in after:
+            if dependency not in self.stages:
+                raise ValueError(f"Unknown stage {dependency} for {name}")
+        self.stages[name] = (function, list(after))
+
+    def describe(self) -> str:
+        lines = []
+        for name, (_, after) in self.stages.items():
+            lines.append(f"{name} <- {', '.join(after)}" if after else name)
+        return "\n".join(lines)
+
+    def run(self) -> dict:
+        """
+        Runs all stages and returns their status: "ok", "failed" or "skipped".
+        """
+        status = {}
+        running = {}
+        with concurrent.futures.ThreadPoolExecutor(
+            max_workers=max(len(self.stages), 1)
+        ) as executor:
+            while len(status) < len(self.stages):
+                for name, (function, after) in self.stages.items():
+                    if name in status or name in running.values():
+                        continue
+                    if any(status.get(x) in ["failed", "skipped"] for x in after):
+                        status[name] = "skipped"
+                    elif all(status.get(x) == "ok" for x in after):
+                        running[executor.submit(function)] = name
+                if not running:
+                    continue
+                done, _ = concurrent.futures.wait(
+                    running, return_when=concurrent.futures.FIRST_COMPLETED
+                )
+                for future in done:
+                    name = running.pop(future)
+                    try:
+                        future.result()
+                    # Failed commands exit through sys.exit()
+                    except (Exception, SystemExit) as e:
+                        print(f"===================== {name} FAILED: {e!r}")
+                        status[name] = "failed"
+                    else:
+                        status[name] = "ok"
+        return status
+
+
+class BaseLayerCache:
+    """
+    Content-addressed store of base layers, i.e. qcow2 images right after the
+    kickstart install and the shell provisioner, before Ansible runs.
+    The key covers everything that goes into a base layer: the boot ISO checksum,
+    the kickstart file, the shell provisioner script and the disk size.
+    """
+
+    def __init__(self, directory: pathlib.Path = BASE_CACHE_DIR):
+        self.directory = directory
+
+    def key(self, template: str, disk_size: str) -> str:
+        """
+        Returns the cache key for a base layer, or None if the boot ISO checksum
+        can't be resolved, in which case the base layer can't be cached.
+        """
+        if template not in ISO_URLS:
+            return None
+        try:
+            iso_checksum = iso_cache.resolve_checksum(ISO_URLS[template])
+        except (OSError, ValueError) as e:
+            print(f"Base layer cache disabled, can't resolve ISO checksum: {e}")
+            return None
+        digest = hashlib.sha256()
+        for part in [
+            template.encode(),
+            iso_checksum.encode(),
+            (DIR_PATH / "templates" / f"{template}-anaconda-ks.cfg").read_bytes(),
+            (DIR_PATH / "templates" / "base-provisioning.sh").read_bytes(),
+            disk_size.encode(),
+        ]:
+            # Hash the parts separately, so their boundaries count
+            digest.update(hashlib.sha256(part).digest())
+        return digest.hexdigest()
+
+    def path(self, key: str) -> pathlib.Path:
+        return self.directory / f"{key}.qcow2"
+
+    def lookup(self, key: str) -> pathlib.Path:
+        """
+        Returns the path of the cached base layer or None on a cache miss.
+        """
+        path = self.path(key)
+        return path if key and path.exists() else None
+
+    @contextlib.contextmanager
+    def lock(self, key: str):
+        """
+        Serializes the creation of a base layer between concurrent builds,
+        in this or in other processes.
+        """
+        self.directory.mkdir(parents=True, exist_ok=True)
+        with open(self.directory / f"{key}.lock", "w") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def store(self, key: str, image: pathlib.Path, metadata: dict) -> pathlib.Path:
+        """
+        Moves a freshly built base layer into the cache.
+        """
+        path = self.path(key)
+        shutil.move(image, path)
+        # Layered images use the cached file as backing file, it must never change
+        path.chmod(0o444)
+        with open(self.directory / f"{key}.json", "w") as f:
+            json.dump(metadata, f, indent=2)
+        return path
 
 
 class Build:
@@ -197,6 +905,19 @@ class Build:
         pvt_key: pathlib.Path,
         ansible_args: str,
         show_spinner: bool,
+        output_directory: pathlib.Path = None,
+        cpus: int = None,
+        memory: int = None,
+        log_prefix: str = None,
+        base_cache: BaseLayerCache = None,
+        keep_raw: bool = True,
+        publish_target: str = None,
+        incremental: bool = False,
+        block_manifest: bool = False,
+        proxy: package_proxy.PackageProxy = None,
+        boot_isos: iso_cache.IsoCache = None,
+        shrink: bool = False,
+        formats: [str] = (),
     ):
         self.openstack = openstack
         self.template = template
@@ -213,24 +934,102 @@ class Build:
         self.image_name = self.assemble_name()
         self.image_path = DIR_PATH / f"{self.image_name}.raw"
         self.show_spinner = show_spinner
+        # Packer refuses to build into an existing directory, matrix builds
+        # therefore each get their own one, which is wiped before the build
+        self.output_directory = output_directory or DIR_PATH / "images"
+        self.cpus = cpus
+        self.memory = memory
+        self.log_prefix = log_prefix
+        self.base_cache = base_cache
+        self.base_image = None
+        self.incremental = incremental
+        # Whether the checksums include a hash of every block
+        self.block_manifest = block_manifest
+        # Checksums of the raw image by algorithm, set once it was converted
+        self.checksums = {}
+        # Generated meta-playbook of an incremental build
+        self.playbook = None
+        # Whether streaming also writes the raw image to image_path
+        self.keep_raw = keep_raw
+        # Caching proxy for downloads during the build, may be shared
+        self.proxy = proxy
+        self.boot_isos = boot_isos
+        # Local copy of the boot ISO in boot_isos, set while a build uses it
+        self.iso_path = None
+        self.shrink = shrink
+        # Artifacts next to the raw image, see FORMATS
+        self.formats = list(
+            dict.fromkeys([*formats, *DELIVERY_FORMATS.get(delivery, [])])
+        )
+        self.report = build_report.BuildReport(
+            self.image_name, self.template, self.provisioning
+        )
+        self.publish_host, self.publish_dir = parse_publish_target(
+            publish_target or f"{SSH_USER}@{SSH_HOST}:{STATIC_DIR}"
+        )
         if conda_env and conda_env.exists():
             self.qemu_path = f"{conda_env}/bin/qemu-img"
             self.openstack_path = f"{conda_env}/bin/openstack"
             self.packer_path = f"{conda_env}/bin/packer"
+            self.qemu_nbd_path = f"{conda_env}/bin/qemu-nbd"
         else:
             self.packer_path = shutil.which("packer")
             self.openstack_path = shutil.which("openstack")
             self.qemu_path = shutil.which("qemu-img")
+            self.qemu_nbd_path = shutil.which("qemu-nbd")
+        # Part of libnbd, not of the conda environment
+        self.nbdcopy_path = shutil.which("nbdcopy")
+        # Optional, the image is sparsified with qemu-img otherwise
+        self.virt_sparsify_path = shutil.which("virt-sparsify")
+        # Needed to log in to the previous image of an incremental build
+        self.virt_customize_path = shutil.which("virt-customize")
+        self.zstd_path = shutil.which("zstd")
 
     def dry_run(self):
+        plan = self.plan_incremental() if self.incremental else None
+        if plan:
+            previous, playbooks = plan
+            print(self.assemble_incremental_base_command(previous))
+            self.base_image = self.incremental_base_path()
+            self.playbook = self.incremental_playbook_path().name
+        elif self.base_cache:
+            key = self.base_cache_key()
+            if not key:
+                print("Base layer cache: DISABLED")
+            elif self.base_cache.lookup(key):
+                self.base_image = self.base_cache.lookup(key)
+                print(f"Base layer cache: HIT {self.base_image}")
+            else:
+                print(f"Base layer cache: MISS {key}")
+                print(self.assemble_packer_base_command())
+                # The build then starts from the base layer built above
+                self.base_image = self.base_cache.path(key)
         print(self.assemble_packer_envs())
         print(self.assemble_packer_build_command())
         print(self.image_name)
         print(self.assemble_convert_command())
+        self.dry_run_convert()
         if self.openstack:
             print(self.assemble_os_command())
         if self.pvt_key:
             print(self.assemble_scp_command())
+            print(self.assemble_rename_command())
+            print(self.assemble_ssh_command())
+
+    def dry_run_convert(self):
+        if self.can_stream():
+            print("Converting with checksums computed inline:")
+            print(self.assemble_stream_command())
+            for format in self.streamed_formats():
+                print(f"  -> {format}: {self.assemble_format_stream_command(format)}")
+
+    def dry_run_stream(self):
+        print("With --stream, instead of the conversion, upload and copy above:")
+        print(self.assemble_stream_command())
+        for sink in self.stream_sinks():
+            print(f"  -> {sink.name}: {getattr(sink, 'command', None) or sink.path}")
+        if self.pvt_key:
+            print(self.assemble_rename_command())
             print(self.assemble_ssh_command())
 
     def assemble_packer_init_command(self):
@@ -243,15 +1042,34 @@ class Build:
         )
 
     def assemble_packer_build_command(self):
+        # Start from the cached base layer if there is one
+        source = f"{self.template}-layered" if self.base_image else self.template
         return " ".join(
             [
                 f"{self.packer_path}",
                 f"build",
-                f"-only=qemu.{self.template}",
+                f"-only=qemu.{source}",
                 f"{DIR_PATH / 'templates'}",
             ]
         )
 
+    def assemble_packer_base_command(self):
+        return " ".join(
+            [
+                f"{self.packer_path}",
+                f"build",
+                f"-only=qemu.{self.template}-base",
+                f"{DIR_PATH / 'templates'}",
+            ]
+        )
+
+    def base_disk_size(self):
+        # Mirrors local.disk_size in templates/variables.pkr.hcl
+        return "50G" if "workers" in self.provisioning else "10G"
+
+    def base_cache_key(self):
+        return self.base_cache.key(self.template, self.base_disk_size())
+
     def assemble_convert_command(self):
         return " ".join(
             [
@@ -259,11 +1077,167 @@ class Build:
                 f"convert",
                 f"-O",
                 f"raw",
-                f"./images/{self.template}",
+                f"{self.output_directory / self.template}",
+                f"{self.image_path}",
+            ]
+        )
+
+    def assemble_sparsify_command(self):
+        image = self.output_directory / self.template
+        if self.virt_sparsify_path:
+            return " ".join([f"{self.virt_sparsify_path}", f"--in-place", f"{image}"])
+        # Rewriting the image drops clusters that are unallocated or all zeros
+        return " ".join(
+            [
+                f"{self.qemu_path}",
+                f"convert",
+                f"-O",
+                f"qcow2",
+                f"{image}",
+                f"{image}.sparse",
+                f"&&",
+                f"mv",
+                f"-f",
+                f"{image}.sparse",
+                f"{image}",
+            ]
+        )
+
+    def assemble_format_command(self, format: str):
+        if format == "qcow2":
+            return " ".join(
+                [
+                    f"{self.qemu_path}",
+                    f"convert",
+                    f"-c",
+                    f"-O",
+                    f"qcow2",
+                    f"{self.output_directory / self.template}",
+                    f"{self.artifact_path('qcow2')}",
+                ]
+            )
+        return " ".join(
+            [
+                f"{self.zstd_path}",
+                f"-T0",
+                f"-q",
+                f"-f",
                 f"{self.image_path}",
+                f"-o",
+                f"{self.artifact_path('zstd')}",
+            ]
+        )
+
+    def assemble_format_stream_command(self, format: str):
+        """
+        Returns the command writing an artifact from the raw image on stdin.
+        """
+        if format == "zstd":
+            return " ".join(
+                [
+                    f"{self.zstd_path}",
+                    f"-T0",
+                    f"-q",
+                    f"-f",
+                    f"-o",
+                    f"{self.artifact_path('zstd')}",
+                ]
+            )
+        # qemu-img convert can't read from a pipe. nbdcopy writes the stream
+        # into an NBD export of a new qcow2 image, through the compress filter,
+        # which compresses every cluster written. Zero chunks are skipped.
+        path = self.artifact_path("qcow2")
+        return " ".join(
+            [
+                f"{self.qemu_path}",
+                f"create",
+                f"-q",
+                f"-f",
+                f"qcow2",
+                f"{path}",
+                f"{self.virtual_size()}",
+                f"&&",
+                f"{self.nbdcopy_path}",
+                f"--synchronous",
+                f"--destination-is-zero",
+                f"--",
+                f"-",
+                f"[",
+                f"{self.qemu_nbd_path}",
+                f"--image-opts",
+                f"driver=compress,file.driver=qcow2,file.file.driver=file,file.file.filename={path}",
+                f"]",
+            ]
+        )
+
+    def assemble_stream_command(self):
+        # qemu-img convert can't write to a pipe, it writes at offsets.
+        # nbdcopy reads a read-only NBD export of the image and
+        # writes it to stdout in order.
+        return " ".join(
+            [
+                f"{self.nbdcopy_path}",
+                f"--synchronous",
+                f"--",
+                f"[",
+                f"{self.qemu_nbd_path}",
+                f"--read-only",
+                f"--format=qcow2",
+                f"{self.output_directory / self.template}",
+                f"]",
+                f"-",
+            ]
+        )
+
+    def assemble_os_stream_command(self):
+        # Without --file, the openstack client reads the image from stdin
+        return " ".join(
+            [
+                f"{self.openstack_path}",
+                f"image",
+                f"create",
+                f"--disk-format",
+                f"raw",
+                f"{self.image_name}",
             ]
         )
 
+    def assemble_ssh_stream_command(self):
+        # Written under a temporary name, see assemble_rename_command
+        command = f"cat > {self.publish_dir / self.image_name}.part"
+        if not self.publish_host:
+            return command
+        return " ".join(self.assemble_remote_prefix() + [shlex.quote(command)])
+
+    def assemble_rename_command(self):
+        """
+        Returns the command giving the published image its name once it was
+        transferred completely, like delta_publish.py does with its .part files.
+        """
+        path = self.publish_dir / self.image_name
+        return " ".join(
+            self.assemble_remote_prefix() + [f"mv", f"{path}.part", f"{path}"]
+        )
+
+    def assemble_remote_prefix(self):
+        """
+        Returns the command prefix to run a command on the publish target,
+        which is empty for a local target directory.
+        """
+        if not self.publish_host:
+            return []
+        return [f"ssh", f"-i", f"{self.pvt_key}", f"{self.publish_host}"]
+
+    def assemble_delta_command(self, command: str, *args):
+        # The receiving side of delta_publish.py is sent along as source,
+        # nothing needs to be installed on the target
+        agent = ["python3", "-c", pathlib.Path(delta_publish.__file__).read_text()]
+        agent += [command, str(self.publish_dir), self.image_name, *args]
+        if not self.publish_host:
+            return agent
+        # ssh passes the command to the remote shell as one string
+        return self.assemble_remote_prefix() + [shlex.join(agent)]
+
     def assemble_os_command(self):
         return " ".join(
             [
@@ -284,8 +1258,31 @@ class Build:
         )
         env["PKR_VAR_headless"] = "true"
         env["PKR_VAR_image_name"] = f"{self.image_name}"
+        env["PKR_VAR_output_directory"] = f"{self.output_directory}"
+        if self.cpus:
+            env["PKR_VAR_cpus"] = f"{self.cpus}"
+        if self.memory:
+            env["PKR_VAR_memory"] = f"{self.memory}"
         if self.ansible_args:
             env["PKR_VAR_ansible_extra_args"] = self.ansible_args
+        if self.base_image:
+            env["PKR_VAR_base_image"] = f"{self.base_image}"
+        if self.playbook:
+            env["PKR_VAR_playbook"] = self.playbook
+        if self.shrink:
+            env["PKR_VAR_shrink"] = "true"
+        if "netboot" in self.formats:
+            env["PKR_VAR_netboot"] = "true"
+        if self.iso_path:
+            env["PKR_VAR_iso_url"] = self.iso_path.as_uri()
+            env["PKR_VAR_iso_checksum"] = iso_cache.resolve_checksum(
+                ISO_URLS[self.template]
+            )
+        if self.proxy:
+            env["PKR_VAR_package_proxy"] = self.proxy.guest_url
+            # ansible-galaxy and the ISO download run on the build host
+            env["http_proxy"] = env["https_proxy"] = self.proxy.url
+            env["no_proxy"] = "localhost,127.0.0.1"
         return env
 
     def assemble_name(self):
@@ -314,26 +1311,31 @@ class Build:
         return "~".join(name)
 
     def assemble_scp_command(self):
+        if not self.publish_host:
+            return " ".join(
+                [
+                    f"cp",
+                    f"{self.image_path}",
+                    f"{self.publish_dir / self.image_name}.part",
+                ]
+            )
         return " ".join(
             [
                 f"scp",
                 f"-i",
                 f"{self.pvt_key}",
                 f"{self.image_path}",
-                f"{SSH_USER}@{SSH_HOST}:{STATIC_DIR / self.image_name}",
+                f"{self.publish_host}:{self.publish_dir / self.image_name}.part",
             ]
         )
 
     def assemble_ssh_command(self):
         return " ".join(
-            [
-                f"ssh",
-                f"-i",
-                f"{self.pvt_key}",
-                f"{SSH_USER}@{SSH_HOST}",
+            self.assemble_remote_prefix()
+            + [
                 f"chmod",
                 f"ugo+r",
-                f"{STATIC_DIR / self.image_name}",
+                f"{self.publish_dir / self.image_name}",
             ]
         )
 
@@ -357,51 +1359,531 @@ class Build:
 
         return f"{commit_time.date().strftime('%Y%m%d')}" f"~{seconds_since_midnight}"
 
+    def run_command(self, name: str, command: str, env: dict = None):
+        """
+        Runs a command of the build as a timed stage of the build report.
+        """
+        with self.report.stage(name) as stage:
+            run_subprocess_with_spinner(
+                name,
+                subprocess.Popen(
+                    command,
+                    env=env,
+                    stdout=subprocess.PIPE,
+                    stderr=subprocess.PIPE,
+                    close_fds=True,
+                    shell=True,
+                ),
+                show_spinner=self.show_spinner,
+                prefix=self.log_prefix,
+                line_callbacks=[stage.on_line],
+            )
+
+    def write_report(self):
+        """
+        Writes the build report next to the Packer manifest
+        and appends it to the build history.
+        """
+        path = self.output_directory / "build-report.json"
+        if self.proxy:
+            # Of all builds sharing the proxy so far
+            self.report.extra["package_cache"] = self.proxy.stats()
+        report = self.report.write(path)
+        head = f"[{self.log_prefix}] " if self.log_prefix else ""
+        print(f"{head}Build report written to {path}:")
+        for stage in report["stages"]:
+            print(
+                f"{head}  {stage['name']}: {stage['status']}, "
+                f"{build_report.format_seconds(stage['duration'])}"
+            )
+
     def build(self):
         self.clean_image_dir()
-        run_subprocess_with_spinner(
+        self.run_command(
             "INITIALIZE",
-            subprocess.Popen(
-                self.assemble_packer_init_command(),
-                env=self.assemble_packer_envs(),
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE,
-                close_fds=True,
-                shell=True,
-            ),
-            show_spinner=self.show_spinner,
-        )
-        run_subprocess_with_spinner(
-            "BUILD",
-            subprocess.Popen(
-                self.assemble_packer_build_command(),
-                env=self.assemble_packer_envs(),
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE,
-                close_fds=True,
-                shell=True,
-            ),
-            show_spinner=self.show_spinner,
+            self.assemble_packer_init_command(),
+            env=self.assemble_packer_envs(),
         )
+        plan = self.plan_incremental() if self.incremental else None
+        if plan:
+            previous, playbooks = plan
+            self.run_command(
+                "INCREMENTAL BASE", self.assemble_incremental_base_command(previous)
+            )
+            self.base_image = self.incremental_base_path()
+            self.playbook = self.write_incremental_playbook(playbooks)
+        elif self.base_cache:
+            self.base_image = self.ensure_base_layer()
+        try:
+            # Layered builds start from a disk image, not from the ISO
+            with self.local_iso() if not self.base_image else contextlib.nullcontext():
+                self.run_command(
+                    "BUILD",
+                    self.assemble_packer_build_command(),
+                    env=self.assemble_packer_envs(),
+                )
+        finally:
+            if self.playbook:
+                (DIR_PATH / "ansible" / self.playbook).unlink(missing_ok=True)
+
+    def find_previous_image(self):
+        """
+        Returns the newest raw image in the repository directory with the same
+        template and provisioning as this build, or None.
+        """
+        key = delta_publish.name_key(self.image_name)
+        candidates = []
+        for path in DIR_PATH.glob("vgcn~*.raw"):
+            name = path.name[: -len(".raw")]
+            other = delta_publish.name_key(name)
+            if name != self.image_name and other and other[0] == key[0]:
+                candidates.append((other[1], path))
+        return max(candidates)[1] if candidates else None
+
+    def plan_incremental(self):
+        """
+        Returns the previous image to start from and the playbooks to run on top
+        of it, or None if the image needs a full rebuild.
+        The previous image's commit is taken from its name.
+        """
+        previous = self.find_previous_image()
+        if not previous:
+            print("Incremental build: no previous image, full rebuild")
+            return None
+        if not self.virt_customize_path:
+            print("Incremental build: virt-customize (libguestfs) missing, full rebuild")
+            return None
+        commit = delta_publish.parse_name(previous.name[: -len(".raw")])["commit"]
+        try:
+            changed = changed_files(commit)
+        except subprocess.CalledProcessError:
+            print(f"Incremental build: unknown commit {commit}, full rebuild")
+            return None
+        playbooks = affected_playbooks(changed, self.provisioning)
+        if playbooks is None:
+            print(
+                f"Incremental build: changes since {commit} need a full rebuild: "
+                f"{', '.join(changed)}"
+            )
+            return None
+        print(
+            f"Incremental build on top of {previous.name}, "
+            f"{len(changed)} files changed since {commit}, "
+            f"running: {', '.join(playbooks) or 'nothing'}"
+        )
+        return previous, playbooks
+
+    def incremental_base_path(self):
+        """
+        The previous raw image converted to qcow2, the backing file of the
+        incremental build. Packer creates the overlay with the backing format
+        of its output format, qcow2, like for the cached base layers.
+        """
+        return self.output_directory.with_name(
+            f".{self.output_directory.name}-incremental-base.qcow2"
+        )
+
+    def assemble_incremental_base_command(self, previous: pathlib.Path):
+        """
+        Converts the previous image and unlocks the root account Packer logs
+        in with, the lock-root role locked it in the finished image.
+        templates/incremental-relock.sh locks it again at the end of the build.
+        """
+        return " ".join(
+            [
+                f"{self.qemu_path}",
+                f"convert",
+                f"-f",
+                f"raw",
+                f"-O",
+                f"qcow2",
+                f"{previous}",
+                f"{self.incremental_base_path()}",
+                f"&&",
+                f"{self.virt_customize_path}",
+                f"--no-network",
+                f"-a",
+                f"{self.incremental_base_path()}",
+                f"--run",
+                f"{DIR_PATH / 'templates' / 'incremental-unlock.sh'}",
+            ]
+        )
+
+    def incremental_playbook_path(self):
+        # Hidden, so it doesn't show up as provisioning choice
+        digest = hashlib.sha256(self.image_name.encode()).hexdigest()[:12]
+        return DIR_PATH / "ansible" / f".incremental-{digest}.yml"
+
+    def write_incremental_playbook(self, playbooks: [str]):
+        """
+        Writes a meta-playbook importing only the given playbooks, in the order of
+        the default meta-playbook. The Ansible groups stay the same, so the
+        variables are the same as in a full build.
+        Returns its name, relative to the ansible directory.
+        """
+        meta = (
+            "playbooks-internal.yml"
+            if "internal" in self.provisioning
+            else "playbooks-external.yml"
+        )
+        imports = re.findall(
+            r"import_playbook:\s*(\S+)\.yml", (DIR_PATH / "ansible" / meta).read_text()
+        )
+        lines = [f"# Generated by build.py for {self.image_name}", "---"]
+        selected = [x for x in imports if x in playbooks]
+        if selected:
+            lines += [f"- ansible.builtin.import_playbook: {x}.yml" for x in selected]
+        else:
+            lines += ["- hosts: all", "  gather_facts: false", "  tasks: []"]
+        path = self.incremental_playbook_path()
+        path.write_text("\n".join(lines) + "\n")
+        return path.name
+
+    def ensure_base_layer(self):
+        """
+        Returns the cached base layer for this build, building it on a cache miss.
+        Returns None if the base layer can't be cached.
+        """
+        key = self.base_cache_key()
+        if not key:
+            return None
+        with self.base_cache.lock(key):
+            base_image = self.base_cache.lookup(key)
+            if base_image:
+                print(f"Base layer cache: HIT {base_image}")
+                return base_image
+            print(f"Base layer cache: MISS {key}")
+            staging = self.base_cache.directory / f"{key}.build"
+            if staging.exists():
+                shutil.rmtree(staging)
+            with self.local_iso():
+                env = self.assemble_packer_envs()
+                env["PKR_VAR_output_directory"] = f"{staging}"
+                self.run_command(
+                    "BASE LAYER BUILD", self.assemble_packer_base_command(), env=env
+                )
+            base_image = self.base_cache.store(
+                key,
+                staging / self.template,
+                {
+                    "template": self.template,
+                    "iso_checksum": iso_cache.resolve_checksum(ISO_URLS[self.template]),
+                    "disk_size": self.base_disk_size(),
+                    "created": datetime.datetime.now().isoformat(),
+                },
+            )
+            shutil.rmtree(staging)
+            return base_image
+
+    @contextlib.contextmanager
+    def local_iso(self):
+        """
+        Points Packer at the verified boot ISO in the ISO cache, downloading it
+        on a cache miss, and keeps it from being pruned while the block runs.
+        Packer downloads the ISO itself if the cache is disabled or the
+        checksum can't be resolved.
+        """
+        if not self.boot_isos or self.template not in ISO_URLS:
+            yield
+            return
+        url = ISO_URLS[self.template]
+        try:
+            checksum = iso_cache.resolve_checksum(url)
+        except (OSError, ValueError) as e:
+            print(f"ISO cache disabled, can't resolve ISO checksum: {e}")
+            yield
+            return
+        with contextlib.ExitStack() as stack:
+            with self.report.stage("ISO DOWNLOAD"):
+                path = stack.enter_context(
+                    self.boot_isos.fetch(url, checksum, prefix=self.log_prefix)
+                )
+            self.iso_path = path
+            try:
+                yield
+            finally:
+                self.iso_path = None
+
+    def artifact_path(self, format: str) -> pathlib.Path:
+        suffixes = {"raw": ".raw", "qcow2": ".qcow2", "zstd": ".raw.zst"}
+        return DIR_PATH / f"{self.image_name}{suffixes[format]}"
+
+    def netboot_paths(self) -> dict:
+        """
+        Returns the netboot files downloaded from the build VM
+        and where they are delivered next to the raw image.
+        """
+        return {
+            self.output_directory / "netboot" / x: DIR_PATH / f"{self.image_name}.{x}"
+            for x in ["vmlinuz", "initramfs"]
+        }
+
+    def virtual_size(self) -> int:
+        info = subprocess.check_output(
+            [
+                f"{self.qemu_path}",
+                "info",
+                "--output=json",
+                f"{self.output_directory / self.template}",
+            ]
+        )
+        return json.loads(info)["virtual-size"]
+
+    def record_size(self, label: str, path: pathlib.Path):
+        """
+        Adds the size of an image to the build report and prints it.
+        """
+        usage = disk_usage(path)
+        self.report.extra.setdefault("sizes", {})[label] = usage
+        head = f"[{self.log_prefix}] " if self.log_prefix else ""
+        print(
+            f"{head}{label} size: {usage['size'] / 1024**2:.0f} MiB, "
+            f"{usage['allocated'] / 1024**2:.0f} MiB allocated"
+        )
+
+    def sparsify(self):
+        """
+        Drops the blocks trimmed in the guest from the Packer image, so neither
+        the conversion nor the compression has to read them.
+        """
+        image = self.output_directory / self.template
+        self.record_size("qcow2", image)
+        self.run_command("SPARSIFY", self.assemble_sparsify_command())
+        self.record_size("sparsified qcow2", image)
+
+    def streamed_formats(self, stream: bool = False) -> [str]:
+        """
+        Returns the artifacts written from the raw data while the conversion
+        streams it, instead of reading the image again.
+        """
+        if not (stream or self.can_stream()):
+            return []
+        return [x for x in self.formats if x in ["qcow2", "zstd"]]
+
+    def format_sinks(self, stream: bool = False):
+        return [
+            ProcessSink(f"{x.upper()} IMAGE", self.assemble_format_stream_command(x))
+            for x in self.streamed_formats(stream)
+        ]
+
+    def write_format(self, format: str):
+        self.run_command(
+            f"{format.upper()} IMAGE", self.assemble_format_command(format)
+        )
+        self.record_size(f"{format} image", self.artifact_path(format))
+
+    def collect_netboot(self):
+        """
+        Delivers the kernel and initramfs staged by templates/netboot-files.sh
+        next to the raw image, named like it.
+        """
+        with self.report.stage("NETBOOT"):
+            for source, target in self.netboot_paths().items():
+                if not source.exists():
+                    raise FileNotFoundError(
+                        f"{source.name} wasn't downloaded from the build VM"
+                    )
+                shutil.copyfile(source, target)
+                self.record_size(f"netboot {source.name}", target)
+
+    def can_stream(self):
+        return bool(self.nbdcopy_path and self.qemu_nbd_path)
+
+    def checksum_sinks(self):
+        sinks = [
+            ChecksumSink(
+                "sha256",
+                block_size=delta_publish.BLOCK_SIZE if self.block_manifest else None,
+            )
+        ]
+        if self.openstack:
+            # Glance records the MD5 and by default the SHA512 of uploads
+            sinks += [ChecksumSink("sha512"), ChecksumSink("md5")]
+        return sinks
+
+    def store_checksums(self, sinks: [ChecksumSink]):
+        """
+        Keeps the checksums for verifying the delivered copies and writes them
+        next to the Packer manifest and as .sha256 file next to the raw image.
+        """
+        self.checksums = {x.algorithm: x.digest.hexdigest() for x in sinks}
+        sha256 = sinks[0]
+        manifest = {
+            "image_name": self.image_name,
+            "size": sha256.size,
+            "checksums": self.checksums,
+        }
+        if self.block_manifest:
+            manifest["block_size"] = sha256.block_size
+            manifest["blocks"] = sha256.blocks
+        self.output_directory.mkdir(parents=True, exist_ok=True)
+        with open(self.output_directory / "checksums.json", "w") as f:
+            json.dump(manifest, f, indent=2)
+        if self.image_path.exists():
+            path = self.image_path.with_name(f"{self.image_path.name}.sha256")
+            path.write_text(f"{self.checksums['sha256']}  {self.image_path.name}\n")
+        print(f"SHA256 {self.checksums['sha256']}")
+
+    def record_sizes(self, streamed: [str] = ()):
+        """
+        Records the sizes of the raw image and the artifacts streamed with it.
+        """
+        if self.image_path.exists():
+            self.record_size("raw image", self.image_path)
+        for format in streamed:
+            self.record_size(f"{format} image", self.artifact_path(format))
 
     def convert(self):
-        run_subprocess_with_spinner(
-            name="CONVERT",
-            proc=subprocess.Popen(
-                self.assemble_convert_command(),
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE,
-                close_fds=True,
+        if not self.can_stream():
+            self.run_command("CONVERT", self.assemble_convert_command())
+            self.record_sizes()
+            return
+        # Convert through the streaming pipeline, so the checksums are computed
+        # while the raw image is written instead of in another pass over it
+        checksum_sinks = self.checksum_sinks()
+        with self.report.stage("CONVERT"):
+            stream_to_sinks(
+                "CONVERT",
+                self.assemble_stream_command(),
+                [
+                    FileSink("RAW IMAGE", self.image_path),
+                    *self.format_sinks(),
+                    *checksum_sinks,
+                ],
+                show_spinner=self.show_spinner,
+                prefix=self.log_prefix,
+            )
+        self.store_checksums(checksum_sinks)
+        self.record_sizes(self.streamed_formats())
+
+    def checksum(self):
+        """
+        Computes the checksums of the raw image, unless that already
+        happened during the conversion.
+        """
+        if self.checksums:
+            return
+        checksum_sinks = self.checksum_sinks()
+        with self.report.stage("CHECKSUM"):
+            with open(self.image_path, "rb") as f:
+                for chunk in iter(lambda: f.read(STREAM_CHUNK_SIZE), b""):
+                    for sink in checksum_sinks:
+                        sink.write(chunk)
+            for sink in checksum_sinks:
+                sink.close()
+        self.store_checksums(checksum_sinks)
+
+    def verify_upload(self):
+        """
+        Compares the checksum Glance computed for the uploaded image with ours.
+        """
+        with self.report.stage("VERIFY OPENSTACK IMAGE"):
+            image = json.loads(
+                subprocess.check_output(
+                    f"{self.openstack_path} image show -f json {self.image_name}",
+                    env=self.openstack_env(),
+                    shell=True,
+                )
+            )
+            algorithm = image.get("os_hash_algo")
+            if algorithm in self.checksums and image.get("os_hash_value"):
+                expected, actual = self.checksums[algorithm], image["os_hash_value"]
+            else:
+                algorithm = "md5"
+                expected, actual = self.checksums["md5"], image.get("checksum")
+            if expected != actual:
+                print(f"OpenStack image {algorithm} {actual} instead of {expected}")
+                sys.exit(1)
+        print(f"OpenStack image {algorithm} verified")
+
+    def verify_publish(self):
+        """
+        Compares the checksum of the published copy with ours.
+        """
+        with self.report.stage("VERIFY PUBLISHED IMAGE"):
+            output = subprocess.check_output(
+                " ".join(
+                    self.assemble_remote_prefix()
+                    + [f"sha256sum", f"{self.publish_dir / self.image_name}"]
+                ),
                 shell=True,
-            ),
-            show_spinner=self.show_spinner,
-        )
+            )
+            actual = output.decode().split()[0]
+            if actual != self.checksums["sha256"]:
+                print(
+                    f"Published image sha256 {actual} instead of {self.checksums['sha256']}"
+                )
+                sys.exit(1)
+        print("Published image sha256 verified")
+
+    def post_build_graph(self, stream: bool = False, delta: bool = False):
+        """
+        Returns the stages after the Packer build as graph. Everything after
+        the conversion only reads the raw image and runs concurrently.
+        """
+        graph = StageGraph()
+        first = []
+        if self.shrink:
+            graph.add("sparsify", self.sparsify)
+            first = ["sparsify"]
+        if stream:
+            # Streaming already feeds all targets and checksums at once
+            graph.add("convert", self.stream, after=first)
+            self.add_format_stages(graph, stream, first)
+            if self.openstack:
+                graph.add("verify-openstack", self.verify_upload, after=["convert"])
+            if self.pvt_key:
+                graph.add("verify-publish", self.verify_publish, after=["convert"])
+            return graph
+        graph.add("convert", self.convert, after=first)
+        self.add_format_stages(graph, stream, first)
+        graph.add("checksum", self.checksum, after=["convert"])
+        if self.openstack:
+            graph.add("openstack", self.upload_to_OS, after=["convert"])
+            graph.add(
+                "verify-openstack", self.verify_upload, after=["openstack", "checksum"]
+            )
+        if self.pvt_key:
+            graph.add(
+                "publish",
+                self.publish_delta if delta else self.publish,
+                after=["convert"],
+            )
+            if not delta:
+                # Delta publishing verifies the rebuilt image itself
+                graph.add(
+                    "verify-publish", self.verify_publish, after=["publish", "checksum"]
+                )
+        return graph
+
+    def add_format_stages(self, graph: StageGraph, stream: bool, first: [str]):
+        """
+        Adds a stage for every artifact that isn't written during the conversion.
+        """
+        streamed = self.streamed_formats(stream)
+        for format in self.formats:
+            if format == "netboot":
+                graph.add("netboot", self.collect_netboot, after=first)
+            elif format in streamed:
+                continue
+            elif format == "qcow2":
+                # Reads the Packer image, concurrently with the conversion
+                graph.add(
+                    "qcow2", functools.partial(self.write_format, format), after=first
+                )
+            else:
+                graph.add(
+                    format,
+                    functools.partial(self.write_format, format),
+                    after=["convert"],
+                )
 
     def clean_image_dir(self):
-        if (DIR_PATH / "images").exists():
-            shutil.rmtree(DIR_PATH / "images")
+        if self.output_directory.exists():
+            shutil.rmtree(self.output_directory)
+        self.incremental_base_path().unlink(missing_ok=True)
 
-    def upload_to_OS(self):
+    def openstack_env(self):
         # Checking this, because OS is failing silently
         env = os.environ.copy()
         if not (
@@ -411,67 +1893,277 @@ class Build:
         ):
             print("OS credentials missing in environment vars")
             sys.exit(1)
-        run_subprocess_with_spinner(
+        return env
+
+    def upload_to_OS(self):
+        self.run_command(
             "OPENSTACK IMAGE CREATE",
-            subprocess.Popen(
-                self.assemble_os_command(),
-                env=env,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE,
-                close_fds=True,
-                shell=True,
-            ),
-            show_spinner=self.show_spinner,
+            self.assemble_os_command(),
+            env=self.openstack_env(),
         )
 
+    def stream_sinks(self):
+        sinks = []
+        if self.openstack:
+            sinks.append(
+                ProcessSink(
+                    "OPENSTACK IMAGE CREATE",
+                    self.assemble_os_stream_command(),
+                    env=self.openstack_env(),
+                )
+            )
+        if self.pvt_key:
+            sinks.append(ProcessSink("PUBLISH", self.assemble_ssh_stream_command()))
+        if self.keep_raw or not sinks:
+            sinks.append(FileSink("RAW IMAGE", self.image_path))
+        return sinks
+
+    def stream(self):
+        """
+        Converts the image to raw and streams it to all delivery targets at once,
+        replacing convert(), upload_to_OS() and publish().
+        """
+        checksum_sinks = self.checksum_sinks()
+        with self.report.stage("CONVERT"):
+            stream_to_sinks(
+                "CONVERT",
+                self.assemble_stream_command(),
+                self.stream_sinks() + self.format_sinks(stream=True) + checksum_sinks,
+                show_spinner=self.show_spinner,
+                prefix=self.log_prefix,
+            )
+        self.store_checksums(checksum_sinks)
+        self.record_sizes(self.streamed_formats(stream=True))
+        if self.pvt_key:
+            self.run_command("RENAME", self.assemble_rename_command())
+            self.run_command("PERMISSION CHANGE", self.assemble_ssh_command())
+
     def publish(self):
-        run_subprocess_with_spinner(
-            "PUBLISH",
-            subprocess.Popen(
-                self.assemble_scp_command(),
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE,
-                close_fds=True,
-                shell=True,
-            ),
-            show_spinner=self.show_spinner,
-        )
-        run_subprocess_with_spinner(
-            "PERMISSION CHANGE",
-            subprocess.Popen(
-                self.assemble_ssh_command(),
+        self.run_command("PUBLISH", self.assemble_scp_command())
+        self.run_command("RENAME", self.assemble_rename_command())
+        self.run_command("PERMISSION CHANGE", self.assemble_ssh_command())
+
+    def publish_delta(self):
+        """
+        Publishes the image by sending only the blocks that differ from the
+        previously published image with the same template and provisioning.
+        The target rebuilds the full image and verifies its checksum.
+        """
+        head = f"[{self.log_prefix}] " if self.log_prefix else ""
+        with self.report.stage("DELTA PUBLISH"):
+            print(f"{head}Looking up previously published image...")
+            base = json.loads(
+                subprocess.check_output(self.assemble_delta_command("hashes"))
+            )
+            if base["previous"]:
+                print(f"{head}Sending delta against {base['previous']}")
+            else:
+                print(f"{head}No previously published image, sending everything")
+            with subprocess.Popen(
+                self.assemble_delta_command("apply", base["previous"] or "-"),
+                stdin=subprocess.PIPE,
                 stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE,
                 close_fds=True,
-                shell=True,
-            ),
-            show_spinner=self.show_spinner,
+            ) as p:
+                try:
+                    stats = delta_publish.write_delta(
+                        self.image_path, base["hashes"], p.stdin, base["block_size"]
+                    )
+                    p.stdin.close()
+                except BrokenPipeError:
+                    stats = None
+                result = p.stdout.read()
+                returncode = p.wait()
+            if (
+                returncode
+                or not stats
+                or json.loads(result)["sha256"] != stats["sha256"]
+            ):
+                print(
+                    f"{head}===================== DELTA PUBLISH FAILED ====================="
+                )
+                sys.exit(returncode or 1)
+            print(
+                f"{head}Sent {stats['sent']} of {stats['blocks']} blocks, "
+                f"{stats['copied']} unchanged, {stats['zero']} empty, sha256 {stats['sha256']}"
+            )
+            print(
+                f"{head}===================== DELTA PUBLISH SUCCESSFUL ====================="
+            )
+        self.run_command("PERMISSION CHANGE", self.assemble_ssh_command())
+
+
+def start_package_proxy(args) -> package_proxy.PackageProxy:
+    """
+    Starts the caching proxy requested with --package-proxy, or returns None.
+    """
+    if not args.package_proxy or args.dry_run:
+        return None
+    proxy = package_proxy.PackageProxy(
+        max_size=int(args.package_cache_size * 1024**3)
+    ).start()
+    print(f"Package proxy listening on {proxy.url} ({proxy.guest_url} in the VM)")
+    return proxy
+
+
+def matrix_builds(args, proxy: package_proxy.PackageProxy = None) -> (int, [Build]):
+    """
+    Creates one Build per template x provisioning x delivery combination,
+    with VMs sized to share the build host.
+    Returns the number of concurrent builds and the builds.
+    """
+    provisioning_sets = list(
+        dict.fromkeys(map(tuple, [args.provisioning, *args.provisioning_sets]))
+    )
+    combinations = list(
+        dict.fromkeys(itertools.product(args.image, provisioning_sets, args.delivery))
+    )
+    parallel, cpus, memory = plan_resources(len(combinations), args.max_parallel)
+    builds = []
+    for template, provisioning, delivery in combinations:
+        log_prefix = f"{template}/{delivery}"
+        if len(provisioning_sets) > 1:
+            log_prefix = f"{template}/{'+'.join(provisioning)}/{delivery}"
+        build = Build(
+            openstack=args.openstack,
+            template=template,
+            conda_env=args.conda_env,
+            # Build modifies the list, so every build gets its own copy
+            provisioning=list(provisioning),
+            delivery=delivery,
+            comment=args.comment,
+            ansible_args=args.ansible_args,
+            pvt_key=args.publish,
+            show_spinner=False,
+            cpus=args.cpus or cpus,
+            memory=args.memory or memory,
+            log_prefix=log_prefix,
+            base_cache=BaseLayerCache() if args.base_cache else None,
+            keep_raw=args.keep_raw,
+            publish_target=args.publish_target,
+            incremental=args.incremental and not args.full,
+            block_manifest=args.block_manifest,
+            proxy=proxy,
+            boot_isos=iso_cache.IsoCache() if args.iso_cache else None,
+            shrink=args.shrink,
+            formats=args.formats,
         )
+        build.output_directory = (
+            args.output_directory or DIR_PATH / "images"
+        ) / build.image_name
+        builds.append(build)
+    return parallel, builds
 
 
-def main():
-    my_parser = make_parser()
-    args = my_parser.parse_args()
+def run_pipeline(image: Build, args):
+    try:
+        image.build()
+        status = image.post_build_graph(stream=args.stream, delta=args.delta).run()
+    finally:
+        image.write_report()
+    failed = [name for name, result in status.items() if result != "ok"]
+    if failed:
+        print(f"Post-build stages not successful: {', '.join(failed)}")
+        sys.exit(1)
+
+
+def run_matrix(args, proxy: package_proxy.PackageProxy = None):
+    parallel, builds = matrix_builds(args, proxy)
+    print(
+        f"Building {len(builds)} images, {parallel} at a time "
+        f"with {builds[0].cpus} CPUs and {builds[0].memory} MiB each"
+    )
+    if args.dry_run:
+        for build in builds:
+            print(f"===================== {build.log_prefix} =====================")
+            build.dry_run()
+            if args.stream:
+                build.dry_run_stream()
+            print("Post-build stages:")
+            print(
+                build.post_build_graph(stream=args.stream, delta=args.delta).describe()
+            )
+        return
+    failed = []
+    with concurrent.futures.ThreadPoolExecutor(max_workers=parallel) as executor:
+        futures = {
+            executor.submit(run_pipeline, build, args): build for build in builds
+        }
+        for future in concurrent.futures.as_completed(futures):
+            build = futures[future]
+            try:
+                future.result()
+            except (Exception, SystemExit) as e:
+                print(f"[{build.log_prefix}] failed: {e!r}")
+                failed.append(build)
+            else:
+                print(f"[{build.log_prefix}] done: {build.image_path}")
+    if failed:
+        print(f"{len(failed)} of {len(builds)} matrix builds failed:")
+        for build in failed:
+            print(f"  {build.log_prefix}")
+        sys.exit(1)
+
+
+def run_single(args, proxy: package_proxy.PackageProxy = None):
     image = Build(
         openstack=args.openstack,
-        template=args.image,
+        template=args.image[0],
         conda_env=args.conda_env,
         provisioning=args.provisioning,
-        delivery=args.delivery,
+        delivery=args.delivery[0],
         comment=args.comment,
         ansible_args=args.ansible_args,
         pvt_key=args.publish,
         show_spinner=not args.quiet,
+        output_directory=args.output_directory,
+        cpus=args.cpus,
+        memory=args.memory,
+        base_cache=BaseLayerCache() if args.base_cache else None,
+        keep_raw=args.keep_raw,
+        publish_target=args.publish_target,
+        incremental=args.incremental and not args.full,
+        block_manifest=args.block_manifest,
+        proxy=proxy,
+        boot_isos=iso_cache.IsoCache() if args.iso_cache else None,
+        shrink=args.shrink,
+        formats=args.formats,
     )
     if args.dry_run:
         image.dry_run()
+        if args.stream:
+            image.dry_run_stream()
+        print("Post-build stages:")
+        print(image.post_build_graph(stream=args.stream, delta=args.delta).describe())
     else:
-        image.build()
-        image.convert()
-        if args.openstack:
-            image.upload_to_OS()
-        if args.publish:
-            image.publish()
+        run_pipeline(image, args)
+
+
+def main():
+    my_parser = make_parser()
+    args = my_parser.parse_args()
+    if args.delta and args.stream:
+        my_parser.error(
+            "--delta needs the raw image on disk and can't be combined with --stream"
+        )
+    if "zstd" in args.formats and not shutil.which("zstd"):
+        my_parser.error("--formats zstd needs zstd to be installed")
+    if not args.matrix and (
+        len(args.image) > 1 or len(args.delivery) > 1 or args.provisioning_sets
+    ):
+        my_parser.error(
+            "multiple templates, provisioning sets or deliveries require --matrix"
+        )
+    proxy = start_package_proxy(args)
+    try:
+        if args.matrix:
+            run_matrix(args, proxy)
+        else:
+            run_single(args, proxy)
+    finally:
+        if proxy:
+            print(proxy.summary())
+            proxy.stop()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,327 @@
+#!/usr/bin/env python
+# Timing reports of VGCN image builds.
+# build.py times every stage of a build (Packer steps, Ansible plays and tasks,
+# conversion, upload, publishing), writes the report as JSON next to the Packer
+# manifest and appends it to a local history.
+# Run this file to look at reports or to compare a build against previous ones:
+#   python build_report.py show [REPORT]
+#   python build_report.py compare [REPORT] [--last 10] [--threshold 1.25]
+# Without REPORT, the newest build in the history is used.
+
+import argparse
+import contextlib
+import datetime
+import fcntl
+import json
+import pathlib
+import re
+import statistics
+import sys
+import time
+
+DIR_PATH = pathlib.Path(__file__).parent.absolute()
+
+HISTORY_FILE = DIR_PATH / "reports" / "history.jsonl"
+
+# Packer announces its steps as "==> source: message",
+# provisioner output is indented as "    source: output"
+PACKER_STEP = re.compile(rb"^==> (?:[\w.-]+: )?(?P<name>.*?)\s*$")
+PROVISIONER_OUTPUT = re.compile(rb"^    [\w.-]+: (?P<line>.*?)\s*$")
+ANSIBLE_PLAY = re.compile(rb"^PLAY \[(?P<name>.*)\] \**$")
+ANSIBLE_TASK = re.compile(rb"^(?:TASK|RUNNING HANDLER) \[(?P<name>.*)\] \**$")
+ANSIBLE_RECAP = re.compile(rb"^PLAY RECAP \**$")
+# Packer colors its output if it thinks it writes to a terminal
+ANSI_ESCAPE = re.compile(rb"\x1b\[[0-9;]*m")
+
+
+class Stage:
+    """
+    Times one stage of a build, e.g. a command run by build.py.
+    Lines of Packer output passed to on_line are split into steps:
+    Packer steps, and Ansible plays and tasks within the provisioner step.
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self.start = time.time()
+        self.duration = None
+        self.status = "running"
+        self.steps = []
+        # The currently open step of each kind
+        self.current = {}
+
+    def open_step(self, kind: str, name: str, timestamp: float):
+        self.close_step(kind, timestamp)
+        step = {"kind": kind, "name": name, "start": timestamp, "duration": None}
+        self.steps.append(step)
+        self.current[kind] = step
+
+    def close_step(self, kind: str, timestamp: float):
+        step = self.current.pop(kind, None)
+        if step:
+            step["duration"] = round(timestamp - step["start"], 3)
+
+    def on_line(self, stream: str, timestamp: float, line: bytes):
+        line = ANSI_ESCAPE.sub(b"", line)
+        match = PACKER_STEP.match(line)
+        if match:
+            # A new Packer step ends whatever Ansible was doing
+            for kind in ["task", "play"]:
+                self.close_step(kind, timestamp)
+            self.open_step("packer", match["name"].decode(errors="replace"), timestamp)
+            return
+        match = PROVISIONER_OUTPUT.match(line)
+        if not match:
+            return
+        line = match["line"]
+        match = ANSIBLE_PLAY.match(line)
+        if match:
+            self.close_step("task", timestamp)
+            self.open_step("play", match["name"].decode(errors="replace"), timestamp)
+        match = ANSIBLE_TASK.match(line)
+        if match:
+            self.open_step("task", match["name"].decode(errors="replace"), timestamp)
+        if ANSIBLE_RECAP.match(line):
+            for kind in ["task", "play"]:
+                self.close_step(kind, timestamp)
+
+    def finish(self, status: str):
+        end = time.time()
+        for kind in list(self.current):
+            self.close_step(kind, end)
+        self.duration = round(end - self.start, 3)
+        self.status = status
+
+    def as_dict(self):
+        return {
+            "name": self.name,
+            "start": self.start,
+            "duration": self.duration,
+            "status": self.status,
+            "steps": self.steps,
+        }
+
+
+class BuildReport:
+    """
+    Collects the stages of a build and stores them as a JSON report.
+    """
+
+    def __init__(self, image_name: str, template: str, provisioning: [str]):
+        self.image_name = image_name
+        self.template = template
+        self.provisioning = provisioning
+        self.start = time.time()
+        self.stages = []
+        # Further information about the build, e.g. package cache statistics
+        self.extra = {}
+
+    @contextlib.contextmanager
+    def stage(self, name: str):
+        stage = Stage(name)
+        self.stages.append(stage)
+        try:
+            yield stage
+        except BaseException:
+            # Also covers the sys.exit() of a failed command
+            stage.finish("failed")
+            raise
+        else:
+            stage.finish("ok")
+
+    def as_dict(self):
+        end = time.time()
+        return {
+            "image_name": self.image_name,
+            "template": self.template,
+            "provisioning": self.provisioning,
+            "started": datetime.datetime.fromtimestamp(self.start).isoformat(),
+            "duration": round(end - self.start, 3),
+            "status": (
+                "ok" if all(x.status == "ok" for x in self.stages) else "failed"
+            ),
+            "stages": [x.as_dict() for x in self.stages],
+            **self.extra,
+        }
+
+    def write(self, path: pathlib.Path, history: pathlib.Path = HISTORY_FILE):
+        """
+        Writes the report to path and appends it to the history.
+        """
+        report = self.as_dict()
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with open(path, "w") as f:
+            json.dump(report, f, indent=2)
+        history.parent.mkdir(parents=True, exist_ok=True)
+        with open(history, "a") as f:
+            # Matrix builds finish concurrently
+            fcntl.flock(f, fcntl.LOCK_EX)
+            f.write(json.dumps(report) + "\n")
+        return report
+
+
+def load_history(history: pathlib.Path = HISTORY_FILE) -> [dict]:
+    if not history.exists():
+        return []
+    with open(history) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def durations(report: dict) -> dict:
+    """
+    Flattens a report into {"STAGE": seconds, "STAGE > kind: step": seconds}.
+    Steps of the same name are summed up, e.g. tasks running in several plays.
+    """
+    result = {}
+    for stage in report["stages"]:
+        if stage["duration"] is None:
+            continue
+        result[stage["name"]] = stage["duration"]
+        for step in stage["steps"]:
+            if step["duration"] is None:
+                continue
+            key = f"{stage['name']} > {step['kind']}: {step['name']}"
+            result[key] = result.get(key, 0) + step["duration"]
+    return result
+
+
+def same_image(a: dict, b: dict) -> bool:
+    return a["template"] == b["template"] and a["provisioning"] == b["provisioning"]
+
+
+def compare(
+    report: dict,
+    previous: [dict],
+    threshold: float = 1.25,
+    min_seconds: float = 30,
+) -> [dict]:
+    """
+    Compares every stage and step of report with its median duration in previous
+    successful builds of the same image. Returns the comparisons, with
+    "regression" set where the duration exceeds threshold times the median by
+    at least min_seconds.
+    """
+    baseline = {}
+    for other in previous:
+        if other["status"] != "ok" or not same_image(report, other):
+            continue
+        for key, duration in durations(other).items():
+            baseline.setdefault(key, []).append(duration)
+    result = []
+    for key, duration in durations(report).items():
+        if key not in baseline:
+            continue
+        median = statistics.median(baseline[key])
+        result.append(
+            {
+                "name": key,
+                "duration": duration,
+                "median": median,
+                "builds": len(baseline[key]),
+                "regression": duration > median * threshold
+                and duration - median >= min_seconds,
+            }
+        )
+    return result
+
+
+def format_seconds(seconds: float) -> str:
+    return str(datetime.timedelta(seconds=round(seconds)))
+
+
+def make_parser() -> argparse.ArgumentParser:
+    my_parser = argparse.ArgumentParser(
+        prog="build_report",
+        description="Show and compare timing reports of VGCN image builds",
+    )
+    my_parser.add_argument(
+        "--history",
+        type=pathlib.Path,
+        default=HISTORY_FILE,
+        help="The history of build reports",
+    )
+    subparsers = my_parser.add_subparsers(dest="command", required=True)
+    show = subparsers.add_parser("show", help="Print the stages of a build")
+    show.add_argument("report", type=pathlib.Path, nargs="?")
+    show.add_argument(
+        "--steps", action="store_true", help="also print Packer and Ansible steps"
+    )
+    compare_parser = subparsers.add_parser(
+        "compare", help="Compare a build with previous builds of the same image"
+    )
+    compare_parser.add_argument("report", type=pathlib.Path, nargs="?")
+    compare_parser.add_argument(
+        "--last",
+        type=int,
+        default=10,
+        help="number of previous builds to compare with",
+    )
+    compare_parser.add_argument(
+        "--threshold",
+        type=float,
+        default=1.25,
+        help="flag stages taking longer than this factor times their median",
+    )
+    compare_parser.add_argument(
+        "--min-seconds",
+        type=float,
+        default=30,
+        help="ignore slowdowns shorter than this",
+    )
+    compare_parser.add_argument(
+        "--all", action="store_true", help="also print stages without regression"
+    )
+    return my_parser
+
+
+def main():
+    args = make_parser().parse_args()
+    history = load_history(args.history)
+    if args.report:
+        with open(args.report) as f:
+            report = json.load(f)
+    elif history:
+        report = history[-1]
+    else:
+        print(f"No builds in {args.history}")
+        sys.exit(1)
+    print(
+        f"{report['image_name']}: {report['status']}, {format_seconds(report['duration'])}"
+    )
+
+    if args.command == "show":
+        for stage in report["stages"]:
+            print(
+                f"  {stage['name']}: {stage['status']}, {format_seconds(stage['duration'] or 0)}"
+            )
+            if args.steps:
+                for step in stage["steps"]:
+                    print(
+                        f"    {step['kind']}: {step['name']} {format_seconds(step['duration'] or 0)}"
+                    )
+        return
+
+    # Only builds before the compared one count as previous
+    previous = [x for x in history if x["started"] < report["started"]]
+    previous = [x for x in previous if same_image(report, x)][-args.last :]
+    if not previous:
+        print("No previous builds of the same image to compare with")
+        return
+    comparisons = compare(report, previous, args.threshold, args.min_seconds)
+    regressions = [x for x in comparisons if x["regression"]]
+    for comparison in comparisons:
+        if args.all or comparison["regression"]:
+            print(
+                f"  {'REGRESSION ' if comparison['regression'] else ''}{comparison['name']}: "
+                f"{format_seconds(comparison['duration'])} "
+                f"(median {format_seconds(comparison['median'])} of {comparison['builds']} builds)"
+            )
+    print(
+        f"{len(regressions)} regressions compared with {len(previous)} previous builds"
+    )
+    if regressions:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,552 @@
+#!/usr/bin/env python
+# Long-running build service for VGCN images.
+# Build requests take the arguments of build.py, are queued and run by a bounded
+# pool of workers, each build as a build.py process of its own. Requests for an
+# image that is already queued or being built, i.e. the same assemble_name()
+# components except for the timestamp, are coalesced into the existing build if
+# they are built and delivered the same way; otherwise they are queued and
+# run after the build of the same image name, as both write the same files.
+# The API is plain HTTP on a local TCP port or a Unix socket:
+#   POST   /builds           {"args": [build.py arguments]}, returns the build
+#   GET    /builds           all builds
+#   GET    /builds/ID        status of a build
+#   GET    /builds/ID/log    log of a build, streamed until it finishes
+#   DELETE /builds/ID        cancel a build
+# Run this file to start the server or to talk to it:
+#   python build_server.py serve [--workers 2] [--socket PATH | --listen HOST:PORT]
+#   python build_server.py submit [--follow] -- rockylinux-9-latest-x86_64 generic kvm
+#   python build_server.py status [ID]
+#   python build_server.py log ID
+#   python build_server.py cancel ID
+
+import argparse
+import collections
+import contextlib
+import http.client
+import http.server
+import io
+import itertools
+import json
+import pathlib
+import queue
+import signal
+import socket
+import socketserver
+import subprocess
+import sys
+import threading
+import time
+import urllib.parse
+
+import build
+
+DIR_PATH = pathlib.Path(__file__).parent.absolute()
+
+STATE_DIR = DIR_PATH / "reports" / "server"
+SOCKET_PATH = STATE_DIR / "build-server.sock"
+
+# Arguments that make no sense for a queued build
+REJECTED_ARGS = {"dry_run": "--dry-run", "matrix": "--matrix"}
+
+# Arguments that don't change what a build produces or where it delivers it,
+# requests differing only in them are coalesced
+SCHEDULING_ARGS = {
+    "quiet",
+    "max_parallel",
+    "conda_env",
+    "output_directory",
+    "cpus",
+    "memory",
+    "iso_cache",
+    "package_proxy",
+    "package_cache_size",
+}
+
+ACTIVE = {"queued", "running"}
+
+LOG_CHUNK_SIZE = 64 * 1024
+
+
+def image_key(image_name: str) -> str:
+    """
+    Returns what identifies the image of a build: the components of its
+    assemble_name() without the date and seconds of the timestamp.
+    """
+    parts = image_name.split("~")
+    return "~".join(parts[:3] + parts[5:])
+
+
+def build_options(parsed: argparse.Namespace) -> dict:
+    """
+    Returns the arguments of a build that must match for coalescing, e.g.
+    --openstack, --publish and --formats.
+    """
+    return {
+        dest: value
+        for dest, value in vars(parsed).items()
+        if dest not in SCHEDULING_ARGS
+    }
+
+
+def parse_build_args(args: [str]) -> argparse.Namespace:
+    """
+    Validates build.py arguments with its own parser.
+    Raises ValueError with the parser's message if they are invalid.
+    """
+    stderr = io.StringIO()
+    try:
+        with contextlib.redirect_stderr(stderr):
+            parsed = build.make_parser().parse_args(args)
+    except SystemExit:
+        raise ValueError(stderr.getvalue().strip().splitlines()[-1])
+    for dest, flag in REJECTED_ARGS.items():
+        if getattr(parsed, dest):
+            raise ValueError(f"{flag} can't be used with the build server")
+    if len(parsed.image) > 1 or len(parsed.delivery) > 1 or parsed.provisioning_sets:
+        raise ValueError(
+            "multiple templates, provisioning sets or deliveries require --matrix"
+        )
+    return parsed
+
+
+class Job:
+    """
+    A queued or running build.py process and its log.
+    """
+
+    def __init__(self, job_id: str, args: [str], name: str):
+        self.id = job_id
+        self.args = args
+        self.name = name
+        self.key = image_key(name)
+        self.options = build_options(parse_build_args(args))
+        self.state = "queued"
+        self.requests = 1
+        self.created = time.time()
+        self.started = None
+        self.finished = None
+        self.returncode = None
+        self.process = None
+        self.cancelled = False
+        self.log_path = STATE_DIR / f"{job_id}.log"
+        # Notified whenever the log grows or the state changes
+        self.changed = threading.Condition()
+
+    def set_state(self, state: str):
+        with self.changed:
+            self.state = state
+            if state == "running":
+                self.started = time.time()
+            elif state not in ACTIVE:
+                self.finished = time.time()
+            self.changed.notify_all()
+
+    def as_dict(self):
+        return {
+            "id": self.id,
+            "image_name": self.name,
+            "key": self.key,
+            "args": self.args,
+            "state": self.state,
+            "requests": self.requests,
+            "created": self.created,
+            "started": self.started,
+            "finished": self.finished,
+            "returncode": self.returncode,
+            "log": str(self.log_path),
+        }
+
+
+class BuildQueue:
+    """
+    Runs builds on a bounded pool of worker threads, coalescing requests for
+    images that are already queued or being built.
+    """
+
+    def __init__(self, workers: int):
+        self.workers = workers
+        # VMs are sized so the workers share the build host, like a matrix build
+        _, self.cpus, self.memory = build.plan_resources(workers, workers)
+        self.jobs = {}
+        self.lock = threading.Lock()
+        self.queue = queue.Queue()
+        # Image names being built, and the jobs waiting for them
+        self.running = set()
+        self.waiting = collections.defaultdict(list)
+        STATE_DIR.mkdir(parents=True, exist_ok=True)
+        # Continue after the builds of previous runs, their logs are kept
+        previous = [int(x.stem) for x in STATE_DIR.glob("*.log") if x.stem.isdigit()]
+        self.ids = itertools.count(max(previous, default=0) + 1)
+        self.threads = [
+            threading.Thread(target=self.work, daemon=True) for _ in range(workers)
+        ]
+
+    def start(self):
+        for thread in self.threads:
+            thread.start()
+        return self
+
+    def submit(self, args: [str]) -> (Job, bool):
+        """
+        Queues a build, or coalesces it into an active build of the same image
+        with the same options. Returns the job and whether the request was
+        coalesced.
+        """
+        parsed = parse_build_args(args)
+        # Build() resolves the provisioning and the name like the build will
+        image = build.Build(
+            openstack=parsed.openstack,
+            template=parsed.image[0],
+            conda_env=parsed.conda_env,
+            # Build() adds the delivery to the list
+            provisioning=list(parsed.provisioning),
+            delivery=parsed.delivery[0],
+            comment=parsed.comment,
+            ansible_args=parsed.ansible_args,
+            pvt_key=parsed.publish,
+            show_spinner=False,
+        )
+        key, options = image_key(image.image_name), build_options(parsed)
+        with self.lock:
+            for job in self.jobs.values():
+                if job.key == key and job.options == options and job.state in ACTIVE:
+                    job.requests += 1
+                    return job, True
+            job = Job(str(next(self.ids)), args, image.image_name)
+            self.jobs[job.id] = job
+        self.queue.put(job)
+        return job, False
+
+    def command(self, job: Job) -> [str]:
+        command = [sys.executable, "-u", str(DIR_PATH / "build.py"), *job.args, "-q"]
+        # Concurrent builds must not wipe each other's Packer output
+        command += ["--output-directory", str(DIR_PATH / "images" / job.id)]
+        parsed = parse_build_args(job.args)
+        if not parsed.cpus:
+            command += ["--cpus", str(self.cpus)]
+        if not parsed.memory:
+            command += ["--memory", str(self.memory)]
+        return command
+
+    def work(self):
+        while True:
+            job = self.queue.get()
+            if job is None:
+                return
+            with self.lock:
+                if job.state != "queued":
+                    continue
+                if job.name in self.running:
+                    # Builds of the same image name write the same raw image,
+                    # incremental playbook and OpenStack image
+                    self.waiting[job.name].append(job)
+                    continue
+                self.running.add(job.name)
+                job.set_state("running")
+            try:
+                self.run(job)
+            finally:
+                with self.lock:
+                    self.running.discard(job.name)
+                    waiting = self.waiting.pop(job.name, [])
+                for other in waiting:
+                    self.queue.put(other)
+
+    def run(self, job: Job):
+        with open(job.log_path, "ab") as log:
+            try:
+                job.process = subprocess.Popen(
+                    self.command(job),
+                    cwd=DIR_PATH,
+                    stdout=subprocess.PIPE,
+                    stderr=subprocess.STDOUT,
+                    stdin=subprocess.DEVNULL,
+                    # Keep SIGINT of the server away from the builds
+                    start_new_session=True,
+                )
+            except OSError as e:
+                log.write(f"Can't start build: {e}\n".encode())
+                job.set_state("failed")
+                return
+            for line in job.process.stdout:
+                log.write(line)
+                log.flush()
+                with job.changed:
+                    job.changed.notify_all()
+            job.returncode = job.process.wait()
+        if job.cancelled:
+            job.set_state("cancelled")
+        else:
+            job.set_state("ok" if job.returncode == 0 else "failed")
+
+    def cancel(self, job: Job):
+        """
+        Cancels a queued build, or interrupts a running one like Ctrl+C would.
+        """
+        with self.lock:
+            if job.state == "queued":
+                job.set_state("cancelled")
+                return
+            if job.state != "running" or job.cancelled:
+                return
+            # The worker sets the state once build.py has cleaned up
+            job.cancelled = True
+        if job.process:
+            job.process.send_signal(signal.SIGINT)
+
+    def shutdown(self):
+        for job in list(self.jobs.values()):
+            self.cancel(job)
+        for _ in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+
+
+class RequestHandler(http.server.BaseHTTPRequestHandler):
+    # Every request gets its own connection, streamed logs end with it
+    protocol_version = "HTTP/1.0"
+
+    def address_string(self):
+        # Unix sockets have no client address
+        return self.client_address[0] if self.client_address else "unix"
+
+    def send_json(self, status: int, data):
+        body = json.dumps(data, indent=2).encode() + b"\n"
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def find_job(self) -> (Job, str):
+        """
+        Returns the job of a /builds/ID[/...] path and the rest of the path.
+        """
+        parts = urllib.parse.urlsplit(self.path).path.strip("/").split("/")
+        if parts[0] != "builds" or len(parts) < 2:
+            return None, None
+        return self.server.builds.jobs.get(parts[1]), "/".join(parts[2:])
+
+    def do_GET(self):
+        path = urllib.parse.urlsplit(self.path).path.strip("/")
+        if path == "builds":
+            jobs = [x.as_dict() for x in self.server.builds.jobs.values()]
+            self.send_json(200, jobs)
+            return
+        job, rest = self.find_job()
+        if not job:
+            self.send_json(404, {"error": "No such build"})
+        elif rest == "":
+            self.send_json(200, job.as_dict())
+        elif rest == "log":
+            self.stream_log(job)
+        else:
+            self.send_json(404, {"error": "Not found"})
+
+    def stream_log(self, job: Job):
+        """
+        Sends the log of a build and everything added to it until it finishes.
+        """
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; charset=utf-8")
+        self.end_headers()
+        offset = 0
+        while True:
+            with job.changed:
+                finished = job.state not in ACTIVE
+            if job.log_path.exists():
+                with open(job.log_path, "rb") as f:
+                    f.seek(offset)
+                    for chunk in iter(lambda: f.read(LOG_CHUNK_SIZE), b""):
+                        self.wfile.write(chunk)
+                        offset += len(chunk)
+                self.wfile.flush()
+            if finished:
+                self.wfile.write(f"===== BUILD {job.state.upper()} =====\n".encode())
+                return
+            with job.changed:
+                # Timeout in case a change was missed between reading and waiting
+                job.changed.wait(timeout=5)
+
+    def do_POST(self):
+        if urllib.parse.urlsplit(self.path).path.strip("/") != "builds":
+            self.send_json(404, {"error": "Not found"})
+            return
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            request = json.loads(self.rfile.read(length))
+            args = request["args"]
+            if not isinstance(args, list) or not all(isinstance(x, str) for x in args):
+                raise ValueError("args must be a list of strings")
+            job, coalesced = self.server.builds.submit(args)
+        except (KeyError, ValueError) as e:
+            self.send_json(400, {"error": str(e)})
+            return
+        except subprocess.CalledProcessError as e:
+            self.send_json(500, {"error": f"Can't name the image: {e}"})
+            return
+        self.send_json(
+            200 if coalesced else 201, {**job.as_dict(), "coalesced": coalesced}
+        )
+
+    def do_DELETE(self):
+        job, rest = self.find_job()
+        if not job or rest:
+            self.send_json(404, {"error": "No such build"})
+            return
+        self.server.builds.cancel(job)
+        self.send_json(200, job.as_dict())
+
+
+class TCPBuildServer(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+
+
+class UnixBuildServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def serve(args):
+    if args.listen:
+        host, _, port = args.listen.rpartition(":")
+        server = TCPBuildServer((host or "127.0.0.1", int(port)), RequestHandler)
+        where = f"http://{args.listen}"
+    else:
+        args.socket.parent.mkdir(parents=True, exist_ok=True)
+        args.socket.unlink(missing_ok=True)
+        server = UnixBuildServer(str(args.socket), RequestHandler)
+        # Only the user running the server may submit builds
+        args.socket.chmod(0o600)
+        where = args.socket
+    server.builds = BuildQueue(args.workers).start()
+    print(
+        f"Build server listening on {where} with {args.workers} workers, "
+        f"{server.builds.cpus} CPUs and {server.builds.memory} MiB per build"
+    )
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print("Shutting down, interrupting running builds")
+    finally:
+        server.server_close()
+        server.builds.shutdown()
+        if not args.listen:
+            args.socket.unlink(missing_ok=True)
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, path: pathlib.Path, timeout: float = None):
+        super().__init__("localhost", timeout=timeout)
+        self.socket_path = str(path)
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(self.socket_path)
+
+
+def request(args, method: str, path: str, body: dict = None):
+    """
+    Sends a request to the build server, returns the response.
+    """
+    if args.server:
+        connection = http.client.HTTPConnection(args.server)
+    else:
+        connection = UnixHTTPConnection(args.socket)
+    headers = {"Content-Type": "application/json"} if body is not None else {}
+    data = json.dumps(body).encode() if body is not None else None
+    try:
+        connection.request(method, path, body=data, headers=headers)
+    except OSError as e:
+        raise SystemExit(f"Can't reach the build server: {e}")
+    return connection.getresponse()
+
+
+def print_log(args, job_id: str) -> str:
+    response = request(args, "GET", f"/builds/{job_id}/log")
+    if response.status != 200:
+        raise SystemExit(json.load(response)["error"])
+    for line in response:
+        sys.stdout.buffer.write(line)
+        sys.stdout.buffer.flush()
+    return json.load(request(args, "GET", f"/builds/{job_id}"))["state"]
+
+
+def make_parser() -> argparse.ArgumentParser:
+    my_parser = argparse.ArgumentParser(
+        prog="build_server",
+        description="Queue VGCN builds on a shared build host",
+    )
+    my_parser.add_argument(
+        "--socket",
+        type=pathlib.Path,
+        default=SOCKET_PATH,
+        help=f"Unix socket of the server (default: {SOCKET_PATH})",
+    )
+    my_parser.add_argument(
+        "--server",
+        metavar="HOST:PORT",
+        help="talk to a server listening on TCP instead of the Unix socket",
+    )
+    subparsers = my_parser.add_subparsers(dest="command", required=True)
+    serve_parser = subparsers.add_parser("serve", help="Run the build server")
+    serve_parser.add_argument(
+        "--workers", type=int, default=2, help="number of concurrent builds"
+    )
+    serve_parser.add_argument(
+        "--listen",
+        metavar="HOST:PORT",
+        help="listen on TCP instead of the Unix socket, e.g. 127.0.0.1:8472",
+    )
+    submit = subparsers.add_parser("submit", help="Queue a build")
+    submit.add_argument(
+        "--follow", action="store_true", help="stream the log until the build ends"
+    )
+    submit.add_argument("args", nargs=argparse.REMAINDER, help="build.py arguments")
+    status = subparsers.add_parser("status", help="Print the status of builds")
+    status.add_argument("id", nargs="?")
+    log = subparsers.add_parser("log", help="Stream the log of a build")
+    log.add_argument("id")
+    cancel = subparsers.add_parser("cancel", help="Cancel a build")
+    cancel.add_argument("id")
+    return my_parser
+
+
+def main():
+    args = make_parser().parse_args()
+    if args.command == "serve":
+        serve(args)
+        return
+    if args.command == "submit":
+        build_args = args.args[1:] if args.args[:1] == ["--"] else args.args
+        response = request(args, "POST", "/builds", {"args": build_args})
+        job = json.load(response)
+        if response.status not in (200, 201):
+            raise SystemExit(job["error"])
+        coalesced = " (coalesced with an identical build)" if job["coalesced"] else ""
+        print(f"Build {job['id']}: {job['image_name']} {job['state']}{coalesced}")
+        if args.follow and print_log(args, job["id"]) != "ok":
+            sys.exit(1)
+    elif args.command == "status":
+        response = request(args, "GET", f"/builds/{args.id}" if args.id else "/builds")
+        jobs = json.load(response)
+        if response.status != 200:
+            raise SystemExit(jobs["error"])
+        for job in jobs if isinstance(jobs, list) else [jobs]:
+            print(
+                f"{job['id']}  {job['state']:9}  {job['requests']} requests  "
+                f"{job['image_name']}"
+            )
+    elif args.command == "log":
+        if print_log(args, args.id) != "ok":
+            sys.exit(1)
+    elif args.command == "cancel":
+        response = request(args, "DELETE", f"/builds/{args.id}")
+        job = json.load(response)
+        if response.status != 200:
+            raise SystemExit(job["error"])
+        print(f"Build {job['id']}: {job['state']}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,212 @@
+#!/usr/bin/env python
+# Block-level delta transfer of VGCN images to the static image server.
+# build.py imports this file for the sending side and runs its source on the
+# target, either through ssh or locally (python3 -c), as the receiving side:
+#
+#   hashes DIR NAME            Finds the image published before NAME in DIR and
+#                              prints its name and block hashes as JSON.
+#   apply DIR NAME BASE        Reads a delta stream from stdin and rebuilds NAME
+#                              in DIR from the previous image BASE ('-' for none),
+#                              verifies its SHA256 checksum and prints it as JSON.
+#
+# The delta stream is a sequence of records, each an opcode and a number:
+# COPY n blocks from BASE, ZERO n blocks, DATA n bytes (followed by the bytes)
+# and END size (followed by the SHA256 digest of the whole image).
+# Blocks are compared at the same offset only, which fits VM images well.
+# Only the Python standard library may be used, the target has nothing else.
+
+import hashlib
+import json
+import os
+import struct
+import sys
+
+BLOCK_SIZE = 1024**2
+
+RECORD = struct.Struct(">cQ")
+OP_COPY = b"C"
+OP_ZERO = b"Z"
+OP_DATA = b"D"
+OP_END = b"E"
+
+ZERO_BLOCK = bytes(BLOCK_SIZE)
+
+
+def parse_name(name):
+    """
+    Splits an image name of the scheme from build.py's assemble_name()
+    (vgcn~template~+provisioning~date~seconds~branch~commit[~comment])
+    into its fields. Returns None for files not following the scheme.
+    """
+    parts = name.split("~")
+    if len(parts) < 7 or parts[0] != "vgcn" or name.endswith(".part"):
+        return None
+    try:
+        seconds = int(parts[4])
+    except ValueError:
+        return None
+    return {
+        "template": parts[1],
+        "provisioning": parts[2],
+        "date": parts[3],
+        "seconds": seconds,
+        "branch": parts[5],
+        "commit": parts[6],
+        "comment": "~".join(parts[7:]) or None,
+    }
+
+
+def name_key(name):
+    """
+    Returns the part of an image name identifying the image and its
+    timestamp, or None for files not following the scheme.
+    """
+    fields = parse_name(name)
+    if fields is None:
+        return None
+    return (fields["template"], fields["provisioning"]), (
+        fields["date"],
+        fields["seconds"],
+    )
+
+
+def find_previous(directory, name):
+    """
+    Returns the name of the newest image in directory with the same template
+    and provisioning as name, or None.
+    """
+    key = name_key(name)
+    if key is None:
+        return None
+    candidates = []
+    for entry in os.listdir(directory):
+        entry_key = name_key(entry)
+        if entry != name and entry_key and entry_key[0] == key[0]:
+            candidates.append((entry_key[1], entry))
+    return max(candidates)[1] if candidates else None
+
+
+def block_hashes(path, block_size=BLOCK_SIZE):
+    hashes = []
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            hashes.append(hashlib.sha256(block).hexdigest())
+    return hashes
+
+
+def write_delta(image, base_hashes, out, block_size=BLOCK_SIZE):
+    """
+    Writes the delta stream that turns the image with base_hashes into image.
+    Hashes image in the same pass and returns transfer statistics.
+    """
+    stats = {"blocks": 0, "copied": 0, "zero": 0, "sent": 0}
+    digest = hashlib.sha256()
+    run_op, run_length = None, 0
+
+    def flush():
+        if run_length:
+            out.write(RECORD.pack(run_op, run_length))
+
+    size = 0
+    with open(image, "rb") as f:
+        for index, block in enumerate(iter(lambda: f.read(block_size), b"")):
+            digest.update(block)
+            size += len(block)
+            stats["blocks"] += 1
+            if index < len(base_hashes) and (
+                hashlib.sha256(block).hexdigest() == base_hashes[index]
+            ):
+                op = OP_COPY
+                stats["copied"] += 1
+            elif len(block) == block_size and block == ZERO_BLOCK:
+                op = OP_ZERO
+                stats["zero"] += 1
+            else:
+                op = OP_DATA
+                stats["sent"] += 1
+            # Consecutive copied and zero blocks are merged into one record
+            if op != run_op or op == OP_DATA:
+                flush()
+                run_op, run_length = op, 0
+            if op == OP_DATA:
+                out.write(RECORD.pack(OP_DATA, len(block)))
+                out.write(block)
+            else:
+                run_length += 1
+    flush()
+    out.write(RECORD.pack(OP_END, size))
+    out.write(digest.digest())
+    out.flush()
+    stats["size"] = size
+    stats["sha256"] = digest.hexdigest()
+    return stats
+
+
+def read_exactly(stream, length):
+    data = stream.read(length)
+    if len(data) != length:
+        raise EOFError("Delta stream ended early")
+    return data
+
+
+def apply_delta(directory, name, base, stream, block_size=BLOCK_SIZE):
+    """
+    Rebuilds name in directory from base and the delta stream.
+    The image is written to a .part file and only renamed after its checksum
+    matched the one sent by the other side.
+    """
+    target = os.path.join(directory, name)
+    partial = f"{target}.part"
+    digest = hashlib.sha256()
+    base_file = open(os.path.join(directory, base), "rb") if base else None
+    try:
+        with open(partial, "wb") as out:
+            while True:
+                op, value = RECORD.unpack(read_exactly(stream, RECORD.size))
+                if op == OP_COPY:
+                    base_file.seek(out.tell())
+                    for _ in range(value):
+                        block = base_file.read(block_size)
+                        digest.update(block)
+                        out.write(block)
+                elif op == OP_ZERO:
+                    for _ in range(value):
+                        digest.update(ZERO_BLOCK)
+                    # Leave a hole instead of writing zeros
+                    out.seek(value * block_size, os.SEEK_CUR)
+                elif op == OP_DATA:
+                    block = read_exactly(stream, value)
+                    digest.update(block)
+                    out.write(block)
+                elif op == OP_END:
+                    expected = read_exactly(stream, digest.digest_size)
+                    out.truncate(value)
+                    break
+                else:
+                    raise ValueError(f"Unknown delta record {op!r}")
+    finally:
+        if base_file:
+            base_file.close()
+    if digest.digest() != expected:
+        os.unlink(partial)
+        raise ValueError(f"Checksum mismatch for {name}")
+    os.rename(partial, target)
+    return {"name": name, "size": value, "sha256": digest.hexdigest()}
+
+
+def main(argv):
+    command, directory, name = argv[:3]
+    if command == "hashes":
+        previous = find_previous(directory, name)
+        hashes = block_hashes(os.path.join(directory, previous)) if previous else []
+        result = {"previous": previous, "block_size": BLOCK_SIZE, "hashes": hashes}
+    elif command == "apply":
+        base = None if argv[3] == "-" else argv[3]
+        result = apply_delta(directory, name, base, sys.stdin.buffer)
+    else:
+        raise SystemExit(f"Unknown command {command}")
+    json.dump(result, sys.stdout)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
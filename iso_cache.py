@@ -0,0 +1,278 @@
+#!/usr/bin/env python
+# Local cache of the boot ISOs of the VGCN templates.
+# build.py downloads each boot ISO once into cache/iso/, verifies its SHA256
+# checksum from the CHECKSUM file published next to it while downloading and
+# hands Packer the local file:// URL. Interrupted downloads are resumed with
+# HTTP range requests. ISOs are stored by checksum, so a new point release
+# under the same "latest" URL is a new entry and the old one ages out.
+# ISOs in use by a build are locked and never pruned.
+# Run this file to look at or maintain the cache:
+#   python iso_cache.py list
+#   python iso_cache.py fetch URL
+#   python iso_cache.py prune [--max-size 10] [--max-age 60]
+
+import argparse
+import contextlib
+import datetime
+import fcntl
+import functools
+import hashlib
+import json
+import os
+import pathlib
+import time
+import urllib.error
+import urllib.request
+
+DIR_PATH = pathlib.Path(__file__).parent.absolute()
+
+CACHE_DIR = DIR_PATH / "cache" / "iso"
+
+# Retention limits, applied after every download and by the prune command
+MAX_SIZE = 10 * 1024**3
+MAX_AGE = 60  # days
+
+DOWNLOAD_CHUNK_SIZE = 1024**2
+DOWNLOAD_ATTEMPTS = 5
+
+
+@functools.lru_cache(maxsize=None)
+def resolve_checksum(iso_url: str) -> str:
+    """
+    Fetches the SHA256 checksum of a boot ISO from the CHECKSUM file
+    published next to it.
+    """
+    with urllib.request.urlopen(f"{iso_url}.CHECKSUM", timeout=30) as response:
+        checksums = response.read().decode("utf-8")
+    iso_name = iso_url.rsplit("/", 1)[-1]
+    for line in checksums.splitlines():
+        # BSD style, e.g. "SHA256 (Rocky-9-latest-x86_64-boot.iso) = 0123..."
+        if line.startswith(f"SHA256 ({iso_name})"):
+            return f"sha256:{line.rsplit('=', 1)[-1].strip()}"
+    raise ValueError(f"No SHA256 checksum for {iso_name} in {iso_url}.CHECKSUM")
+
+
+class IsoCache:
+    """
+    Content-addressed store of boot ISOs, keyed by their SHA256 checksum.
+    """
+
+    def __init__(
+        self,
+        directory: pathlib.Path = CACHE_DIR,
+        max_size: int = MAX_SIZE,
+        max_age: float = MAX_AGE,
+    ):
+        self.directory = directory
+        self.max_size = max_size
+        self.max_age = max_age
+
+    def path(self, checksum: str) -> pathlib.Path:
+        return self.directory / f"{checksum.split(':', 1)[-1]}.iso"
+
+    def entries(self) -> [dict]:
+        """
+        Returns the metadata of the cached ISOs, least recently used first.
+        """
+        entries = []
+        for path in self.directory.glob("*.json"):
+            iso = path.with_suffix(".iso")
+            if not iso.exists():
+                continue
+            with open(path) as f:
+                entry = json.load(f)
+            # The modification time of the ISO records its last use
+            entry["path"] = iso
+            entry["used"] = iso.stat().st_mtime
+            entries.append(entry)
+        return sorted(entries, key=lambda x: x["used"])
+
+    @contextlib.contextmanager
+    def fetch(self, url: str, checksum: str, prefix: str = None):
+        """
+        Yields the path of the ISO with checksum, downloading it from url
+        on a cache miss. The entry is locked shared until the block ends, so
+        it isn't pruned while a build uses it, and locked exclusively only
+        while it is downloaded, so builds of the same ISO don't wait for each
+        other on a hit.
+        """
+        algorithm, _, expected = checksum.partition(":")
+        if algorithm != "sha256":
+            raise ValueError(f"Unsupported ISO checksum {checksum}")
+        head = f"[{prefix}] " if prefix else ""
+        path = self.path(checksum)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        with open(path.with_suffix(".lock"), "w") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_SH)
+            try:
+                if path.exists():
+                    print(f"{head}ISO cache: HIT {path}")
+                while not path.exists():
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+                    fcntl.flock(lock_file, fcntl.LOCK_EX)
+                    # Another build may have downloaded it in the meantime
+                    if not path.exists():
+                        print(f"{head}ISO cache: MISS, downloading {url}")
+                        self.download(url, path, expected, head)
+                        self.write_metadata(path, url, checksum)
+                    # Changing the lock isn't atomic, a prune may get in
+                    # between, then the loop downloads it again
+                    fcntl.flock(lock_file, fcntl.LOCK_SH)
+                os.utime(path)
+                self.prune(keep=[path])
+                yield path
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def write_metadata(self, path: pathlib.Path, url: str, checksum: str):
+        with open(path.with_suffix(".json"), "w") as f:
+            json.dump(
+                {
+                    "url": url,
+                    "checksum": checksum,
+                    "size": path.stat().st_size,
+                    "created": datetime.datetime.now().isoformat(),
+                },
+                f,
+                indent=2,
+            )
+
+    def download(self, url: str, path: pathlib.Path, expected: str, head: str = ""):
+        """
+        Downloads url to path, resuming from a partial download left by an
+        earlier attempt or run. The checksum is computed while downloading,
+        the file only gets its final name if it matches.
+        """
+        partial = path.with_suffix(".part")
+        for attempt in range(1, DOWNLOAD_ATTEMPTS + 1):
+            digest = hashlib.sha256()
+            # Hash what an earlier attempt left, the download appends to it
+            offset = 0
+            if partial.exists():
+                with open(partial, "rb") as f:
+                    for chunk in iter(lambda: f.read(DOWNLOAD_CHUNK_SIZE), b""):
+                        digest.update(chunk)
+                        offset += len(chunk)
+            request = urllib.request.Request(url)
+            if offset:
+                request.add_header("Range", f"bytes={offset}-")
+            try:
+                with urllib.request.urlopen(request, timeout=60) as response:
+                    if offset and response.status != 206:
+                        # The server ignored the range, start over
+                        print(f"{head}Server doesn't support resuming, restarting")
+                        digest, offset = hashlib.sha256(), 0
+                    with open(partial, "r+b" if offset else "wb") as f:
+                        f.seek(offset)
+                        f.truncate()
+                        for chunk in iter(
+                            lambda: response.read(DOWNLOAD_CHUNK_SIZE), b""
+                        ):
+                            digest.update(chunk)
+                            f.write(chunk)
+            except urllib.error.HTTPError as e:
+                # The partial download is complete already
+                if e.code != 416:
+                    raise
+            except OSError as e:
+                if attempt == DOWNLOAD_ATTEMPTS:
+                    raise
+                print(f"{head}Download interrupted ({e}), resuming")
+                time.sleep(attempt)
+                continue
+            if digest.hexdigest() != expected:
+                partial.unlink()
+                raise ValueError(
+                    f"Checksum mismatch for {url}: "
+                    f"expected {expected}, got {digest.hexdigest()}"
+                )
+            os.rename(partial, path)
+            print(f"{head}ISO verified and cached as {path}")
+            return
+
+    def prune(
+        self, max_size: int = None, max_age: float = None, keep: [pathlib.Path] = ()
+    ) -> [dict]:
+        """
+        Removes ISOs not used for max_age days, then the least recently used
+        ones until the cache fits max_size. ISOs in use and those in keep
+        are skipped. Returns the removed entries.
+        """
+        max_size = self.max_size if max_size is None else max_size
+        max_age = self.max_age if max_age is None else max_age
+        entries = self.entries()
+        size = sum(x["size"] for x in entries)
+        cutoff = time.time() - max_age * 24 * 3600
+        removed = []
+        for entry in entries:
+            if entry["used"] >= cutoff and size <= max_size:
+                continue
+            path = entry["path"]
+            if path in keep:
+                continue
+            # Lock files stay, other processes may be waiting on them
+            with open(path.with_suffix(".lock"), "w") as lock_file:
+                try:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    continue
+                path.unlink()
+                path.with_suffix(".json").unlink(missing_ok=True)
+                path.with_suffix(".part").unlink(missing_ok=True)
+            size -= entry["size"]
+            removed.append(entry)
+        return removed
+
+
+def make_parser() -> argparse.ArgumentParser:
+    my_parser = argparse.ArgumentParser(
+        prog="iso_cache",
+        description="Maintain the local cache of boot ISOs of VGCN builds",
+    )
+    my_parser.add_argument("--cache-dir", type=pathlib.Path, default=CACHE_DIR)
+    subparsers = my_parser.add_subparsers(dest="command", required=True)
+    subparsers.add_parser("list", help="Print the cached ISOs")
+    fetch = subparsers.add_parser(
+        "fetch", help="Download and verify an ISO, e.g. to warm the cache"
+    )
+    fetch.add_argument(
+        "url", help="URL of the ISO, a .CHECKSUM file must be next to it"
+    )
+    prune = subparsers.add_parser("prune", help="Remove old ISOs from the cache")
+    prune.add_argument(
+        "--max-size",
+        type=float,
+        default=MAX_SIZE / 1024**3,
+        help=f"size limit of the cache in GiB (default: {MAX_SIZE // 1024**3})",
+    )
+    prune.add_argument(
+        "--max-age",
+        type=float,
+        default=MAX_AGE,
+        help=f"remove ISOs not used for this many days (default: {MAX_AGE})",
+    )
+    return my_parser
+
+
+def main():
+    args = make_parser().parse_args()
+    cache = IsoCache(args.cache_dir)
+    if args.command == "list":
+        for entry in cache.entries():
+            used = datetime.datetime.fromtimestamp(entry["used"]).isoformat()
+            print(
+                f"{entry['path'].name}  {entry['size'] / 1024**2:.0f} MiB  "
+                f"last used {used}  {entry['url']}"
+            )
+    elif args.command == "fetch":
+        with cache.fetch(args.url, resolve_checksum(args.url)):
+            pass
+    elif args.command == "prune":
+        removed = cache.prune(int(args.max_size * 1024**3), args.max_age)
+        for entry in removed:
+            print(f"Removed {entry['path'].name} ({entry['url']})")
+        print(f"{len(removed)} ISOs removed")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,329 @@
+#!/usr/bin/env python
+# Caching HTTP proxy for the packages downloaded during VGCN image builds.
+# build.py starts it on the build host and points dnf in the build VM at it,
+# so repeated and matrix builds download each RPM from the mirrors only once.
+# Immutable downloads (packages, checksum-named repodata, tarballs) are cached
+# in a size-bounded store with LRU eviction; everything else is passed through.
+# HTTPS can't be cached without intercepting TLS, it is tunneled and counted.
+# It can also be run on its own:
+#   python package_proxy.py --port 3128 --max-size 20
+
+import argparse
+import collections
+import hashlib
+import http.server
+import os
+import pathlib
+import re
+import selectors
+import shutil
+import socket
+import tempfile
+import threading
+import urllib.error
+import urllib.request
+
+DIR_PATH = pathlib.Path(__file__).parent.absolute()
+
+CACHE_DIR = DIR_PATH / "cache" / "packages"
+
+# How the build VM reaches the build host with QEMU user mode networking
+GUEST_HOST_ADDRESS = "10.0.2.2"
+
+# Downloads that never change under the same URL
+CACHEABLE = re.compile(r"(\.rpm|\.drpm|\.tar\.gz|\.tgz|/repodata/[0-9a-f]{32,}-[^/]+)$")
+
+COPY_BUFFER_SIZE = 1024**2
+
+# Headers not to be forwarded by a proxy (RFC 9110, section 7.6.1)
+HOP_BY_HOP = {
+    "connection",
+    "keep-alive",
+    "proxy-authenticate",
+    "proxy-authorization",
+    "proxy-connection",
+    "te",
+    "trailer",
+    "transfer-encoding",
+    "upgrade",
+}
+
+
+class PackageCache:
+    """
+    Size-bounded store of downloads, evicting the least recently used ones.
+    """
+
+    def __init__(self, directory: pathlib.Path, max_size: int):
+        self.directory = directory
+        self.max_size = max_size
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.lock = threading.Lock()
+        # Oldest first, recovered from the access times of a previous run
+        self.entries = collections.OrderedDict()
+        files = [x for x in self.directory.iterdir() if x.suffix == ".pkg"]
+        for path in sorted(files, key=lambda x: x.stat().st_mtime):
+            self.entries[path.name] = path.stat().st_size
+        self.size = sum(self.entries.values())
+        self.stats = collections.Counter()
+
+    def path(self, url: str) -> pathlib.Path:
+        return self.directory / f"{hashlib.sha256(url.encode()).hexdigest()}.pkg"
+
+    def get(self, url: str):
+        """
+        Returns the cached file for url opened for reading, or None.
+        It is opened under the lock, so an eviction by a concurrent put() can
+        only unlink it while it is read, which doesn't affect the reader.
+        """
+        path = self.path(url)
+        with self.lock:
+            if path.name not in self.entries:
+                self.stats["misses"] += 1
+                return None
+            try:
+                cached = open(path, "rb")
+            except FileNotFoundError:
+                # Removed behind the cache's back, downloaded again
+                self.size -= self.entries.pop(path.name)
+                self.stats["misses"] += 1
+                return None
+            self.entries.move_to_end(path.name)
+            self.stats["hits"] += 1
+            self.stats["hit_bytes"] += self.entries[path.name]
+        # The modification time keeps the LRU order across runs
+        os.utime(cached.fileno())
+        return cached
+
+    def put(self, url: str, download: pathlib.Path):
+        """
+        Moves a completed download into the cache and evicts old entries.
+        """
+        path = self.path(url)
+        size = download.stat().st_size
+        if size > self.max_size:
+            download.unlink()
+            return
+        with self.lock:
+            os.replace(download, path)
+            self.size += size - self.entries.pop(path.name, 0)
+            self.entries[path.name] = size
+            while self.size > self.max_size:
+                name, evicted = self.entries.popitem(last=False)
+                (self.directory / name).unlink(missing_ok=True)
+                self.size -= evicted
+                self.stats["evictions"] += 1
+
+
+class ProxyHandler(http.server.BaseHTTPRequestHandler):
+    """
+    Forward proxy: GET and HEAD for http:// URLs, CONNECT for tunnels.
+    """
+
+    # Every request gets its own connection, keeps the handler simple
+    protocol_version = "HTTP/1.0"
+    # Don't send upstream requests through a proxy set in the environment
+    opener = urllib.request.build_opener(urllib.request.ProxyHandler({}))
+
+    def log_message(self, format, *args):
+        pass
+
+    def forward_headers(self):
+        return {k: v for k, v in self.headers.items() if k.lower() not in HOP_BY_HOP}
+
+    def send_upstream_headers(self, status: int, headers):
+        self.send_response(status)
+        for key, value in headers.items():
+            if key.lower() not in HOP_BY_HOP:
+                self.send_header(key, value)
+        self.end_headers()
+
+    def do_HEAD(self):
+        self.do_GET(body=False)
+
+    def do_GET(self, body=True):
+        cache = self.server.cache
+        if not self.path.startswith("http://"):
+            self.send_error(400, "Only absolute http:// URLs can be proxied")
+            return
+        # Partial downloads aren't cached
+        cacheable = body and CACHEABLE.search(self.path) and "Range" not in self.headers
+        if cacheable:
+            cached = cache.get(self.path)
+            if cached:
+                with cached:
+                    self.send_response(200)
+                    self.send_header(
+                        "Content-Length", str(os.fstat(cached.fileno()).st_size)
+                    )
+                    self.end_headers()
+                    shutil.copyfileobj(cached, self.wfile, COPY_BUFFER_SIZE)
+                return
+        request = urllib.request.Request(
+            self.path,
+            headers=self.forward_headers(),
+            method="GET" if body else "HEAD",
+        )
+        try:
+            upstream = self.opener.open(request, timeout=60)
+        except urllib.error.HTTPError as e:
+            upstream = e
+        except OSError as e:
+            self.send_error(502, f"Upstream error: {e}")
+            return
+        with upstream:
+            self.send_upstream_headers(upstream.status, upstream.headers)
+            if not body:
+                return
+            if not (cacheable and upstream.status == 200):
+                shutil.copyfileobj(upstream, self.wfile, COPY_BUFFER_SIZE)
+                return
+            with tempfile.NamedTemporaryFile(
+                dir=cache.directory, suffix=".part", delete=False
+            ) as download:
+                try:
+                    for chunk in iter(lambda: upstream.read(COPY_BUFFER_SIZE), b""):
+                        download.write(chunk)
+                        self.wfile.write(chunk)
+                except OSError:
+                    download.close()
+                    os.unlink(download.name)
+                    raise
+            with cache.lock:
+                cache.stats["miss_bytes"] += os.path.getsize(download.name)
+            cache.put(self.path, pathlib.Path(download.name))
+
+    def do_CONNECT(self):
+        host, _, port = self.path.rpartition(":")
+        try:
+            upstream = socket.create_connection((host, int(port)), timeout=60)
+        except (OSError, ValueError) as e:
+            self.send_error(502, f"Upstream error: {e}")
+            return
+        self.send_response(200, "Connection established")
+        self.end_headers()
+        with self.server.cache.lock:
+            self.server.cache.stats["tunnels"] += 1
+        tunneled = relay(self.connection, upstream)
+        with self.server.cache.lock:
+            self.server.cache.stats["tunnel_bytes"] += tunneled
+
+
+def relay(a: socket.socket, b: socket.socket) -> int:
+    """
+    Copies data between two sockets until one side closes.
+    Returns the number of bytes copied.
+    """
+    copied = 0
+    selector = selectors.DefaultSelector()
+    selector.register(a, selectors.EVENT_READ, b)
+    selector.register(b, selectors.EVENT_READ, a)
+    try:
+        while True:
+            events = selector.select(timeout=300)
+            if not events:
+                # Idle for too long
+                return copied
+            for key, _ in events:
+                data = key.fileobj.recv(COPY_BUFFER_SIZE)
+                if not data:
+                    return copied
+                key.data.sendall(data)
+                copied += len(data)
+    except OSError:
+        return copied
+    finally:
+        selector.close()
+        b.close()
+
+
+class PackageProxy:
+    """
+    Runs the caching proxy in a background thread of the build.
+    """
+
+    def __init__(
+        self,
+        directory: pathlib.Path = CACHE_DIR,
+        max_size: int = 20 * 1024**3,
+        port: int = 0,
+    ):
+        self.cache = PackageCache(directory, max_size)
+        # The build VM reaches the host's loopback through QEMU user networking
+        self.server = http.server.ThreadingHTTPServer(("127.0.0.1", port), ProxyHandler)
+        self.server.daemon_threads = True
+        self.server.cache = self.cache
+        self.thread = None
+
+    @property
+    def port(self) -> int:
+        return self.server.server_address[1]
+
+    @property
+    def guest_url(self) -> str:
+        return f"http://{GUEST_HOST_ADDRESS}:{self.port}"
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.port}"
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def stats(self) -> dict:
+        with self.cache.lock:
+            stats = dict(self.cache.stats)
+            stats["cache_size"] = self.cache.size
+            stats["cache_entries"] = len(self.cache.entries)
+        requests = stats.get("hits", 0) + stats.get("misses", 0)
+        stats["hit_ratio"] = (
+            round(stats.get("hits", 0) / requests, 3) if requests else None
+        )
+        # Share of the traffic that couldn't be cached, e.g. repos only
+        # reachable over HTTPS
+        tunneled = stats.get("tunnel_bytes", 0)
+        total = stats.get("hit_bytes", 0) + stats.get("miss_bytes", 0) + tunneled
+        stats["tunnel_ratio"] = round(tunneled / total, 3) if total else None
+        return stats
+
+    def summary(self) -> str:
+        stats = self.stats()
+        return (
+            f"Package cache: {stats.get('hits', 0)} hits "
+            f"({stats.get('hit_bytes', 0) / 1024**2:.1f} MiB), "
+            f"{stats.get('misses', 0)} misses "
+            f"({stats.get('miss_bytes', 0) / 1024**2:.1f} MiB), "
+            f"{stats.get('evictions', 0)} evictions, "
+            f"{stats.get('tunnels', 0)} uncached HTTPS tunnels "
+            f"({stats.get('tunnel_bytes', 0) / 1024**2:.1f} MiB, "
+            f"{(stats['tunnel_ratio'] or 0):.0%} of the traffic)"
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        prog="package_proxy",
+        description="Caching HTTP proxy for packages downloaded during VGCN builds",
+    )
+    parser.add_argument("--port", type=int, default=3128)
+    parser.add_argument(
+        "--max-size", type=float, default=20, help="cache size limit in GiB"
+    )
+    parser.add_argument("--cache-dir", type=pathlib.Path, default=CACHE_DIR)
+    args = parser.parse_args()
+    proxy = PackageProxy(args.cache_dir, int(args.max_size * 1024**3), args.port)
+    print(f"Serving on {proxy.url}, the build VM reaches it as {proxy.guest_url}")
+    try:
+        proxy.server.serve_forever()
+    except KeyboardInterrupt:
+        print(proxy.summary())
+
+
+if __name__ == "__main__":
+    main()
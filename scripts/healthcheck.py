@@ -4,37 +4,777 @@
 # python3 healthcheck.py --ip_addresses 1.1.1.1 8.8.8.8 --mount_points / \
 #                        --env_variables PATH --space_checks /,10 --details
 #
+# All checks run concurrently on a small pool of worker threads under one
+# overall deadline (--deadline), so a degraded node still reports in time.
+#
+# Run as daemon, the checks are refreshed in the background, each on its own
+# interval, and served from a Unix socket. Queries return the cached results
+# at once, and fall back to checking directly if no daemon is running:
+# python3 healthcheck.py --serve --ip_addresses 1.1.1.1 --mount_points /data
+# python3 healthcheck.py --query --details
+#
+# Addresses are probed from one event loop, with ICMP echo over unprivileged
+# datagram sockets (see net.ipv4.ping_group_range, the ping command is used
+# where they aren't permitted) or, given as host:port, with TCP connects.
+#
+# Mount points are probed by a small pool of helper processes, so a hung
+# NFS or CVMFS mount only ever blocks a helper. A helper that doesn't answer
+# in time is killed and counted as stuck, and the path it hangs on fails at
+# once until it is gone, instead of piling up blocked helpers.
+#
+# I/O checks measure sequential and random throughput of paths at bounded
+# cost in the same helpers, cache the results for --io_interval seconds and
+# print them as startd cron attributes next to NODE_IS_HEALTHY, e.g.
+# ScratchWriteMBps:
+# python3 healthcheck.py --io_checks /scratch,Scratch,100,200 /data/share
+#
+# With --metrics the results are printed in Influx line protocol instead,
+# for an exec input of Telegraf, or sent to a socket listener:
+# python3 healthcheck.py --query --metrics --metrics_socket udp://127.0.0.1:8094
+#
 # 2019, Andreas Skorczyk <me@andreas-sk.de>
 
 import argparse
+import asyncio
+import collections
+import json
 import os
+import queue
+import random
+import re
+import select
+import signal
+import socket
+import socketserver
+import struct
 import subprocess
 import sys
+import tempfile
+import threading
+import time
+
+
+# Names of the checks, in the order of the --details output
+NETWORK = "Network"
+MOUNTS = "Mounts"
+DISK_SPACE = "Disk Space"
+IO = "I/O"
+ENV = "Env. Variables"
+CHECKS = [NETWORK, MOUNTS, DISK_SPACE, IO, ENV]
+
+SOCKET_PATH = "/run/healthcheck.sock"
+
+# Influx measurement and tag key of the targets by check
+MEASUREMENTS = {
+    NETWORK: ("healthcheck_network", "target"),
+    MOUNTS: ("healthcheck_mount", "path"),
+    DISK_SPACE: ("healthcheck_disk_space", "path"),
+    IO: ("healthcheck_io", "path"),
+    ENV: ("healthcheck_env", "variable"),
+}
+
+IO_CACHE = "/var/tmp/healthcheck-io.json"
+IO_BLOCK_SIZE = 1024**2
+IO_PAGE_SIZE = 4096
+
+# Startd cron attributes of the I/O measurements, prefixed by the name of
+# the path
+IO_ATTRIBUTES = [
+    ("write_mbps", "WriteMBps"),
+    ("read_mbps", "ReadMBps"),
+    ("rand_write_iops", "RandWriteIOPS"),
+    ("rand_read_iops", "RandReadIOPS"),
+    ("rand_write_latency_ms", "RandWriteLatencyMs"),
+    ("rand_read_latency_ms", "RandReadLatencyMs"),
+]
+
+# Runs in the helper processes of MountProber, answers each request with the
+# result of statvfs on its path, or of measure_io of this script for "io"
+MOUNT_HELPER = r"""
+import json, os, sys, time
+sys.path.insert(0, sys.argv[1])
+for line in sys.stdin:
+    request = json.loads(line)
+    path = request["path"]
+    start = time.time()
+    try:
+        if request["op"] == "io":
+            from healthcheck import measure_io
+            result = measure_io(path, **request["options"])
+        else:
+            stat = os.statvfs(path)
+            result = {"mounted": os.path.ismount(path),
+                      "blocks": stat.f_blocks, "frsize": stat.f_frsize,
+                      "bavail": stat.f_bavail}
+    except OSError as e:
+        result = {"error": str(e)}
+    result["latency"] = time.time() - start
+    sys.stdout.write(json.dumps(result) + "\n")
+    sys.stdout.flush()
+"""
+
+# ICMP echo request and reply types by address family
+ICMP_ECHO = {
+    socket.AF_INET: (socket.IPPROTO_ICMP, 8, 0),
+    socket.AF_INET6: (socket.IPPROTO_ICMPV6, 128, 129),
+}
+
+
+class CheckResult:
+    """
+    Outcome of checking one target (an address, a path or a variable).
+    """
+
+    def __init__(self, check, target, healthy, latency, error=None,
+                 values=None):
+        self.check = check
+        self.target = target
+        self.healthy = healthy
+        self.latency = latency
+        self.error = error
+        # Measurements of the check, e.g. RTT and loss of a network probe
+        self.values = values or {}
+
+
+class ProbeResult:
+    """
+    Outcome of probing one network target, times in seconds.
+    """
+
+    def __init__(self, target, sent=0):
+        self.target = target
+        self.sent = sent
+        self.rtts = []
+        self.error = None
+        self.duration = 0
+
+    @property
+    def healthy(self):
+        return bool(self.rtts)
+
+    @property
+    def loss(self):
+        return 1 - len(self.rtts) / self.sent if self.sent else 1.0
+
+    @property
+    def rtt(self):
+        return sum(self.rtts) / len(self.rtts) if self.rtts else None
+
+
+def split_target(target):
+    """
+    Splits host:port (or [address]:port) targets, returns (host, None)
+    for plain addresses.
+    """
+    match = re.match(r"^\[(.+)\]:(\d+)$", target) or \
+        re.match(r"^([^:]+):(\d+)$", target)
+    if match:
+        return match.group(1), int(match.group(2))
+    return target, None
+
+
+def icmp_packet(kind, sequence):
+    """
+    Builds an ICMP echo request. The kernel sets the identifier of
+    datagram ICMP sockets.
+    """
+    payload = struct.pack("!d", time.time())
+    header = struct.pack("!BBHHH", kind, 0, 0, 0, sequence)
+    data = header + payload
+    checksum = sum(struct.unpack("!%dH" % (len(data) // 2), data))
+    checksum = (checksum >> 16) + (checksum & 0xffff)
+    checksum = ~(checksum + (checksum >> 16)) & 0xffff
+    return struct.pack("!BBHHH", kind, 0, checksum, 0, sequence) + payload
+
+
+class NetworkProber:
+    """
+    Probes all targets at once from one asyncio event loop and records RTT
+    and loss: addresses with ICMP echo, host:port targets with TCP connects.
+    Each target gets count probes, interval seconds apart, every probe is
+    answered within wait seconds or lost.
+    """
+
+    def __init__(self, count=3, interval=0.2, wait=2):
+        self.count = count
+        self.interval = interval
+        self.wait = wait
+
+    def probe(self, targets):
+        """
+        Returns a ProbeResult by target.
+        """
+        return asyncio.run(self.probe_all(targets))
+
+    async def probe_all(self, targets):
+        results = await asyncio.gather(
+            *[self.probe_target(target) for target in targets])
+        return dict(zip(targets, results))
+
+    async def probe_target(self, target):
+        start = time.time()
+        host, port = split_target(target)
+        if port is None:
+            result = await self.icmp_probe(target, host)
+        else:
+            result = await self.tcp_probe(target, host, port)
+        result.duration = time.time() - start
+        return result
+
+    async def tcp_probe(self, target, host, port):
+        result = ProbeResult(target, self.count)
+
+        async def connect(sequence):
+            await asyncio.sleep(sequence * self.interval)
+            start = time.time()
+            try:
+                _, writer = await asyncio.wait_for(
+                    asyncio.open_connection(host, port), self.wait)
+            except (OSError, asyncio.TimeoutError) as e:
+                result.error = str(e) or "timeout"
+                return
+            result.rtts.append(time.time() - start)
+            writer.close()
+
+        await asyncio.gather(*[connect(x) for x in range(self.count)])
+        return result
+
+    async def icmp_probe(self, target, host):
+        loop = asyncio.get_running_loop()
+        result = ProbeResult(target)
+        try:
+            family, _, _, _, address = (await loop.getaddrinfo(
+                host, None, type=socket.SOCK_DGRAM))[0]
+            protocol, request, reply = ICMP_ECHO[family]
+            sock = socket.socket(family, socket.SOCK_DGRAM, protocol)
+        except PermissionError:
+            # The group may not open ICMP sockets, use the ping command
+            return await self.ping_probe(target, host)
+        except (OSError, KeyError) as e:
+            result.error = str(e)
+            return result
+
+        sent_at = {}
+
+        async def send():
+            for sequence in range(self.count):
+                if sequence:
+                    await asyncio.sleep(self.interval)
+                sent_at[sequence] = time.time()
+                result.sent += 1
+                sock.sendto(icmp_packet(request, sequence), address)
+
+        async def receive():
+            while len(result.rtts) < self.count:
+                data = await loop.sock_recv(sock, 1024)
+                kind, _, _, _, sequence = struct.unpack("!BBHHH", data[:8])
+                if kind == reply and sequence in sent_at:
+                    result.rtts.append(time.time() - sent_at.pop(sequence))
+
+        with sock:
+            sock.setblocking(False)
+            sender = asyncio.ensure_future(send())
+            try:
+                await asyncio.wait_for(
+                    receive(), (self.count - 1) * self.interval + self.wait)
+            except asyncio.TimeoutError:
+                result.error = "timeout"
+            except OSError as e:
+                result.error = str(e)
+            finally:
+                sender.cancel()
+                try:
+                    await sender
+                except asyncio.CancelledError:
+                    pass
+                except OSError as e:
+                    result.error = str(e)
+        return result
+
+    async def ping_probe(self, target, host):
+        result = ProbeResult(target, self.count)
+        try:
+            process = await asyncio.create_subprocess_exec(
+                "ping", "-n", "-c", str(self.count),
+                "-i", str(self.interval), "-W", str(self.wait), host,
+                stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        except OSError as e:
+            result.error = str(e)
+            return result
+        output, _ = await process.communicate()
+        result.rtts = [float(x) / 1000 for x in
+                       re.findall(r"time=([\d.]+) ms", output.decode())]
+        if not result.rtts:
+            result.error = "no reply"
+        return result
+
+
+class HealthReport:
+    """
+    Aggregate verdict of a run of HealthChecker.run_checks.
+    """
+
+    def __init__(self, results, duration, helpers=None):
+        self.results = results
+        self.duration = duration
+        # Statistics of the mount helper processes
+        self.helpers = helpers
+        self.checks = {}
+        for check in CHECKS:
+            own = [x for x in results if x.check == check]
+            # Targets of a check are probed concurrently
+            self.checks[check] = {
+                "healthy": all(x.healthy for x in own),
+                "latency": max([x.latency for x in own] or [0]),
+            }
+        self.healthy = all(x["healthy"] for x in self.checks.values())
+
+    def as_dict(self):
+        return {
+            "healthy": self.healthy,
+            "duration": self.duration,
+            "checks": self.checks,
+            "results": [vars(x) for x in self.results],
+            "helpers": self.helpers,
+        }
+
+    def details(self):
+        return format_details(self.as_dict())
+
+
+def format_details(report):
+    """
+    Formats the --details output of a report as returned by
+    HealthReport.as_dict, locally or by the daemon.
+    """
+    checks = []
+    for check, x in report["checks"].items():
+        info = "%.2fs" % x["latency"]
+        if "age" in x:
+            info += ", %ds ago" % x["age"]
+        if x.get("stale"):
+            info += ", stale"
+        checks.append("%s: %s (%s)" % (check, x["healthy"], info))
+    line = ", ".join(checks)
+    failed = ["%s %s" % (x["check"], x["target"])
+              + (" (%s)" % x["error"] if x["error"] else "")
+              for x in report["results"] if not x["healthy"]]
+    if failed:
+        line += "\nFailed: " + ", ".join(failed)
+    helpers = report.get("helpers") or {}
+    if helpers.get("stuck_now"):
+        line += "\nStuck mount helpers: %d (%s)" % (
+            helpers["stuck_now"], ", ".join(helpers["stuck_paths"]))
+    if report["duration"] is not None:
+        line += "\nTotal: %.2fs" % report["duration"]
+    return line
+
+
+class MountProber:
+    """
+    Supervised pool of helper processes calling statvfs on paths or
+    measuring their I/O performance. At most max_helpers are in use at a
+    time. A helper that doesn't answer within wait seconds is killed and
+    stays in the stuck list until it has exited, which a process in
+    uninterruptible sleep only does once the file system responds again.
+    No new helper is started for a path with a stuck one.
+    """
+
+    def __init__(self, max_helpers=4, wait=5):
+        self.max_helpers = max_helpers
+        self.wait = wait
+        self.lock = threading.Condition()
+        self.idle = []
+        self.busy = 0
+        # Stuck helpers by path
+        self.stuck = collections.defaultdict(list)
+        self.counters = collections.Counter()
+
+    def start_helper(self):
+        with self.lock:
+            self.counters["started"] += 1
+        return subprocess.Popen(
+            [sys.executable, "-c", MOUNT_HELPER,
+             os.path.dirname(os.path.abspath(__file__))],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE, universal_newlines=True)
+
+    def reap(self):
+        """
+        Forgets stuck helpers that have exited. Call with lock held.
+        """
+        for path in list(self.stuck):
+            self.stuck[path] = [x for x in self.stuck[path]
+                                if x.poll() is None]
+            if not self.stuck[path]:
+                del self.stuck[path]
+
+    def acquire(self, path, wait):
+        end = time.time() + wait
+        with self.lock:
+            self.reap()
+            if path in self.stuck:
+                return None
+            while not self.idle and self.busy >= self.max_helpers:
+                if time.time() >= end:
+                    raise OSError("no free helper")
+                self.lock.wait(end - time.time())
+            self.busy += 1
+            helper = self.idle.pop() if self.idle else None
+        return helper or self.start_helper()
+
+    def release(self, helper):
+        with self.lock:
+            self.busy -= 1
+            if helper is not None:
+                self.idle.append(helper)
+            self.lock.notify()
+
+    def probe(self, path, wait=None, op="statvfs", **options):
+        """
+        Returns the statvfs result of path from a helper as dict with the
+        keys mounted, blocks, frsize, bavail and latency, or error. With op
+        "io" the result of measure_io(path, **options) instead.
+        """
+        wait = self.wait if wait is None else wait
+        start = time.time()
+        helper = self.acquire(path, wait)
+        if helper is None:
+            with self.lock:
+                self.counters["skipped"] += 1
+            return {"error": "helper stuck on this path", "latency": 0}
+        request = {"op": op, "path": path, "options": options}
+        try:
+            helper.stdin.write(json.dumps(request) + "\n")
+            helper.stdin.flush()
+            ready, _, _ = select.select(
+                [helper.stdout], [], [], max(wait - (time.time() - start), 0))
+            line = helper.stdout.readline() if ready else None
+        except OSError:
+            line = ""
+        if line:
+            self.release(helper)
+            return json.loads(line)
+        if line == "":
+            # The helper died, a new one is started next time
+            helper.kill()
+            self.release(None)
+            return {"error": "helper died", "latency": time.time() - start}
+        helper.kill()
+        with self.lock:
+            self.stuck[path].append(helper)
+            self.counters["stuck"] += 1
+        self.release(None)
+        return {"error": "timeout", "latency": time.time() - start}
+
+    def stats(self):
+        with self.lock:
+            self.reap()
+            stats = dict(self.counters)
+            stats["idle"] = len(self.idle)
+            stats["busy"] = self.busy
+            stats["stuck_now"] = sum(len(x) for x in self.stuck.values())
+            stats["stuck_paths"] = sorted(self.stuck)
+        return stats
+
+    def close(self):
+        with self.lock:
+            for helper in self.idle:
+                helper.stdin.close()
+                helper.wait()
+            self.idle = []
+
+
+class IOProbe:
+    """
+    Measures sequential and random read and write performance of the file
+    system at a path with measure_io in a helper process of prober, so a
+    hung file system only blocks the helper, which is then tracked as stuck
+    and no more measurements are started on the path until it recovers.
+    Measurements are cached in cache_file and reused for interval seconds.
+    """
+
+    def __init__(self, prober=None, cache_file=IO_CACHE, interval=3600,
+                 size=64 * 1024**2, operations=256, budget=5):
+        self.prober = prober or MountProber()
+        self.cache_file = cache_file
+        self.interval = interval
+        self.size = size
+        self.operations = operations
+        self.budget = budget
+        self.lock = threading.Lock()
+
+    def load(self):
+        try:
+            with open(self.cache_file) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def store(self, path, values):
+        with self.lock:
+            cache = self.load()
+            cache[path] = {"time": time.time(), "values": values}
+            directory = os.path.dirname(self.cache_file)
+            try:
+                fd, name = tempfile.mkstemp(dir=directory)
+                with os.fdopen(fd, "w") as f:
+                    json.dump(cache, f)
+                os.replace(name, self.cache_file)
+            except OSError:
+                # Measured again next time
+                pass
+
+    def probe(self, path):
+        """
+        Returns the cached measurements of path if they are recent enough,
+        measures it otherwise.
+        """
+        entry = self.load().get(path)
+        if entry and time.time() - entry["time"] < self.interval:
+            return entry["values"]
+        values = self.measure(path)
+        self.store(path, values)
+        return values
+
+    def measure(self, path):
+        """
+        Returns the measurements of path from a helper, raises OSError if
+        they failed, so they aren't cached.
+        """
+        # The syncs may take a while longer than the budget
+        result = self.prober.probe(
+            path, self.budget + self.prober.wait, "io", size=self.size,
+            operations=self.operations, budget=self.budget)
+        if "error" in result:
+            raise OSError(result["error"])
+        del result["latency"]
+        return result
+
+
+def measure_io(path, size, operations, budget):
+    """
+    Measures the file system at path with a temporary file of at most size
+    bytes, spending at most budget seconds. The page cache of the file is
+    dropped before reading and writes are synced, so the disk is measured
+    and not memory. Runs in the helpers of MountProber.
+    """
+    values = {}
+    end = time.time() + budget
+    fd, name = tempfile.mkstemp(prefix=".healthcheck-io-", dir=path)
+    try:
+        block = os.urandom(IO_BLOCK_SIZE)
+        start = time.time()
+        written = 0
+        while written < size and time.time() < end:
+            written += os.write(fd, block)
+        os.fsync(fd)
+        values["write_mbps"] = written / 1024**2 / (time.time() - start)
+
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+        os.lseek(fd, 0, os.SEEK_SET)
+        start = time.time()
+        read = 0
+        while read < written and time.time() < end:
+            chunk = os.read(fd, IO_BLOCK_SIZE)
+            if not chunk:
+                break
+            read += len(chunk)
+        values["read_mbps"] = read / 1024**2 / (time.time() - start)
+
+        # No readahead, every random read goes to the disk
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_RANDOM)
+        pages = max(written // IO_PAGE_SIZE, 1)
+        page = block[:IO_PAGE_SIZE]
+        for kind in ["rand_read", "rand_write"]:
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+            count = 0
+            start = time.time()
+            while count < operations and time.time() < end:
+                offset = random.randrange(pages) * IO_PAGE_SIZE
+                if kind == "rand_read":
+                    os.pread(fd, IO_PAGE_SIZE, offset)
+                else:
+                    os.pwrite(fd, page, offset)
+                count += 1
+            if kind == "rand_write":
+                os.fdatasync(fd)
+            duration = time.time() - start
+            if count and duration:
+                values[kind + "_iops"] = count / duration
+                values[kind + "_latency_ms"] = 1000 * duration / count
+    finally:
+        os.close(fd)
+        os.unlink(name)
+    return values
+
+
+def io_name(path):
+    """
+    Attribute prefix of a path, e.g. Share for /data/share.
+    """
+    parts = re.split(r"[^A-Za-z0-9]+", os.path.basename(path.rstrip("/")))
+    return "".join(x.capitalize() for x in parts) or "Root"
+
+
+def format_attributes(report):
+    """
+    Returns the I/O measurements of a report as startd cron attributes.
+    """
+    lines = []
+    for x in report["results"]:
+        if x["check"] != IO or "name" not in x["values"]:
+            continue
+        for key, attribute in IO_ATTRIBUTES:
+            if key in x["values"]:
+                lines.append("%s%s = %.2f" % (
+                    x["values"]["name"], attribute, x["values"][key]))
+    return lines
+
+
+def escape_tag(value):
+    """
+    Escapes a tag key or value for Influx line protocol.
+    """
+    for char in "\\, =":
+        value = value.replace(char, "\\" + char)
+    return value
+
+
+def format_fields(fields):
+    items = []
+    for key, value in fields.items():
+        if value is None:
+            continue
+        if isinstance(value, str):
+            value = value.replace("\\", "\\\\").replace('"', '\\"')
+            items.append('%s="%s"' % (key, value))
+        elif isinstance(value, bool):
+            items.append("%s=%s" % (key, "true" if value else "false"))
+        elif isinstance(value, int):
+            items.append("%s=%di" % (key, value))
+        else:
+            items.append("%s=%r" % (key, float(value)))
+    return ",".join(items)
 
-from timeout import (TimeoutException,
-                     timeout)
+
+def format_metrics(report, timestamp=None):
+    """
+    Returns the results of a report, as returned by HealthReport.as_dict,
+    as lines of Influx line protocol: one line per target with its latency
+    and values (RTT and loss, statvfs latency and free percentage) and a
+    summary line with the total duration.
+    """
+    timestamp = int((timestamp or time.time()) * 1e9)
+    lines = []
+    for x in report["results"]:
+        measurement, tag = MEASUREMENTS[x["check"]]
+        fields = {"healthy": x["healthy"], "latency": x["latency"]}
+        fields.update(x["values"])
+        lines.append("%s,%s=%s %s %d" % (
+            measurement, tag, escape_tag(x["target"]),
+            format_fields(fields), timestamp))
+    helpers = report.get("helpers") or {}
+    summary = {
+        "healthy": report["healthy"],
+        "duration": report["duration"],
+        "stuck_helpers": helpers.get("stuck_now"),
+    }
+    for check, x in report["checks"].items():
+        summary[MEASUREMENTS[check][0].split("_", 1)[1]] = x["healthy"]
+    lines.append("healthcheck %s %d" % (format_fields(summary), timestamp))
+    return lines
+
+
+def send_metrics(lines, address):
+    """
+    Sends lines to a socket listener, address is udp://host:port,
+    tcp://host:port, unix:///path or unixgram:///path.
+    """
+    scheme, _, location = address.partition("://")
+    data = "".join(line + "\n" for line in lines).encode()
+    if scheme in ("unix", "unixgram"):
+        kind = socket.SOCK_STREAM if scheme == "unix" else socket.SOCK_DGRAM
+        family, location = socket.AF_UNIX, location
+    elif scheme in ("tcp", "udp"):
+        kind = socket.SOCK_STREAM if scheme == "tcp" else socket.SOCK_DGRAM
+        host, port = split_target(location)
+        if port is None:
+            raise ValueError("No port in %s" % address)
+        family, _, _, _, location = socket.getaddrinfo(host, port,
+                                                       type=kind)[0]
+    else:
+        raise ValueError("Unsupported metrics address %s" % address)
+    with socket.socket(family, kind) as sock:
+        sock.settimeout(5)
+        sock.connect(location)
+        if kind == socket.SOCK_DGRAM:
+            # One datagram per line, they must fit into a packet
+            for line in lines:
+                sock.send(line.encode() + b"\n")
+        else:
+            sock.sendall(data)
 
 
 class HealthChecker:
+    def __init__(self, max_workers=8, prober=None, mount_prober=None,
+                 io_probe=None):
+        self.max_workers = max_workers
+        self.prober = prober or NetworkProber()
+        self.mount_prober = mount_prober or MountProber()
+        self.io_probe = io_probe or IOProbe(self.mount_prober)
+
+    def ping(self, ip):
+        """
+        Checks if ip is reachable.
+        """
+        return self.check_network([ip])
+
+    def probe_network(self, ip_addresses):
+        """
+        Probes all addresses at once, returns a CheckResult for each.
+        """
+        probes = self.prober.probe(ip_addresses)
+        return [CheckResult(NETWORK, ip, x.healthy, x.duration, x.error,
+                            {"rtt": x.rtt, "loss": x.loss})
+                for ip, x in probes.items()]
+
     def check_network(self, ip_addresses):
         """
         Checks for a given list of ip-addresses if they are reachable.
         """
-        reachable = True
+        return all(x.healthy for x in self.probe_network(ip_addresses))
 
-        for ip in ip_addresses:
-            # Use normal call of "ping" to check reachability
-            with open(os.devnull, 'w') as devnull:
-                try:
-                    subprocess.check_call(
-                        ["ping", "-c", "1", "-W", "2", ip],
-                        stdout=devnull,  # suppress output
-                        stderr=devnull
-                    )
-                except subprocess.CalledProcessError:
-                    reachable = False
+    def probe_mount(self, check, path, min_percent=0, wait=None):
+        """
+        Checks if at least min_percent are still available at path, and
+        for the mounts check that path is a mount point, in a helper
+        process. Returns a CheckResult.
+        """
+        start = time.time()
+        probe = self.mount_prober.probe(path, wait)
+        values = {"statvfs_latency": probe["latency"]}
+        if "error" in probe:
+            return CheckResult(check, path, False, time.time() - start,
+                               probe["error"], values)
+        disk_capacity = probe["blocks"] * probe["frsize"]
+        free = probe["bavail"] * probe["frsize"]
+        if disk_capacity:
+            values["free_percent"] = 100 * free / disk_capacity
+        free_percentage = 100 - (free / (disk_capacity / 100)) \
+            if disk_capacity else 0
+        healthy = free_percentage >= min_percent
+        error = None
+        if check == MOUNTS and not probe["mounted"]:
+            healthy, error = False, "not mounted"
+        return CheckResult(check, path, healthy, time.time() - start, error,
+                           values)
 
-        return reachable
+    def check_mount(self, mount):
+        """
+        Checks if mount is mounted and responsive.
+        """
+        return self.probe_mount(MOUNTS, mount).healthy
 
     def check_mount_points(self, mount_points):
         """
@@ -70,22 +810,34 @@ class HealthChecker:
         satisfied = True
 
         for path, min_percent in paths:
-            # Use timeout as a hard-mounted disk may still be mounted
-            # while not responding, which could cause a infinite wait
-            try:
-                # Calculate available disk space using statvfs
-                stat = timeout(max_wait)(os.statvfs)(path)
-                disk_capacity = stat.f_blocks * stat.f_frsize
-                free = stat.f_bavail * stat.f_frsize
-                free_percentage = 100 - (free / (disk_capacity / 100))
+            # A hard-mounted disk may still be mounted while not responding,
+            # which could cause a infinite wait, the helper takes it
+            satisfied = satisfied and self.probe_mount(
+                DISK_SPACE, path, min_percent, max_wait).healthy
 
-                if free_percentage < min_percent:
-                    satisfied = False
+        return satisfied
 
-            except (OSError, TimeoutException):
-                satisfied = False
+    def check_space(self, path, min_percent):
+        """
+        Checks if at least min_percent are still available at path.
+        """
+        return self.probe_mount(DISK_SPACE, path, min_percent).healthy
 
-        return satisfied
+    def probe_io(self, path, name=None, min_mbps=0, min_iops=0):
+        """
+        Checks if sequential reads and writes at path reach min_mbps and
+        random ones min_iops. Returns a CheckResult.
+        """
+        start = time.time()
+        values = dict(self.io_probe.probe(path))
+        values["name"] = name or io_name(path)
+        slow = ["%s %.1f" % (key, values[key]) for key, minimum in [
+            ("write_mbps", min_mbps), ("read_mbps", min_mbps),
+            ("rand_write_iops", min_iops), ("rand_read_iops", min_iops),
+        ] if values.get(key, 0) < minimum]
+        error = "too slow: " + ", ".join(slow) if slow else None
+        return CheckResult(IO, path, not slow, time.time() - start, error,
+                           values)
 
     def check_env(self, env_variables):
         """
@@ -98,54 +850,322 @@ class HealthChecker:
 
         return env_set
 
+    def run_checks(self, ip_addresses=(), mount_points=(), space_checks=(),
+                   env_variables=(), deadline=10, io_checks=()):
+        """
+        Runs all checks concurrently on a pool of at most max_workers threads,
+        every mount point, path and variable as a check of its own, all
+        addresses together in one event loop. io_checks are tuples of the
+        arguments of probe_io.
+        Checks that didn't finish within deadline seconds count as failed.
+        Returns a HealthReport.
+        """
+        # Functions of tasks with several targets return a list of
+        # CheckResult, the others whether their target is healthy
+        tasks = []
+        if ip_addresses:
+            tasks.append((NETWORK, list(ip_addresses), self.probe_network,
+                          (ip_addresses,)))
+        tasks += [(MOUNTS, [mount], self.probe_mount, (MOUNTS, mount))
+                  for mount in mount_points]
+        tasks += [(DISK_SPACE, [path], self.probe_mount,
+                   (DISK_SPACE, path, min_percent))
+                  for path, min_percent in space_checks]
+        tasks += [(IO, [x[0]], self.probe_io, tuple(x)) for x in io_checks]
+        tasks += [(ENV, [env], self.check_env, ([env],))
+                  for env in env_variables]
+
+        start = time.time()
+        end = start + deadline
+        pending = queue.Queue()
+        for index, task in enumerate(tasks):
+            pending.put((index, task))
+        results = {}
+        finished = threading.Condition()
+
+        def work():
+            # Don't start checks once the deadline has passed
+            while time.time() < end:
+                try:
+                    index, (check, targets, function, args) = \
+                        pending.get_nowait()
+                except queue.Empty:
+                    return
+                began = time.time()
+                try:
+                    outcome = function(*args)
+                except Exception as e:
+                    outcome = [CheckResult(check, x, False,
+                                           time.time() - began, str(e))
+                               for x in targets]
+                if isinstance(outcome, CheckResult):
+                    outcome = [outcome]
+                if not isinstance(outcome, list):
+                    outcome = [CheckResult(check, targets[0], bool(outcome),
+                                           time.time() - began)]
+                with finished:
+                    results[index] = outcome
+                    finished.notify()
+
+        for _ in range(min(self.max_workers, len(tasks))):
+            # Daemon threads, a check hanging on a dead mount must not keep
+            # the process alive
+            worker = threading.Thread(target=work)
+            worker.daemon = True
+            worker.start()
+
+        with finished:
+            while len(results) < len(tasks) and time.time() < end:
+                finished.wait(end - time.time())
+            for index, (check, targets, _, _) in enumerate(tasks):
+                if index not in results:
+                    results[index] = [
+                        CheckResult(check, x, False, deadline, "timeout")
+                        for x in targets]
+            results = [x for index in range(len(tasks))
+                       for x in results[index]]
+
+        return HealthReport(results, time.time() - start,
+                            self.mount_prober.stats())
+
+
+class HealthDaemon:
+    """
+    Keeps the results of the checks up to date, every check refreshed in its
+    own thread on its own interval, and serves them on a Unix socket.
+    """
+
+    def __init__(self, checker, targets, intervals, deadline=10):
+        # Arguments of run_checks and refresh interval by check
+        self.checker = checker
+        self.targets = targets
+        self.intervals = intervals
+        self.deadline = deadline
+        self.lock = threading.Lock()
+        self.results = {}
+        self.updated = {}
+        self.durations = {}
+        self.stop = threading.Event()
+
+    def refresh(self, check):
+        report = self.checker.run_checks(deadline=self.deadline,
+                                         **self.targets[check])
+        with self.lock:
+            self.results[check] = [
+                x for x in report.results if x.check == check]
+            self.updated[check] = time.time()
+            self.durations[check] = report.duration
+
+    def refresh_loop(self, check):
+        while not self.stop.wait(self.intervals[check]):
+            self.refresh(check)
+
+    def report(self):
+        """
+        Returns the cached results like HealthReport.as_dict, with the age
+        of every check. A check that missed two refreshes is stale and
+        counts as failed.
+        """
+        with self.lock:
+            results = [x for check in CHECKS
+                       for x in self.results.get(check, [])]
+            updated = dict(self.updated)
+            # The checks are refreshed concurrently
+            duration = max(self.durations.values(), default=None)
+        report = HealthReport(results, duration,
+                              self.checker.mount_prober.stats()).as_dict()
+        now = time.time()
+        for check, x in report["checks"].items():
+            if check not in updated:
+                continue
+            x["age"] = now - updated[check]
+            x["stale"] = \
+                x["age"] > 2 * self.intervals[check] + self.deadline
+            x["healthy"] = x["healthy"] and not x["stale"]
+        report["healthy"] = all(
+            x["healthy"] for x in report["checks"].values())
+        return report
+
+    def serve(self, socket_path=SOCKET_PATH):
+        # Checked once before serving, so there are never no results
+        for check in self.targets:
+            self.refresh(check)
+        for check in self.targets:
+            thread = threading.Thread(target=self.refresh_loop, args=(check,))
+            thread.daemon = True
+            thread.start()
+
+        daemon = self
+
+        class Handler(socketserver.BaseRequestHandler):
+            def handle(self):
+                self.request.sendall(
+                    json.dumps(daemon.report()).encode() + b"\n")
+
+        if os.path.exists(socket_path):
+            os.unlink(socket_path)
+        server = socketserver.ThreadingUnixStreamServer(socket_path, Handler)
+        server.daemon_threads = True
+        # Read-only results, any local user may query them
+        os.chmod(socket_path, 0o666)
+
+        def shutdown(sig, frame):
+            self.stop.set()
+            threading.Thread(target=server.shutdown).start()
+
+        signal.signal(signal.SIGTERM, shutdown)
+        signal.signal(signal.SIGINT, shutdown)
+        try:
+            server.serve_forever()
+        finally:
+            server.server_close()
+            os.unlink(socket_path)
+
+
+def query(socket_path=SOCKET_PATH, wait=2):
+    """
+    Returns the cached report of a running HealthDaemon.
+    """
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    client.settimeout(wait)
+    try:
+        client.connect(socket_path)
+        data = b""
+        for chunk in iter(lambda: client.recv(65536), b""):
+            data += chunk
+    finally:
+        client.close()
+    return json.loads(data)
+
 
 if __name__ == "__main__":
-    hc = HealthChecker()
-    details = False
-
-    # Parse arguments if given or use default-checks instead
-    if len(sys.argv) > 1:
-        parser = argparse.ArgumentParser()
-        parser.add_argument("--ip_addresses", nargs="+", type=str,
-                            help="1.1.1.1 8.8.8.8")
-        parser.add_argument("--mount_points", nargs="+", type=str,
-                            help="/ /mount")
-        parser.add_argument("--space_checks", nargs="+", type=str,
-                            help="/,10 /mount,50")
-        parser.add_argument("--env_variables", nargs="+", type=str,
-                            help="ENV1 ENV2")
-        parser.add_argument("--details", action='store_true')
-        args = parser.parse_args()
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--ip_addresses", nargs="+", type=str,
+                        help="1.1.1.1 8.8.8.8 host:443")
+    parser.add_argument("--mount_points", nargs="+", type=str,
+                        help="/ /mount")
+    parser.add_argument("--space_checks", nargs="+", type=str,
+                        help="/,10 /mount,50")
+    parser.add_argument("--env_variables", nargs="+", type=str,
+                        help="ENV1 ENV2")
+    parser.add_argument("--io_checks", nargs="+", type=str,
+                        help="/scratch,Scratch,100,200 "
+                             "(path,name,min MB/s,min IOPS)")
+    parser.add_argument("--io_interval", type=float, default=3600,
+                        help="seconds to reuse I/O measurements")
+    parser.add_argument("--io_cache", type=str, default=IO_CACHE)
+    parser.add_argument("--details", action='store_true')
+    parser.add_argument("--deadline", type=float, default=10,
+                        help="seconds until unfinished checks fail")
+    parser.add_argument("--workers", type=int, default=8,
+                        help="checks running at the same time")
+    parser.add_argument("--ping_count", type=int, default=3,
+                        help="probes sent to each address")
+    parser.add_argument("--ping_wait", type=float, default=2,
+                        help="seconds to wait for each reply")
+    parser.add_argument("--serve", action='store_true',
+                        help="run as daemon serving cached results")
+    parser.add_argument("--query", action='store_true',
+                        help="print the results of a running daemon")
+    parser.add_argument("--socket", type=str, default=SOCKET_PATH)
+    parser.add_argument("--json", action='store_true',
+                        help="print the whole report as JSON")
+    parser.add_argument("--metrics", action='store_true',
+                        help="print Influx line protocol")
+    parser.add_argument("--metrics_socket", type=str,
+                        help="send the metrics to udp://127.0.0.1:8094 "
+                             "(or tcp://, unix://, unixgram://) instead")
+    parser.add_argument("--interval", type=float, default=60,
+                        help="seconds between refreshes of the daemon")
+    parser.add_argument("--network_interval", type=float)
+    parser.add_argument("--mount_interval", type=float)
+    parser.add_argument("--space_interval", type=float)
+    parser.add_argument("--env_interval", type=float)
+    args = parser.parse_args()
 
+    # Use default-checks if no checks are given
+    if (args.ip_addresses or args.mount_points or args.space_checks
+            or args.env_variables or args.io_checks):
         ip_addresses = args.ip_addresses or []
         mount_points = args.mount_points or []
         env_variables = args.env_variables or []
-        details = args.details
 
         # Manually parse space_checks
         space_checks = []
         for check in args.space_checks or []:
             path, space = check.split(",")
             space_checks.append((path, int(space)))
+
+        io_checks = []
+        for check in args.io_checks or []:
+            path, *rest = check.split(",")
+            name = rest[0] if rest else None
+            thresholds = [float(x) for x in rest[1:3]]
+            io_checks.append((path, name, *thresholds))
     else:
         ip_addresses = ["1.1.1.1"]
         mount_points = ["/data", "/cvmfs"]
         space_checks = [("/data/share", 20)]
         env_variables = []
+        io_checks = []
+
+    mount_prober = MountProber()
+    hc = HealthChecker(args.workers,
+                       NetworkProber(args.ping_count, wait=args.ping_wait),
+                       mount_prober,
+                       IOProbe(mount_prober, args.io_cache, args.io_interval))
+
+    if args.serve:
+        targets = {
+            NETWORK: {"ip_addresses": ip_addresses},
+            MOUNTS: {"mount_points": mount_points},
+            DISK_SPACE: {"space_checks": space_checks},
+            IO: {"io_checks": io_checks},
+            ENV: {"env_variables": env_variables},
+        }
+        intervals = {
+            NETWORK: args.network_interval or args.interval,
+            MOUNTS: args.mount_interval or args.interval,
+            DISK_SPACE: args.space_interval or args.interval,
+            IO: args.io_interval,
+            ENV: args.env_interval or args.interval,
+        }
+        HealthDaemon(hc, {k: v for k, v in targets.items()
+                          if list(v.values())[0]},
+                     intervals, args.deadline).serve(args.socket)
+        sys.exit(0)
+
+    report = None
+    if args.query:
+        try:
+            report = query(args.socket)
+        except (OSError, ValueError):
+            # No daemon running, check directly
+            pass
+    if report is None:
+        report = hc.run_checks(ip_addresses, mount_points, space_checks,
+                               env_variables, args.deadline,
+                               io_checks).as_dict()
+
+    if args.metrics:
+        lines = format_metrics(report)
+        if args.metrics_socket:
+            send_metrics(lines, args.metrics_socket)
+        else:
+            print("\n".join(lines))
+        sys.exit(0 if report["healthy"] else 1)
 
-    network_health = hc.check_network(ip_addresses)
-    mount_health = hc.check_mount_points(mount_points)
-    disk_space_health = hc.check_disk_space(space_checks)
-    env_health = hc.check_env(env_variables)
+    if args.json:
+        print(json.dumps(report))
+        sys.exit(0 if report["healthy"] else 1)
 
-    healthy = network_health and mount_health and disk_space_health \
-        and env_health
+    print("NODE_IS_HEALTHY = " + str(report["healthy"]))
 
-    print("NODE_IS_HEALTHY = " + str(healthy))
+    for line in format_attributes(report):
+        print(line)
 
-    if details:
-        print("Network: %s, Mounts: %s, Disk Space: %s, Env. Variables: %s" %
-              (network_health, mount_health, disk_space_health, env_health))
+    if args.details:
+        print(format_details(report))
 
-    if not healthy:
+    if not report["healthy"]:
         exit(1)
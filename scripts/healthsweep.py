@@ -0,0 +1,194 @@
+# Script for checking the health of many servers at once.
+#
+# Runs healthcheck.py, installed to /usr/local/bin by the workers playbook,
+# on every host over SSH, at most --parallel hosts at a time and each within
+# --deadline seconds. The remote command queries the healthcheck daemon of
+# the node if one runs, and checks directly otherwise.
+# SSH connections are multiplexed (ControlMaster) and kept open for a while,
+# so repeated sweeps don't pay for the SSH handshakes again.
+# Every host's result is printed as a JSON line as soon as it is known,
+# followed by a summary line of the unhealthy hosts by failing check. Hosts
+# that can't be reached in time count as "unreachable", hosts answering with
+# something else than a report as "bad_report".
+#
+# Example for command-line usage:
+# python3 healthsweep.py --hosts_file workers.txt --user centos \
+#                        --parallel 64 --deadline 30 > sweep.jsonl
+#
+# With --local the command runs on this machine for every host instead,
+# "{host}" in the command is replaced by the host name, e.g. to try the
+# sweep with stand-in hosts:
+# python3 healthsweep.py --local --hosts node1 node2 \
+#     --remote_command "python3 healthcheck.py --json --mount_points /{host}"
+
+import argparse
+import asyncio
+import collections
+import json
+import os
+import signal
+import sys
+import tempfile
+import time
+
+REMOTE_COMMAND = "python3 /usr/local/bin/healthcheck.py --query --json"
+
+# Keeps the multiplexed SSH connections open between sweeps
+CONTROL_PERSIST = 600
+
+
+class HealthSweep:
+    """
+    Runs a health check command on many hosts concurrently.
+    """
+
+    def __init__(self, command=REMOTE_COMMAND, parallel=32, deadline=30,
+                 user=None, ssh="ssh", control_dir=None, local=False):
+        self.command = command
+        self.parallel = parallel
+        self.deadline = deadline
+        self.user = user
+        self.ssh = ssh
+        self.control_dir = control_dir or os.path.join(
+            tempfile.gettempdir(), "healthsweep-%d" % os.getuid())
+        self.local = local
+
+    def ssh_command(self, host, command):
+        destination = "%s@%s" % (self.user, host) if self.user else host
+        return [
+            self.ssh,
+            "-o", "BatchMode=yes",
+            "-o", "ConnectTimeout=%d" % max(self.deadline // 2, 1),
+            "-o", "ControlMaster=auto",
+            "-o", "ControlPath=%s" % os.path.join(self.control_dir, "%C"),
+            "-o", "ControlPersist=%d" % CONTROL_PERSIST,
+            destination, command,
+        ]
+
+    async def check_host(self, host, slots):
+        """
+        Returns the result of checking host as dict.
+        """
+        result = {"host": host, "healthy": False}
+        command = self.command.replace("{host}", host)
+        async with slots:
+            start = time.time()
+            try:
+                if self.local:
+                    process = await asyncio.create_subprocess_shell(
+                        command, stdout=asyncio.subprocess.PIPE,
+                        stderr=asyncio.subprocess.PIPE,
+                        start_new_session=True)
+                else:
+                    process = await asyncio.create_subprocess_exec(
+                        *self.ssh_command(host, command),
+                        stdout=asyncio.subprocess.PIPE,
+                        stderr=asyncio.subprocess.PIPE,
+                        start_new_session=True)
+            except OSError as e:
+                result["error"] = str(e)
+                return result
+            try:
+                output, stderr = await asyncio.wait_for(
+                    process.communicate(), self.deadline)
+            except asyncio.TimeoutError:
+                # Children of the command would keep its output open
+                os.killpg(process.pid, signal.SIGKILL)
+                await process.wait()
+                result["error"] = "timeout"
+                result["duration"] = time.time() - start
+                return result
+            result["duration"] = time.time() - start
+        try:
+            report = json.loads(output)
+        except ValueError:
+            # ssh exits with 255 on connection errors
+            lines = stderr.decode(errors="replace").strip().splitlines()
+            result["error"] = "exit %d: %s" % (
+                process.returncode, lines[-1] if lines else "no report")
+            return result
+        if not (isinstance(report, dict)
+                and isinstance(report.get("checks"), dict)):
+            # Some other JSON, e.g. from a wrong command
+            result["error"] = "bad report"
+            result["failed"] = ["bad_report"]
+            return result
+        result["healthy"] = report.get("healthy") is True
+        result["failed"] = [check for check, x in report["checks"].items()
+                            if not (isinstance(x, dict) and x.get("healthy"))]
+        result["report"] = report
+        return result
+
+    async def sweep(self, hosts, out=sys.stdout):
+        """
+        Checks all hosts, writes every result to out as a JSON line once it
+        is known. Returns the summary.
+        """
+        os.makedirs(self.control_dir, mode=0o700, exist_ok=True)
+        slots = asyncio.Semaphore(self.parallel)
+        start = time.time()
+        by_check = collections.defaultdict(list)
+        healthy = 0
+        tasks = [asyncio.ensure_future(self.check_host(host, slots))
+                 for host in hosts]
+        for task in asyncio.as_completed(tasks):
+            result = await task
+            out.write(json.dumps(result) + "\n")
+            out.flush()
+            if result["healthy"]:
+                healthy += 1
+            else:
+                for check in result.get("failed", ["unreachable"]):
+                    by_check[check].append(result["host"])
+        return {
+            "hosts": len(hosts),
+            "healthy": healthy,
+            "unhealthy": len(hosts) - healthy,
+            "by_check": {check: sorted(x) for check, x in by_check.items()},
+            "duration": time.time() - start,
+        }
+
+
+def read_hosts(path):
+    with open(path) as f:
+        lines = [line.split("#", 1)[0].strip() for line in f]
+    return [line for line in lines if line]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--hosts", nargs="+", type=str, default=[],
+                        help="node1 node2")
+    parser.add_argument("--hosts_file", type=str,
+                        help="file with one host per line")
+    parser.add_argument("--user", type=str)
+    parser.add_argument("--parallel", type=int, default=32,
+                        help="hosts checked at the same time")
+    parser.add_argument("--deadline", type=int, default=30,
+                        help="seconds until a host counts as unreachable")
+    parser.add_argument("--remote_command", type=str, default=REMOTE_COMMAND)
+    parser.add_argument("--ssh", type=str, default="ssh")
+    parser.add_argument("--control_dir", type=str,
+                        help="directory of the SSH control sockets")
+    parser.add_argument("--local", action='store_true',
+                        help="run the command locally for every host")
+    args = parser.parse_args()
+
+    hosts = args.hosts + (read_hosts(args.hosts_file)
+                          if args.hosts_file else [])
+    if not hosts:
+        parser.error("no hosts given")
+
+    sweep = HealthSweep(args.remote_command, args.parallel, args.deadline,
+                        args.user, args.ssh, args.control_dir, args.local)
+    summary = asyncio.run(sweep.sweep(hosts))
+    print(json.dumps({"summary": summary}))
+
+    sys.stderr.write("%d of %d hosts healthy in %.1fs\n" % (
+        summary["healthy"], summary["hosts"], summary["duration"]))
+    for check, failed in sorted(summary["by_check"].items()):
+        sys.stderr.write("%s: %d (%s)\n" % (
+            check, len(failed), ", ".join(failed)))
+
+    if summary["unhealthy"]:
+        exit(1)
@@ -3,10 +3,12 @@
 # Licensed under Simplified BSD License (see LICENSE)
 # https://programtalk.com/vs2/?source=python/2899/dd-agent/utils/timeout.py
 
+import asyncio
+import collections
+import concurrent.futures
 import functools
-from threading import Thread
-
-_thread_by_func = {}
+import queue
+import threading
 
 
 class TimeoutException(Exception):
@@ -16,37 +18,215 @@ class TimeoutException(Exception):
     pass
 
 
-class ThreadMethod(Thread):
+class TimeoutExecutor:
     """
-    Descendant of `Thread` class.
-
-    Run the specified target method with the specified arguments.
-    Store result and exceptions.
+    Runs calls with a time limit on a bounded pool of daemon worker threads,
+    which are started on demand and reused.
 
-    From: https://code.activestate.com/recipes/440569/
+    A call that times out keeps running in its worker, which is stuck until
+    it returns. It is replaced by a new worker as long as fewer than
+    max_stuck workers are stuck, a recovered worker rejoins the pool or
+    exits if the pool is full again. Timed-out calls are tracked in a
+    registry of at most max_tracked entries, the oldest are evicted first.
+    Calling the same function with the same (hashable) arguments again while
+    it is still stuck waits for that call instead of starting another one.
+    Every call gets an idle worker or a new one; only when max_workers are
+    busy it waits for one, which counts against its time limit.
     """
 
-    def __init__(self, target, args, kwargs):
-        Thread.__init__(self)
-        self.setDaemon(True)
-        self.target, self.args, self.kwargs = target, args, kwargs
-        self.start()
+    def __init__(self, max_workers=8, max_stuck=8, max_tracked=128):
+        self.max_workers = max_workers
+        self.max_stuck = max_stuck
+        self.max_tracked = max_tracked
+        self.tasks = queue.Queue()
+        self.lock = threading.Lock()
+        # Workers that aren't stuck, and how many of them wait for tasks
+        # without a task submitted for them
+        self.active = 0
+        self.idle = 0
+        # Tasks submitted while all workers were busy
+        self.backlog = 0
+        self.stuck = 0
+        # Timed-out calls still running, by call key
+        self.registry = collections.OrderedDict()
+        self.counters = collections.Counter()
 
-    def run(self):
-        try:
-            self.result = self.target(*self.args, **self.kwargs)
-        except Exception as e:
-            self.exception = e
+    def start_worker(self, assigned=False):
+        """
+        Starts a worker if the pool isn't full and not too many workers are
+        stuck, returns whether it was started. An assigned worker takes the
+        task submitted next instead of becoming idle. Call with lock held.
+        """
+        if self.active >= self.max_workers or \
+                self.active + self.stuck >= self.max_workers + self.max_stuck:
+            return False
+        self.active += 1
+        worker = threading.Thread(target=self.work, args=(assigned,))
+        worker.daemon = True
+        worker.start()
+        return True
+
+    def ready(self):
+        """
+        Takes a task from the backlog or becomes idle. Call with lock held.
+        """
+        if self.backlog:
+            self.backlog -= 1
         else:
-            self.exception = None
+            self.idle += 1
+
+    def work(self, assigned):
+        if not assigned:
+            with self.lock:
+                self.ready()
+        while True:
+            future, func, args, kwargs = self.tasks.get()
+            # Calls that timed out while waiting in the queue are cancelled
+            ran = future.set_running_or_notify_cancel()
+            if ran:
+                try:
+                    result = func(*args, **kwargs)
+                except BaseException as e:
+                    future.set_exception(e)
+                else:
+                    future.set_result(result)
+            with self.lock:
+                if ran:
+                    self.counters["completed"] += 1
+                if future.stuck:
+                    self.stuck -= 1
+                    self.counters["recovered"] += 1
+                    if self.active >= self.max_workers:
+                        return
+                    self.active += 1
+                self.ready()
+
+    def submit(self, func, *args, **kwargs):
+        """
+        Runs func(*args, **kwargs) on the pool, returns a
+        concurrent.futures.Future.
+        """
+        future = concurrent.futures.Future()
+        future.stuck = False
+        with self.lock:
+            self.counters["started"] += 1
+            # Reserve a worker, so concurrent calls don't count on the same
+            if self.idle:
+                self.idle -= 1
+            elif not self.start_worker(assigned=True):
+                self.backlog += 1
+            self.tasks.put((future, func, args, kwargs))
+        return future
+
+    @staticmethod
+    def key(func, args, kwargs):
+        key = (func, args, tuple(sorted(kwargs.items())))
+        try:
+            hash(key)
+        except TypeError:
+            return None
+        return key
+
+    def start(self, func, args, kwargs):
+        """
+        Returns the key and future of a call, joining a stuck identical call.
+        """
+        key = self.key(func, args, kwargs)
+        with self.lock:
+            future = self.registry.get(key) if key is not None else None
+        return key, future or self.submit(func, *args, **kwargs)
+
+    def timed_out(self, key, future):
+        """
+        Records a call that didn't finish in time.
+        """
+        with self.lock:
+            self.counters["timed_out"] += 1
+            if future.cancel() or future.done():
+                return
+            if not future.stuck:
+                future.stuck = True
+                self.stuck += 1
+                self.active -= 1
+                self.start_worker()
+            if key is None:
+                return
+            self.registry[key] = future
+            self.registry.move_to_end(key)
+            while len(self.registry) > self.max_tracked:
+                self.registry.popitem(last=False)
+                self.counters["evicted"] += 1
+        future.add_done_callback(functools.partial(self.forget, key))
+
+    def forget(self, key, future):
+        with self.lock:
+            if self.registry.get(key) is future:
+                del self.registry[key]
+
+    def call(self, seconds, func, *args, **kwargs):
+        """
+        Returns func(*args, **kwargs), raises TimeoutException if it takes
+        longer than seconds.
+        """
+        key, future = self.start(func, args, kwargs)
+        try:
+            return future.result(seconds)
+        except concurrent.futures.TimeoutError:
+            self.timed_out(key, future)
+            raise TimeoutException()
+
+    async def call_async(self, seconds, func, *args, **kwargs):
+        """
+        Like call, for coroutines: awaits func(*args, **kwargs) running on
+        the pool without blocking the event loop.
+        """
+        key, future = self.start(func, args, kwargs)
+        try:
+            return await asyncio.wait_for(
+                asyncio.shield(asyncio.wrap_future(future)), seconds)
+        except asyncio.TimeoutError:
+            self.timed_out(key, future)
+            raise TimeoutException()
+
+    def stats(self):
+        """
+        Returns the counters of started, completed and timed-out calls and
+        the current number of workers and stuck calls.
+        """
+        with self.lock:
+            stats = dict(self.counters)
+            stats.update({
+                "workers": self.active,
+                "idle": self.idle,
+                "backlog": self.backlog,
+                "stuck": self.stuck,
+                "tracked": len(self.registry),
+            })
+        return stats
+
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_executor():
+    """
+    Returns the executor shared by the timeout decorators.
+    """
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = TimeoutExecutor()
+        return _executor
 
 
 def timeout(timeout):
     """
-    A decorator to timeout a function. Decorated method calls are executed in
-    a separate new thread with a specified timeout.
-    Also check if a thread for the same function already exists before
-    creating a new one.
+    A decorator to timeout a function. Decorated method calls are executed
+    on the pool of worker threads of the shared TimeoutExecutor with a
+    specified timeout.
+    Also check if a call of the same function with the same arguments is
+    still running before starting a new one.
 
     Note: Compatible with Windows (thread based).
     """
@@ -54,26 +234,24 @@ def timeout(timeout):
     def decorator(func):
         @functools.wraps(func)
         def wrapper(*args, **kwargs):
-            key = "{0}:{1}:{2}:{3}".format(id(func), func.__name__, args,
-                                           kwargs)
-
-            if key in _thread_by_func:
-                # A thread for the same function already exists.
-                worker = _thread_by_func[key]
-            else:
-                worker = ThreadMethod(func, args, kwargs)
-                _thread_by_func[key] = worker
-
-            worker.join(timeout)
-            if worker.is_alive():
-                raise TimeoutException()
-
-            del _thread_by_func[key]
-
-            if worker.exception:
-                raise worker.exception
-            else:
-                return worker.result
+            return get_executor().call(timeout, func, *args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def async_timeout(timeout):
+    """
+    Like timeout, but the decorated (blocking) function becomes a coroutine
+    function, to be awaited from asyncio code.
+    """
+
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            return await get_executor().call_async(
+                timeout, func, *args, **kwargs)
 
         return wrapper
 
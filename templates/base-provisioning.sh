@@ -0,0 +1,15 @@
+#!/bin/sh -e
+# Prepares the freshly installed system for the Ansible provisioner.
+# Runs as part of the base layer, see the shell provisioner in build.pkr.hcl.
+usermod -u 99 $(id -nu 999 )
+groupmod -g 99 $(getent group 999 | cut -d: -f1)
+if getent passwd 990 >/dev/null; then usermod -u 98 $(getent passwd 990 | cut -d: -f1); fi
+if getent group 989 >/dev/null; then groupmod -g 98 $(getent group 989 | cut -d: -f1); fi
+getent group cvmfs >/dev/null || groupadd -g 989 cvmfs
+getent passwd cvmfs >/dev/null || useradd -u 990 -g 989 -r -s /sbin/nologin -d /var/lib/cvmfs -M cvmfs
+uname -r
+sudo dnf update -y
+dnf -y install epel-release
+dnf config-manager --set-enabled crb # Enable CRB for dependencies
+dnf -y install wget ansible-core     # Use ansible-core for v10
+echo 'System prepared for Ansible'
@@ -7,57 +7,106 @@ packer {
   }
 }
 
+locals {
+  # build.py sets var.iso_url and var.iso_checksum to the copy in its ISO cache
+  rockylinux_9_iso_url      = coalesce(var.iso_url, "https://download.rockylinux.org/pub/rocky/9/isos/x86_64/Rocky-9-latest-x86_64-boot.iso")
+  rockylinux_9_iso_checksum = coalesce(var.iso_checksum, "file:https://download.rockylinux.org/pub/rocky/9/isos/x86_64/Rocky-9-latest-x86_64-boot.iso.CHECKSUM")
+  rockylinux_9_boot_command = [
+    "<esc><wait>",
+    "linux inst.mbr biosdevname=0 net.ifnames=0 ",
+    "rootpw=${var.ssh_password} ",
+    "inst.ks=http://{{ .HTTPIP }}:{{ .HTTPPort }}/rockylinux-9-latest-x86_64-anaconda-ks.cfg",
+    "<enter>"
+  ]
+  rockylinux_10_iso_url      = coalesce(var.iso_url, "https://download.rockylinux.org/pub/rocky/10/isos/x86_64/Rocky-10-latest-x86_64-boot.iso")
+  rockylinux_10_iso_checksum = coalesce(var.iso_checksum, "file:https://download.rockylinux.org/pub/rocky/10/isos/x86_64/Rocky-10-latest-x86_64-boot.iso.CHECKSUM")
+  rockylinux_10_boot_command = [
+    "<esc><wait>e",
+    "<down><down><end><wait>",
+    " inst.ks=http://{{ .HTTPIP }}:{{ .HTTPPort }}/rockylinux-10-latest-x86_64-anaconda-ks.cfg",
+    " rootpw=${var.ssh_password} ",
+    "<leftCtrlOn>x<leftCtrlOff>"
+  ]
+}
+
 build {
+  # Full builds: kickstart install, base provisioning and Ansible in one go
   source "source.qemu.base" {
     name = "rockylinux-9-latest-x86_64"
     vm_name = "rockylinux-9-latest-x86_64"
-    iso_url = "https://download.rockylinux.org/pub/rocky/9/isos/x86_64/Rocky-9-latest-x86_64-boot.iso"
-    iso_checksum = "file:https://download.rockylinux.org/pub/rocky/9/isos/x86_64/Rocky-9-latest-x86_64-boot.iso.CHECKSUM"
+    iso_url = local.rockylinux_9_iso_url
+    iso_checksum = local.rockylinux_9_iso_checksum
     disk_size = "${local.disk_size}"
-    boot_command = [
-      "<esc><wait>",
-      "linux inst.mbr biosdevname=0 net.ifnames=0 ",
-      "rootpw=${var.ssh_password} ",
-      "inst.ks=http://{{ .HTTPIP }}:{{ .HTTPPort }}/rockylinux-9-latest-x86_64-anaconda-ks.cfg",
-      "<enter>"
-    ]
+    boot_command = local.rockylinux_9_boot_command
     shutdown_command = "systemctl poweroff"
   }
 
   source "source.qemu.base" {
     name = "rockylinux-10-latest-x86_64"
     vm_name = "rockylinux-10-latest-x86_64"
-    iso_url = "https://download.rockylinux.org/pub/rocky/10/isos/x86_64/Rocky-10-latest-x86_64-boot.iso"
-    iso_checksum = "file:https://download.rockylinux.org/pub/rocky/10/isos/x86_64/Rocky-10-latest-x86_64-boot.iso.CHECKSUM"
+    iso_url = local.rockylinux_10_iso_url
+    iso_checksum = local.rockylinux_10_iso_checksum
+    disk_size = "${local.disk_size}"
+    boot_command = local.rockylinux_10_boot_command
+    shutdown_command = "systemctl poweroff"
+  }
+
+  # Base layers: kickstart install and base provisioning only,
+  # build.py stores the result in its base layer cache
+  source "source.qemu.base" {
+    name = "rockylinux-9-latest-x86_64-base"
+    vm_name = "rockylinux-9-latest-x86_64"
+    iso_url = local.rockylinux_9_iso_url
+    iso_checksum = local.rockylinux_9_iso_checksum
+    disk_size = "${local.disk_size}"
+    boot_command = local.rockylinux_9_boot_command
+    shutdown_command = "systemctl poweroff"
+  }
+
+  source "source.qemu.base" {
+    name = "rockylinux-10-latest-x86_64-base"
+    vm_name = "rockylinux-10-latest-x86_64"
+    iso_url = local.rockylinux_10_iso_url
+    iso_checksum = local.rockylinux_10_iso_checksum
+    disk_size = "${local.disk_size}"
+    boot_command = local.rockylinux_10_boot_command
+    shutdown_command = "systemctl poweroff"
+  }
+
+  # Layered builds: Ansible only, on top of a cached base layer (var.base_image)
+  source "source.qemu.layered" {
+    name = "rockylinux-9-latest-x86_64-layered"
+    vm_name = "rockylinux-9-latest-x86_64"
+    disk_size = "${local.disk_size}"
+    shutdown_command = "systemctl poweroff"
+  }
+
+  source "source.qemu.layered" {
+    name = "rockylinux-10-latest-x86_64-layered"
+    vm_name = "rockylinux-10-latest-x86_64"
     disk_size = "${local.disk_size}"
-    boot_command = [
-      "<esc><wait>e",
-      "<down><down><end><wait>",
-      " inst.ks=http://{{ .HTTPIP }}:{{ .HTTPPort }}/rockylinux-10-latest-x86_64-anaconda-ks.cfg",
-      " rootpw=${var.ssh_password} ",
-      "<leftCtrlOn>x<leftCtrlOff>"
-    ]
     shutdown_command = "systemctl poweroff"
   }
 
   provisioner "shell" {
-    inline = [
-      "usermod -u 99 $(id -nu 999 )",
-      "groupmod -g 99 $(getent group 999 | cut -d: -f1)",
-      "if getent passwd 990 >/dev/null; then usermod -u 98 $(getent passwd 990 | cut -d: -f1); fi",
-      "if getent group 989 >/dev/null; then groupmod -g 98 $(getent group 989 | cut -d: -f1); fi",
-      "getent group cvmfs >/dev/null || groupadd -g 989 cvmfs",
-      "getent passwd cvmfs >/dev/null || useradd -u 990 -g 989 -r -s /sbin/nologin -d /var/lib/cvmfs -M cvmfs",
-      "uname -r",
-      "sudo dnf update -y",
-      "dnf -y install epel-release",
-      "dnf config-manager --set-enabled crb", # Enable CRB for dependencies
-      "dnf -y install wget ansible-core",     # Use ansible-core for v10
-      "echo 'System prepared for Ansible'",
+    script           = "templates/package-proxy-on.sh"
+    environment_vars = ["PACKAGE_PROXY=${var.package_proxy}"]
+  }
+
+  provisioner "shell" {
+    # build.py hashes this script for the base layer cache key
+    script = "templates/base-provisioning.sh"
+    except = [
+      "qemu.rockylinux-9-latest-x86_64-layered",
+      "qemu.rockylinux-10-latest-x86_64-layered",
     ]
   }
 
   provisioner "ansible" {
+    except = [
+      "qemu.rockylinux-9-latest-x86_64-base",
+      "qemu.rockylinux-10-latest-x86_64-base",
+    ]
     playbook_file    = "ansible/${local.playbook}"
     user             = "root"
     galaxy_file      = "requirements.yml"
@@ -74,6 +123,51 @@ build {
     groups           = var.groups
   }
 
+  provisioner "shell" {
+    except = [
+      "qemu.rockylinux-9-latest-x86_64-base",
+      "qemu.rockylinux-10-latest-x86_64-base",
+    ]
+    script           = "templates/netboot-files.sh"
+    environment_vars = ["NETBOOT=${var.netboot}"]
+  }
+
+  provisioner "file" {
+    except = [
+      "qemu.rockylinux-9-latest-x86_64-base",
+      "qemu.rockylinux-10-latest-x86_64-base",
+    ]
+    direction   = "download"
+    source      = "/tmp/netboot/"
+    destination = "${var.output_directory}/netboot/"
+  }
+
+  provisioner "shell" {
+    except = [
+      "qemu.rockylinux-9-latest-x86_64-base",
+      "qemu.rockylinux-10-latest-x86_64-base",
+    ]
+    inline = ["rm -rf /tmp/netboot"]
+  }
+
+  provisioner "shell" {
+    # Incremental builds: undo templates/incremental-unlock.sh, run by build.py
+    only = [
+      "qemu.rockylinux-9-latest-x86_64-layered",
+      "qemu.rockylinux-10-latest-x86_64-layered",
+    ]
+    script = "templates/incremental-relock.sh"
+  }
+
+  provisioner "shell" {
+    script = "templates/package-proxy-off.sh"
+  }
+
+  provisioner "shell" {
+    script           = "templates/shrink-guest.sh"
+    environment_vars = ["SHRINK=${var.shrink}"]
+  }
+
   post-processor "manifest" {
       output = "${var.output_directory}/${source.name}.json"
   }
@@ -0,0 +1,10 @@
+#!/bin/sh -e
+# Restores what incremental-unlock.sh changed in the previous image, unless
+# the playbooks run by the incremental build did it already.
+if [ -e /etc/vgcn-build-relock-root ]; then
+    grep -q '^root:!' /etc/shadow || usermod --lock root
+    rm -f /etc/vgcn-build-relock-root
+fi
+if [ -e /etc/vgcn-build-enable-cloud-init ]; then
+    rm -f /etc/cloud/cloud-init.disabled /etc/vgcn-build-enable-cloud-init
+fi
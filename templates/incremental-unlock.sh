@@ -0,0 +1,13 @@
+#!/bin/sh -e
+# Prepares the previous image of an incremental build for Packer, run in the
+# image by virt-customize (build.py). Finished images may have the root
+# password locked (lock-root role) and cloud-init installed, which would
+# reconfigure SSH on boot. Both are undone for the build and restored by
+# incremental-relock.sh, the marker files record what to restore.
+if grep -q '^root:!' /etc/shadow; then
+    usermod --unlock root
+    touch /etc/vgcn-build-relock-root
+fi
+if [ -d /etc/cloud ] && [ ! -e /etc/cloud/cloud-init.disabled ]; then
+    touch /etc/cloud/cloud-init.disabled /etc/vgcn-build-enable-cloud-init
+fi
@@ -0,0 +1,18 @@
+#!/bin/sh -e
+# Stages kernel and initramfs for network boot (build.py --formats netboot,
+# always for the pxe delivery). The file provisioner in build.pkr.hcl downloads
+# /tmp/netboot, which therefore always exists, but stays empty otherwise.
+rm -rf /tmp/netboot
+mkdir -p /tmp/netboot
+[ "$NETBOOT" = "true" ] || exit 0
+
+kernel=$(ls -1 /boot/vmlinuz-* | grep -v rescue | sort -V | tail -n 1)
+cp "$kernel" /tmp/netboot/vmlinuz
+# The initramfs built by the openslx-ng.dracut role of the pxe delivery
+# boots the image over the network, other deliveries get the default one
+if [ -f /opt/systemd-init/initramfs ]; then
+    cp /opt/systemd-init/initramfs /tmp/netboot/initramfs
+else
+    cp "/boot/initramfs-${kernel#/boot/vmlinuz-}.img" /tmp/netboot/initramfs
+fi
+chmod 644 /tmp/netboot/*
@@ -0,0 +1,11 @@
+#!/bin/sh -e
+# Restores the files changed by package-proxy-on.sh and removes its dnf plugin,
+# the image must not depend on the build host's proxy.
+for backup in /etc/dnf/dnf.conf.vgcn-build /etc/yum.repos.d/*.repo.vgcn-build; do
+    [ -f "$backup" ] || continue
+    mv -f "$backup" "${backup%.vgcn-build}"
+done
+if [ -f /etc/dnf/vgcn-build-plugin ]; then
+    rm -f "$(cat /etc/dnf/vgcn-build-plugin)" /etc/dnf/plugins/vgcn_build_proxy.conf
+    rm -f /etc/dnf/vgcn-build-plugin
+fi
@@ -0,0 +1,58 @@
+#!/bin/sh -e
+# Points dnf at the caching proxy of build.py (--package-proxy).
+# The original dnf.conf is kept as dnf.conf.vgcn-build, package-proxy-off.sh
+# restores it and removes the dnf plugin installed here.
+[ -n "$PACKAGE_PROXY" ] || exit 0
+
+echo "Using package proxy $PACKAGE_PROXY"
+cp -p /etc/dnf/dnf.conf /etc/dnf/dnf.conf.vgcn-build
+echo "proxy=$PACKAGE_PROXY" >> /etc/dnf/dnf.conf
+
+# HTTPS downloads can only be tunneled through the proxy, not cached. Instead
+# of rewriting the repo files present now, a dnf plugin switches the repos to
+# plain http mirrors whenever dnf runs, so it also covers the repos added
+# later (EPEL, Docker, HTCondor, CVMFS). Repodata is still verified by the
+# checksums from the metalink and packages by their GPG signature, so only
+# repos with gpgcheck get http base URLs.
+plugins=$(python3 -c 'import dnf, os; print(os.path.join(os.path.dirname(os.path.dirname(dnf.__file__)), "dnf-plugins"))')
+echo "$plugins/vgcn_build_proxy.py" > /etc/dnf/vgcn-build-plugin
+printf '[main]\nenabled=1\n' > /etc/dnf/plugins/vgcn_build_proxy.conf
+cat > "$plugins/vgcn_build_proxy.py" <<'EOF'
+# Asks for http mirrors while building a VGCN image, see package-proxy-on.sh
+import urllib.parse
+
+import dnf
+
+# Serve their repos over http too, redirects to https are followed by dnf
+HTTP_HOSTS = {
+    "dl.rockylinux.org",
+    "download.rockylinux.org",
+    "dl.fedoraproject.org",
+    "download.docker.com",
+    "research.cs.wisc.edu",
+    "htcss-downloads.chtc.wisc.edu",
+    "cvmrepo.web.cern.ch",
+    "cvmrepo.s3.cern.ch",
+}
+
+
+def http_url(url):
+    parts = urllib.parse.urlsplit(url)
+    if parts.scheme != "https" or parts.hostname not in HTTP_HOSTS:
+        return url
+    return urllib.parse.urlunsplit(parts._replace(scheme="http"))
+
+
+class VgcnBuildProxy(dnf.Plugin):
+    name = "vgcn_build_proxy"
+
+    def config(self):
+        for repo in self.base.repos.iter_enabled():
+            # MirrorManager (Rocky, EPEL) lists http mirrors on request
+            for option in ["metalink", "mirrorlist"]:
+                url = getattr(repo, option)
+                if url and "?" in url and "protocol=" not in url:
+                    setattr(repo, option, url + "&protocol=http")
+            if repo.gpgcheck:
+                repo.baseurl = [http_url(x) for x in repo.baseurl]
+EOF
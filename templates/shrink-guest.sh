@@ -0,0 +1,15 @@
+#!/bin/sh -e
+# Frees the blocks of deleted files before the image is converted (build.py --shrink).
+# The build VM's disk discards trimmed blocks and detects zeroed ones,
+# both end up as holes in the qcow2 image, see sources.pkr.hcl.
+[ "$SHRINK" = "true" ] || exit 0
+
+dnf clean all
+rm -rf /var/cache/dnf/*
+if ! fstrim --all --verbose; then
+    echo "fstrim not supported, zeroing free space instead"
+    # dd stops with an error once the disk is full
+    dd if=/dev/zero of=/zero.fill bs=1M status=none || true
+    rm -f /zero.fill
+fi
+sync
@@ -33,6 +33,14 @@ variable "ssh_timeout" {
   default = "10m"
 }
 
+variable "base_image" {
+  # qcow2 image the layered sources start from, set by build.py: a cached
+  # base layer or, for incremental builds, the previous image converted.
+  # Packer creates the overlay with the backing format of its output format.
+  type    = string
+  default = ""
+}
+
 variable "http_dir" {
   type    = string
   default = "templates"
@@ -52,6 +60,9 @@ source "qemu" "base" {
   accelerator        = "kvm"
   format             = "qcow2"
   disk_interface     = "virtio"
+  # Blocks trimmed or zeroed in the guest become holes in the qcow2 image
+  disk_discard       = "unmap"
+  disk_detect_zeroes = "unmap"
   net_device         = "virtio-net"
   headless           = "${var.headless}"
   http_directory     = "${var.http_dir}"
@@ -65,3 +76,27 @@ source "qemu" "base" {
     ["-cpu", "host"]
   ]
 }
+
+source "qemu" "layered" {
+  output_directory   = "${var.output_directory}"
+  accelerator        = "kvm"
+  format             = "qcow2"
+  disk_image         = true
+  use_backing_file   = true
+  iso_url            = "${var.base_image}"
+  iso_checksum       = "none"
+  disk_interface     = "virtio"
+  # Blocks trimmed or zeroed in the guest become holes in the qcow2 image
+  disk_discard       = "unmap"
+  disk_detect_zeroes = "unmap"
+  net_device         = "virtio-net"
+  headless           = "${var.headless}"
+  ssh_timeout        = "${var.ssh_timeout}"
+  ssh_username       = "${var.ssh_username}"
+  ssh_password       = "${var.ssh_password}"
+  qemuargs           = [
+    ["-m", "${var.memory}"],
+    ["-smp", "${var.cpus}"],
+    ["-cpu", "host"]
+  ]
+}
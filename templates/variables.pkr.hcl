@@ -27,7 +27,7 @@ variable "headless" {
   default = "true"
 }
 locals {
-  playbook = contains(var.groups, "internal") ? "playbooks-internal.yml" : "playbooks-external.yml"
+  playbook = var.playbook != "" ? var.playbook : contains(var.groups, "internal") ? "playbooks-internal.yml" : "playbooks-external.yml"
 }
 locals {
   vault_password = contains(var.groups, "internal") ? "--vault-password-file=${var.vault_password_file}" : null
@@ -42,6 +42,38 @@ variable "vault_password_file" {
   type    = string
   default = ".vault_password"
 }
+variable "playbook" {
+  # Meta-playbook in the ansible directory to run instead of the default one,
+  # build.py generates one for incremental builds
+  type = string
+  default = ""
+}
+variable "iso_url" {
+  # Local boot ISO of the selected source, build.py sets it to the verified
+  # copy in its ISO cache; the default is the download in build.pkr.hcl
+  type = string
+  default = ""
+}
+variable "iso_checksum" {
+  type = string
+  default = ""
+}
+variable "shrink" {
+  # Trim free space at the end of provisioning, build.py --shrink
+  type = bool
+  default = false
+}
+variable "netboot" {
+  # Download kernel and initramfs for network boot, build.py --formats netboot
+  type = bool
+  default = false
+}
+variable "package_proxy" {
+  # Caching HTTP proxy for dnf in the build VM, build.py starts one with
+  # --package-proxy; the proxy settings are removed again at the end of the build
+  type = string
+  default = ""
+}
 variable "image_name" {
   type = string
   default = ""
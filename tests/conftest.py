@@ -0,0 +1,8 @@
+import pathlib
+import sys
+
+ROOT = pathlib.Path(__file__).parent.parent
+
+# The scripts aren't packages, make them importable by file name
+for directory in (ROOT, ROOT / "scripts", ROOT / "ansible" / "files"):
+    sys.path.insert(0, str(directory))
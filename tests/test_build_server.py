@@ -0,0 +1,66 @@
+import threading
+import time
+
+import pytest
+
+import build_server
+
+ARGS = ["rockylinux-9-latest-x86_64", "generic", "kvm"]
+
+
+@pytest.fixture
+def builds(tmp_path, monkeypatch):
+    """
+    A BuildQueue with two workers, running stand-ins instead of build.py.
+    """
+    monkeypatch.setattr(build_server, "STATE_DIR", tmp_path)
+    builds = build_server.BuildQueue(2)
+    builds.overlaps = []
+    building = set()
+    lock = threading.Lock()
+
+    def run(job):
+        with lock:
+            if job.name in building:
+                builds.overlaps.append(job.name)
+            building.add(job.name)
+        time.sleep(0.2)
+        with lock:
+            building.discard(job.name)
+        job.set_state("ok")
+
+    monkeypatch.setattr(builds, "run", run)
+    yield builds.start()
+    builds.shutdown()
+
+
+def wait_done(jobs):
+    deadline = time.time() + 5
+    while any(x.state in build_server.ACTIVE for x in jobs):
+        assert time.time() < deadline
+        time.sleep(0.01)
+
+
+def test_same_request_coalesced(builds):
+    first, coalesced = builds.submit(ARGS)
+    assert not coalesced
+    second, coalesced = builds.submit(ARGS + ["-q"])
+    assert coalesced and second is first and first.requests == 2
+    wait_done([first])
+
+
+def test_same_image_other_delivery_serialized(builds):
+    first, _ = builds.submit(ARGS)
+    second, coalesced = builds.submit(ARGS + ["--openstack"])
+    assert not coalesced and second is not first
+    assert second.name == first.name
+    wait_done([first, second])
+    assert builds.overlaps == []
+    assert second.started >= first.finished
+
+
+def test_other_images_concurrent(builds):
+    first, _ = builds.submit(ARGS)
+    second, _ = builds.submit(["rockylinux-10-latest-x86_64", "generic", "kvm"])
+    wait_done([first, second])
+    assert second.started < first.finished
@@ -0,0 +1,96 @@
+import hashlib
+import io
+import os
+
+import pytest
+
+import build
+import delta_publish
+
+BLOCK = delta_publish.BLOCK_SIZE
+
+
+def block(seed, size=BLOCK):
+    return hashlib.sha256(seed.encode()).digest() * (size // 32) + bytes(size % 32)
+
+
+def name(seconds):
+    return f"vgcn~rockylinux-9-latest-x86_64~+generic+workers~2026-01-01~{seconds}~main~abc1234"
+
+
+@pytest.fixture
+def publisher(tmp_path, monkeypatch):
+    """
+    Returns a function publishing an image with the given content to a local
+    --publish-target through Build.publish_delta.
+    """
+    monkeypatch.chdir(build.DIR_PATH)
+    target = tmp_path / "published"
+    target.mkdir()
+
+    def publish(seconds, content):
+        image = build.Build(
+            False,
+            "rockylinux-9-latest-x86_64",
+            None,
+            ["generic", "workers"],
+            "no",
+            None,
+            None,
+            "",
+            False,
+            publish_target=str(target),
+        )
+        image.image_name = name(seconds)
+        image.image_path = tmp_path / f"{image.image_name}.raw"
+        image.image_path.write_bytes(content)
+        image.publish_delta()
+        return target / image.image_name
+
+    return publish
+
+
+def sent(capsys):
+    return [x for x in capsys.readouterr().out.splitlines() if x.startswith("Sent ")]
+
+
+def test_round_trip(publisher, capsys):
+    first = block("a") + block("b") + bytes(BLOCK) + block("d") + block("e") + block("f", 1000)
+    published = publisher(100, first)
+    assert published.read_bytes() == first
+    assert sent(capsys) == [
+        f"Sent 5 of 6 blocks, 0 unchanged, 1 empty, sha256 {hashlib.sha256(first).hexdigest()}"
+    ]
+
+    # Changed and newly empty blocks, a different partial last block
+    second = block("a") + block("B") + bytes(BLOCK) + block("d") + bytes(BLOCK) + block("F", 1500)
+    published = publisher(200, second)
+    assert published.read_bytes() == second
+    assert sent(capsys) == [
+        f"Sent 2 of 6 blocks, 3 unchanged, 1 empty, sha256 {hashlib.sha256(second).hexdigest()}"
+    ]
+
+    # Unchanged, including the partial last block
+    published = publisher(300, second)
+    assert hashlib.sha256(published.read_bytes()).digest() == hashlib.sha256(second).digest()
+    assert sent(capsys)[0].startswith("Sent 0 of 6 blocks, 6 unchanged, 0 empty")
+    assert not [x for x in os.listdir(published.parent) if x.endswith(".part")]
+
+
+def test_shrinking_image(publisher):
+    publisher(100, block("a") + block("b") + block("c", 10))
+    published = publisher(200, block("a") + block("b", 20))
+    assert published.read_bytes() == block("a") + block("b", 20)
+
+
+def test_checksum_mismatch(tmp_path):
+    image = tmp_path / "image.raw"
+    image.write_bytes(block("a") + block("b", 100))
+    stream = io.BytesIO()
+    delta_publish.write_delta(image, [], stream)
+    # Corrupt the digest at the end of the stream
+    data = bytearray(stream.getvalue())
+    data[-1] ^= 1
+    with pytest.raises(ValueError):
+        delta_publish.apply_delta(str(tmp_path), "copy.raw", None, io.BytesIO(bytes(data)))
+    assert sorted(os.listdir(tmp_path)) == ["image.raw"]
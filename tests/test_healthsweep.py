@@ -0,0 +1,63 @@
+import asyncio
+import io
+import json
+
+from healthsweep import HealthSweep
+
+REPORT = {
+    "healthy": False,
+    "checks": {"mounts": {"healthy": True}, "cvmfs": {"healthy": False}},
+}
+
+# Stand-ins for the hosts, picked by the host name
+COMMAND = (
+    "case {host} in "
+    "healthy) echo '%s';; "
+    "unhealthy) echo '%s';; "
+    "slow) sleep 10;; "
+    "garbage) echo 'Traceback'; exit 1;; "
+    "list) echo '[1, 2]';; "
+    "broken) echo '{\"healthy\": true, \"checks\": null}';; "
+    "esac"
+    % (json.dumps({"healthy": True, "checks": {"mounts": {"healthy": True}}}),
+       json.dumps(REPORT))
+)
+
+
+def sweep(tmp_path, hosts, deadline=5):
+    checker = HealthSweep(
+        COMMAND, parallel=4, deadline=deadline, control_dir=str(tmp_path), local=True
+    )
+    out = io.StringIO()
+    summary = asyncio.run(checker.sweep(hosts, out))
+    results = {x["host"]: x for x in map(json.loads, out.getvalue().splitlines())}
+    return summary, results
+
+
+def test_success(tmp_path):
+    summary, results = sweep(tmp_path, ["healthy", "unhealthy"])
+    assert summary["hosts"] == 2
+    assert summary["healthy"] == 1
+    assert summary["by_check"] == {"cvmfs": ["unhealthy"]}
+    assert results["healthy"]["healthy"] is True
+    assert results["unhealthy"]["failed"] == ["cvmfs"]
+    assert results["unhealthy"]["report"] == REPORT
+
+
+def test_timeout(tmp_path):
+    summary, results = sweep(tmp_path, ["slow", "healthy"], deadline=1)
+    assert summary["by_check"] == {"unreachable": ["slow"]}
+    assert results["slow"]["error"] == "timeout"
+    assert results["slow"]["duration"] < 5
+
+
+def test_bad_output(tmp_path):
+    summary, results = sweep(tmp_path, ["garbage", "list", "broken"])
+    assert summary["unhealthy"] == 3
+    assert summary["by_check"] == {
+        "unreachable": ["garbage"],
+        "bad_report": ["broken", "list"],
+    }
+    assert results["garbage"]["error"] == "exit 1: no report"
+    assert results["list"]["error"] == "bad report"
+    assert not results["broken"]["healthy"]
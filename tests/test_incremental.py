@@ -0,0 +1,25 @@
+import pytest
+
+import build
+
+PLAYBOOKS = ["generic", "workers", "internal"]
+
+
+@pytest.mark.parametrize(
+    "changed, expected",
+    [
+        (["ansible/workers.yml"], ["workers"]),
+        (["ansible/kvm.yml"], []),
+        # The build VM is in every provisioning group
+        (["ansible/group_vars/workers.yml"], PLAYBOOKS),
+        (["ansible/group_vars/pulsar.yml"], PLAYBOOKS),
+        (["ansible/group_vars/all.yml"], PLAYBOOKS),
+        (["ansible/files/meta_walltime.py"], ["workers"]),
+        (["scripts/healthcheck.py"], ["workers"]),
+        (["scripts/healthsweep.py"], []),
+        (["templates/build.pkr.hcl"], None),
+        (["ansible/playbooks-internal.yml"], None),
+    ],
+)
+def test_affected_playbooks(changed, expected):
+    assert build.affected_playbooks(changed, PLAYBOOKS) == expected
@@ -0,0 +1,51 @@
+import hashlib
+import threading
+from unittest import mock
+
+import iso_cache
+
+CONTENT = b"boot iso"
+CHECKSUM = f"sha256:{hashlib.sha256(CONTENT).hexdigest()}"
+URL = "http://example.org/boot.iso"
+
+
+def fake_download(url, path, expected, head=""):
+    path.write_bytes(CONTENT)
+
+
+def test_miss_then_hit(tmp_path):
+    cache = iso_cache.IsoCache(tmp_path)
+    with mock.patch.object(cache, "download", side_effect=fake_download) as download:
+        with cache.fetch(URL, CHECKSUM) as path:
+            assert path.read_bytes() == CONTENT
+        with cache.fetch(URL, CHECKSUM) as path:
+            assert path.exists()
+    download.assert_called_once()
+    assert [x["url"] for x in cache.entries()] == [URL]
+
+
+def test_concurrent_hits_dont_wait(tmp_path):
+    cache = iso_cache.IsoCache(tmp_path)
+    with mock.patch.object(cache, "download", side_effect=fake_download):
+        with cache.fetch(URL, CHECKSUM):
+            # A second build of the same template while the first one runs
+            fetched = threading.Event()
+
+            def fetch():
+                with cache.fetch(URL, CHECKSUM):
+                    fetched.set()
+
+            thread = threading.Thread(target=fetch, daemon=True)
+            thread.start()
+            assert fetched.wait(5)
+            thread.join()
+
+
+def test_in_use_not_pruned(tmp_path):
+    cache = iso_cache.IsoCache(tmp_path)
+    with mock.patch.object(cache, "download", side_effect=fake_download):
+        with cache.fetch(URL, CHECKSUM) as path:
+            assert cache.prune(max_size=0, max_age=0) == []
+            assert path.exists()
+        assert [x["url"] for x in cache.prune(max_size=0, max_age=0)] == [URL]
+    assert not path.exists()
@@ -0,0 +1,50 @@
+import pytest
+
+import build
+
+
+@pytest.fixture(autouse=True)
+def repo_dir(monkeypatch):
+    # The parser lists the playbooks in ./ansible
+    monkeypatch.chdir(build.DIR_PATH)
+
+
+def matrix(*args):
+    parsed = build.make_parser().parse_args(["--matrix", *args])
+    _, builds = build.matrix_builds(parsed)
+    return [x.log_prefix for x in builds]
+
+
+def test_template_x_delivery():
+    assert matrix("rockylinux-9-latest-x86_64,rockylinux-10-latest-x86_64", "workers", "kvm,pxe") == [
+        "rockylinux-9-latest-x86_64/kvm",
+        "rockylinux-9-latest-x86_64/pxe",
+        "rockylinux-10-latest-x86_64/kvm",
+        "rockylinux-10-latest-x86_64/pxe",
+    ]
+
+
+def test_provisioning_sets():
+    builds = matrix(
+        "rockylinux-9-latest-x86_64",
+        "workers",
+        "internal",
+        "kvm,pxe",
+        "--provisioning",
+        "workers,external",
+        "--provisioning",
+        "workers,internal",
+    )
+    assert builds == [
+        "rockylinux-9-latest-x86_64/workers+internal/kvm",
+        "rockylinux-9-latest-x86_64/workers+internal/pxe",
+        "rockylinux-9-latest-x86_64/workers+external/kvm",
+        "rockylinux-9-latest-x86_64/workers+external/pxe",
+    ]
+
+
+def test_provisioning_set_choices():
+    with pytest.raises(SystemExit):
+        build.make_parser().parse_args(
+            ["rockylinux-9-latest-x86_64", "workers", "kvm", "--provisioning", "nope"]
+        )
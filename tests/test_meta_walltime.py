@@ -0,0 +1,131 @@
+import argparse
+import io
+import json
+import os
+import pickle
+import types
+from unittest import mock
+
+import pytest
+
+import meta_walltime
+
+
+def write_json(path, meta):
+    path.write_text(json.dumps({"ds": {"meta_data": {"meta": meta}}}))
+
+
+@pytest.fixture
+def instance_data(tmp_path):
+    path = tmp_path / "instance-data.json"
+    write_json(path, {"maxWallTime": "7200", "other": "x"})
+    return path
+
+
+def get_times(tmp_path, instance_data, obj_pkl="missing.pkl"):
+    return meta_walltime.get_times(
+        str(tmp_path / "cache.json"), str(instance_data), str(tmp_path / obj_pkl)
+    )
+
+
+def test_walltime_from_json(tmp_path, instance_data):
+    start = int(os.stat(instance_data).st_ctime)
+    assert get_times(tmp_path, instance_data) == (7200, start)
+    assert (tmp_path / "cache.json").exists()
+
+
+def test_cached_times_reused(tmp_path, instance_data):
+    times = get_times(tmp_path, instance_data)
+    with mock.patch.object(meta_walltime, "meta_from_json") as meta_from_json:
+        assert get_times(tmp_path, instance_data) == times
+    meta_from_json.assert_not_called()
+
+
+def test_cache_invalidated_by_changes(tmp_path, instance_data):
+    get_times(tmp_path, instance_data)
+    write_json(instance_data, {"maxWallTime": "3600", "padding": "changed"})
+    assert get_times(tmp_path, instance_data)[0] == 3600
+
+
+def test_walltime_from_pickle(tmp_path):
+    with open(tmp_path / "obj.pkl", "wb") as file_:
+        # Stands in for a cloudinit.sources.DataSource
+        pickle.dump(types.SimpleNamespace(metadata={"meta": {"WallTime": "100"}}), file_)
+    times = get_times(tmp_path, tmp_path / "missing.json", "obj.pkl")
+    assert times is not None and times[0] == 100
+
+
+def test_ambiguous_metadata(tmp_path):
+    write_json(tmp_path / "ambiguous.json", {"WallTime": "1", "maxWallTime": "2"})
+    with pytest.raises(ValueError):
+        get_times(tmp_path, tmp_path / "ambiguous.json")
+
+
+def test_no_metadata(tmp_path):
+    assert get_times(tmp_path, tmp_path / "missing.json") is None
+
+
+@pytest.mark.parametrize(
+    "elapsed, expected",
+    [
+        (3000, ["MachineRemainingWalltime = 4200", "MachineDrainSoon = False"]),
+        (4000, ["MachineDrainSoon = True"]),
+        (9000, ["MachineRemainingWalltime = 0", "MachineDrainSoon = True"]),
+    ],
+)
+def test_walltime_ad(elapsed, expected):
+    ad = meta_walltime.walltime_ad((7200, 1000), 1000 + elapsed, 3600)
+    assert set(expected) <= set(ad)
+
+
+def test_walltime_ad_uptime_fallback():
+    ad = meta_walltime.walltime_ad(None, 0, 3600)
+    assert len(ad) == 2 and ad[0].startswith("MachineStarttime = ")
+
+
+@pytest.mark.parametrize(
+    "walltime, expected",
+    [
+        # Far from expiry
+        (86400, 600),
+        # Ends when draining has to start
+        (3700, 100),
+        # Shorter near expiry
+        (3000, 300),
+        (100, 30),
+    ],
+)
+def test_next_interval(walltime, expected):
+    assert meta_walltime.next_interval((walltime, 0), 0, 3600) == expected
+
+
+def test_publish(tmp_path, instance_data):
+    start = int(os.stat(instance_data).st_ctime)
+    clock = iter([start + 3500, start + 3600, start + 3700])
+    sleeps = []
+    out = io.StringIO()
+    args = argparse.Namespace(
+        cache_file=str(tmp_path / "cache.json"),
+        instance_data=str(instance_data),
+        obj_pkl=str(tmp_path / "missing.pkl"),
+        drain_before=3600,
+        min_interval=30,
+        max_interval=600,
+        count=3,
+    )
+    meta_walltime.publish(args, out, clock=lambda: next(clock), sleep=sleeps.append)
+    blocks = out.getvalue().split("-\n")
+    assert len(blocks) == 4 and blocks[-1] == ""
+    assert "MachineDrainSoon = False" in blocks[0]
+    assert "MachineDrainSoon = True" in blocks[2]
+    assert sleeps == [100, 360.0]
+
+
+def test_save_env(tmp_path):
+    environment = tmp_path / "environment"
+    environment.write_text("PATH=/usr/bin\nWALLTIME=1\n")
+    meta_walltime.save_env(7200, 1000, str(environment))
+    assert environment.read_text() == "PATH=/usr/bin\nWALLTIME=7200\nBOOTTIME=1000\n"
+    os.utime(environment, (0, 0))
+    meta_walltime.save_env(7200, 1000, str(environment))
+    assert environment.stat().st_mtime == 0
@@ -0,0 +1,44 @@
+import pytest
+
+import build
+
+
+def stream(command, sinks):
+    build.stream_to_sinks("STREAM", command, sinks, show_spinner=False)
+
+
+def test_stream_to_sinks(tmp_path):
+    raw = tmp_path / "image.raw"
+    copy = tmp_path / "copy.raw"
+    checksum = build.ChecksumSink("sha256")
+    sinks = [
+        build.FileSink("RAW", raw),
+        build.ProcessSink("COPY", f"cat > {copy}"),
+        checksum,
+    ]
+    stream("printf data", sinks)
+    assert raw.read_bytes() == copy.read_bytes() == b"data"
+    assert checksum.size == 4
+
+
+def test_failed_command_aborts_sinks(tmp_path):
+    raw = tmp_path / "image.raw"
+    with pytest.raises(SystemExit):
+        stream("printf data; exit 3", [build.FileSink("RAW", raw)])
+    assert not raw.exists()
+
+
+def test_sink_open_failure_aborts_opened(tmp_path):
+    raw = tmp_path / "image.raw"
+    upload = build.ProcessSink("UPLOAD", "sleep 30")
+    sinks = [
+        build.FileSink("RAW", raw),
+        upload,
+        build.FileSink("QCOW2", tmp_path / "missing" / "image.qcow2"),
+    ]
+    with pytest.raises(FileNotFoundError):
+        stream("printf data", sinks)
+    assert not raw.exists()
+    # Killed, not waited for
+    assert upload.proc.returncode is not None
+    assert list(tmp_path.iterdir()) == []
@@ -0,0 +1,77 @@
+import threading
+import time
+
+import pytest
+
+from timeout import TimeoutException, TimeoutExecutor
+
+
+def wait_for(condition, seconds=5):
+    deadline = time.time() + seconds
+    while not condition():
+        assert time.time() < deadline
+        time.sleep(0.01)
+
+
+def test_concurrent_calls_get_own_workers():
+    executor = TimeoutExecutor(max_workers=4)
+    # Leaves one idle worker
+    assert executor.call(1, lambda: 1) == 1
+    wait_for(lambda: executor.stats()["idle"] == 1)
+    # Only passes if all calls run at the same time
+    barrier = threading.Barrier(3)
+    futures = [executor.submit(barrier.wait, 1) for _ in range(3)]
+    assert sorted(x.result(2) for x in futures) == [0, 1, 2]
+    stats = executor.stats()
+    assert stats["workers"] == 3
+    assert stats["stuck"] == 0
+
+
+def test_concurrent_timeouts():
+    executor = TimeoutExecutor(max_workers=4)
+    assert executor.call(1, lambda: 1) == 1
+    wait_for(lambda: executor.stats()["idle"] == 1)
+    results = []
+
+    def call():
+        results.append(executor.call(1.0, time.sleep, 0.6))
+
+    threads = [threading.Thread(target=call) for _ in range(2)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert results == [None, None]
+    assert "timed_out" not in executor.stats()
+
+
+def test_full_pool_queues_calls():
+    executor = TimeoutExecutor(max_workers=1)
+    first = executor.submit(time.sleep, 0.3)
+    second = executor.submit(lambda: 2)
+    assert executor.stats()["backlog"] == 1
+    assert second.result(2) == 2 and first.done()
+    assert executor.stats()["workers"] == 1
+
+
+def test_stuck_and_recovered():
+    executor = TimeoutExecutor(max_workers=2)
+    release = threading.Event()
+    with pytest.raises(TimeoutException):
+        executor.call(0.1, release.wait)
+    stats = executor.stats()
+    assert stats["timed_out"] == 1
+    assert stats["stuck"] == 1
+    assert stats["tracked"] == 1
+    # The stuck worker was replaced
+    assert executor.call(1, lambda: 3) == 3
+    # Calling it again waits for the stuck call
+    with pytest.raises(TimeoutException):
+        executor.call(0.1, release.wait)
+    assert executor.stats()["started"] == 2
+    release.set()
+    wait_for(lambda: executor.stats()["stuck"] == 0)
+    stats = executor.stats()
+    assert stats["recovered"] == 1
+    assert stats["tracked"] == 0
+    assert stats["workers"] == 2